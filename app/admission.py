@@ -0,0 +1,281 @@
+"""
+Gemini 呼叫的准入控制
+
+在呼叫 generate_content 前以 token bucket 限制每秒的上游請求數，避免尖峰時觸發 API 配額 429：
+- 等待中的查詢依 session 輪流放行（同一 session 連續送出多個查詢不會擠掉其他人）
+- 等待佇列有上限；佇列已滿或預估等待超過上限時立即拒絕，不讓請求堆積到最後才失敗
+- 等待期間可透過 on_wait 回呼顯示排隊位置與預估等待時間
+- 設定 shared_path 時以 SQLite 共用 token bucket，多個 process 共用同一個速率上限
+
+重試不經過佇列，以 charge() 直接扣除 token（可為負值），延後後續查詢的放行時間。
+"""
+
+import itertools
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+
+class AdmissionRejected(Exception):
+    """佇列已滿或預估等待時間過長，查詢被拒絕"""
+
+
+class LocalTokenBucket:
+    """
+    process 內的 token bucket
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def take(self, cost: float) -> float:
+        """
+        嘗試取得 cost 個 token；成功回傳 0，否則回傳預估還需等待的秒數
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return 0.0
+            return (cost - self._tokens) / self.rate
+
+    def charge(self, cost: float):
+        """直接扣除 token（允許為負）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= cost
+
+    def deficit_wait(self) -> float:
+        """token 為負時回補到 0 所需的秒數"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, -self._tokens / self.rate)
+
+
+class SQLiteTokenBucket:
+    """
+    以 SQLite 共用的 token bucket（多個 process 共用同一個速率上限）
+
+    每次操作在 BEGIN IMMEDIATE 交易中讀取並更新 token 數，以資料庫寫入鎖序列化。
+    """
+
+    def __init__(self, path: str, rate: float, burst: float, name: str = 'gemini'):
+        self.path = Path(path)
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                'INSERT OR IGNORE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                (name, burst, time.time())
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _update(self, fn: Callable[[float], tuple]) -> Any:
+        """在交易中回補 token，fn(tokens) 回傳 (新的 token 數, 回傳值)"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM buckets WHERE name = ?', (self.name,)
+            ).fetchone()
+            now = time.time()
+            tokens, updated_at = row if row else (self.burst, now)
+            tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+            tokens, result = fn(tokens)
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                (self.name, tokens, now)
+            )
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def take(self, cost: float) -> float:
+        def fn(tokens):
+            if tokens >= cost:
+                return tokens - cost, 0.0
+            return tokens, (cost - tokens) / self.rate
+        return self._update(fn)
+
+    def charge(self, cost: float):
+        self._update(lambda tokens: (tokens - cost, None))
+
+    def deficit_wait(self) -> float:
+        return self._update(lambda tokens: (tokens, max(0.0, -tokens / self.rate)))
+
+
+class _Ticket:
+    __slots__ = ('id', 'session_id', 'cost', 'enqueued_at')
+
+    def __init__(self, ticket_id: int, session_id: str, cost: float):
+        self.id = ticket_id
+        self.session_id = session_id
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    token bucket + 依 session 輪流放行的等待佇列（thread-safe，每個 process 一個）
+    """
+
+    def __init__(self, rate: float = 5.0, burst: float = 10.0, max_queue: int = 50,
+                 max_wait: float = 60.0, shared_path: str = '', poll_interval: float = 0.5):
+        self.rate = rate
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        if shared_path:
+            self.bucket = SQLiteTokenBucket(shared_path, rate, burst)
+        else:
+            self.bucket = LocalTokenBucket(rate, burst)
+
+        # session_id → 該 session 的等待中 ticket；OrderedDict 的順序即輪流放行的順序
+        self._queues: 'OrderedDict[str, Deque[_Ticket]]' = OrderedDict()
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._counters = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'charged': 0,
+            'wait_total': 0.0,
+        }
+
+    def _fair_order(self) -> List[_Ticket]:
+        """依 session 輪流排列所有等待中的 ticket"""
+        order = []
+        queues = [list(q) for q in self._queues.values()]
+        for depth in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[depth] for q in queues if depth < len(q))
+        return order
+
+    def _queued_count(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _estimate_wait(self, tickets_ahead: List[_Ticket], cost: float) -> float:
+        return self.bucket.deficit_wait() + (sum(t.cost for t in tickets_ahead) + cost) / self.rate
+
+    def _remove(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.session_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if queue:
+            # 輪到下一個 session
+            self._queues.move_to_end(ticket.session_id)
+        else:
+            del self._queues[ticket.session_id]
+
+    def acquire(self, session_id: str, cost: float = 1.0,
+                on_wait: Optional[Callable[[int, float], None]] = None) -> float:
+        """
+        等待放行
+
+        on_wait(position, eta) 在需要排隊時定期呼叫（position 從 1 開始）。
+        回傳實際等待秒數；佇列已滿或預估等待超過 max_wait 時拋出 AdmissionRejected。
+        """
+        start = time.monotonic()
+        # 超過 burst 的請求永遠等不到足夠的 token
+        cost = min(cost, self.bucket.burst)
+        with self._cond:
+            # 沒有人排隊且有足夠 token：直接放行
+            if not self._queues and self.bucket.take(cost) == 0.0:
+                self._counters['admitted'] += 1
+                return 0.0
+
+            if self._queued_count() >= self.max_queue:
+                self._counters['rejected'] += 1
+                raise AdmissionRejected(f"目前查詢人數過多（排隊 {self._queued_count()} 筆），請稍後再試")
+
+            eta = self._estimate_wait(self._fair_order(), cost)
+            if eta > self.max_wait:
+                self._counters['rejected'] += 1
+                raise AdmissionRejected(f"目前查詢人數過多（預估需等待 {eta:.0f} 秒），請稍後再試")
+
+            ticket = _Ticket(next(self._ids), session_id, cost)
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._counters['queued'] += 1
+
+        deadline = start + self.max_wait
+        try:
+            while True:
+                with self._cond:
+                    order = self._fair_order()
+                    if order and order[0] is ticket:
+                        wait_for = self.bucket.take(cost)
+                        if wait_for == 0.0:
+                            self._remove(ticket)
+                            self._counters['admitted'] += 1
+                            waited = time.monotonic() - start
+                            self._counters['wait_total'] += waited
+                            self._cond.notify_all()
+                            return waited
+                    else:
+                        wait_for = self.poll_interval
+                    position = order.index(ticket) + 1
+                    eta = self._estimate_wait(order[:position - 1], cost)
+
+                if time.monotonic() >= deadline:
+                    with self._cond:
+                        self._counters['timeouts'] += 1
+                    raise AdmissionRejected(f"等待超過 {self.max_wait:g} 秒，請稍後再試")
+
+                if on_wait is not None:
+                    on_wait(position, eta)
+
+                with self._cond:
+                    self._cond.wait(min(max(wait_for, 0.01), self.poll_interval))
+        except BaseException:
+            with self._cond:
+                self._remove(ticket)
+                self._cond.notify_all()
+            raise
+
+    def charge(self, cost: float = 1.0):
+        """不經佇列直接扣除 token（用於重試）"""
+        self.bucket.charge(cost)
+        with self._cond:
+            self._counters['charged'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳統計：admitted, queued, rejected, timeouts, charged, waiting, avg_wait
+        """
+        with self._cond:
+            stats = dict(self._counters)
+            stats['waiting'] = self._queued_count()
+        stats['avg_wait'] = stats.pop('wait_total') / stats['queued'] if stats['queued'] else 0.0
+        return stats
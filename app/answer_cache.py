@@ -0,0 +1,186 @@
+"""
+查詢結果快取
+
+以 SQLite 儲存 query_gemini() 的答案與來源，重啟後仍保留，
+並可由多個 worker process 共用。
+
+- Key：正規化問題 + 排序後的 Store 組合 + 模型名稱 + 系統提示雜湊
+- TTL 到期的項目視為未命中並刪除
+- 超過容量上限時依最後存取時間淘汰（LRU）
+- 命中 / 未命中次數記錄在資料庫中，跨 process 累計
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+
+def normalize_question(question: str) -> str:
+    """
+    正規化問題文字：全形轉半形（NFKC）、去除首尾空白、合併連續空白
+    """
+    text = unicodedata.normalize('NFKC', question or '')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def hash_text(text: str) -> str:
+    """回傳文字的 SHA-256 雜湊"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """
+    SQLite 查詢結果快取（TTL + LRU）
+    """
+
+    def __init__(self, path: str, ttl_seconds: int = 86400, max_entries: int = 5000):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_answers_last_access ON answers (last_access)'
+            )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # 每次操作建立新連線，避免跨 thread 共用連線
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(question: str, selected_stores: List[str], model: str, system_prompt: str,
+                 variant: str = '') -> str:
+        """
+        產生快取 key
+
+        variant 用於區分不同查詢模式（例如分別查詢各 Store）的結果
+        """
+        raw = json.dumps(
+            [
+                normalize_question(question),
+                sorted(selected_stores),
+                model,
+                hash_text(system_prompt),
+                variant,
+            ],
+            ensure_ascii=False,
+        )
+        return hash_text(raw)
+
+    def _incr(self, conn: sqlite3.Connection, name: str, amount: int = 1):
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount),
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        讀取快取，未命中或已過期回傳 None
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT payload, created_at FROM answers WHERE key = ?', (key,)
+            ).fetchone()
+
+            if row is None:
+                self._incr(conn, 'misses')
+                return None
+
+            payload, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                conn.execute('DELETE FROM answers WHERE key = ?', (key,))
+                self._incr(conn, 'misses')
+                return None
+
+            conn.execute('UPDATE answers SET last_access = ? WHERE key = ?', (now, key))
+            self._incr(conn, 'hits')
+
+        return json.loads(payload)
+
+    def contains(self, key: str) -> bool:
+        """
+        是否有未過期的快取（不更新存取時間與命中統計）
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT created_at FROM answers WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False
+        return not (self.ttl_seconds and time.time() - row[0] > self.ttl_seconds)
+
+    def set(self, key: str, result: Dict[str, Any]):
+        """
+        寫入快取，必要時淘汰最久未使用的項目
+        """
+        now = time.time()
+        payload = json.dumps(result, ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO answers (key, payload, created_at, last_access) '
+                'VALUES (?, ?, ?, ?)',
+                (key, payload, now, now),
+            )
+
+            count = conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    'DELETE FROM answers WHERE key IN ('
+                    'SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)',
+                    (overflow,),
+                )
+                self._incr(conn, 'evictions', overflow)
+
+    def clear(self):
+        """清空快取與統計"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM answers')
+            conn.execute('DELETE FROM counters')
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳快取統計：hits, misses, evictions, entries, hit_rate
+        """
+        with self._connect() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            entries = conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': counters.get('evictions', 0),
+            'entries': entries,
+            'hit_rate': hits / total if total else 0.0,
+        }
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+HTTP API（ASGI）
+
+提供與 Streamlit 介面相同的問答，供內部系統（法遵機器人、案件管理工具等）直接呼叫，
+不需嵌入或模擬 Streamlit 頁面：
+
+    uvicorn api:app --app-dir app --host 0.0.0.0 --port 8000
+
+- POST /v1/query：回傳 JSON；body 帶 "stream": true 或 Accept: text/event-stream 時以 SSE 串流
+- GET  /v1/stores：可查詢的資料來源
+- GET  /healthz、GET /metrics（Prometheus）
+
+查詢在 event loop 上以 client.aio 執行，等待 Gemini 時不佔用 thread，單一 process 可同時處理大量請求。
+Client、mapping 索引、查詢快取、重試策略與准入控制由 qa_core 提供，所有請求共用；
+准入控制依 X-Client-ID（未提供時為來源 IP）輪流放行。
+
+每個請求帶有 request ID（沿用 X-Request-ID，未提供時產生），回應標頭、JSON 與 metrics 記錄皆包含此 ID。
+
+SSE 事件：
+- meta：{"request_id", "stores", "mode"}
+- delta：{"text"} 部分答案文字
+- done：最終結果，格式同 JSON 回應（answer 為完整答案；無來源重試時可能與 delta 累積的內容不同）
+"""
+
+import hmac
+import json
+import re
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import anyio.to_thread
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+from admission import AdmissionRejected
+from gemini_backend import GEMINI_BACKEND
+from metadata_filter import filters_key, has_filters
+from qa_core import (
+    ADMISSION_ENABLED, ADMISSION_MAX_QUEUE, FANOUT_ENABLED, GEMINI_WARM_UP,
+    RETRY_MAX_ATTEMPTS, STORES, answer_cached, filter_unsupported_stores, get_admission_controller,
+    get_retry_policy, load_mappings, query_gemini_async, query_gemini_fanout_async, query_gemini_stream_async,
+    start_client_warm_up,
+)
+from settings import get_setting
+
+# 呼叫 API 需帶入的 token（逗號分隔，Authorization: Bearer 或 X-API-Key），未設定時不驗證
+API_KEYS = [key.strip() for key in get_setting('API_KEYS', '').split(',') if key.strip()]
+API_MAX_QUESTION_CHARS = get_setting('API_MAX_QUESTION_CHARS', 2000)
+
+# 沿用用戶端提供的 request ID 時的格式限制
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+
+class ApiError(Exception):
+    """請求格式錯誤、未授權等，回傳對應的 HTTP 狀態碼"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RequestIdMiddleware:
+    """
+    為每個請求設定 request ID（request.state.request_id），並加在回應標頭 X-Request-ID
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        scope.setdefault('state', {})['request_id'] = request_id
+
+        async def send_with_request_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-request-id', request_id.encode('latin-1'))
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+def get_api_key() -> str:
+    """Gemini API Key；回放模式不連網，不需要 API Key"""
+    api_key = get_setting('GEMINI_API_KEY', '')
+    if not api_key and GEMINI_BACKEND == 'replay':
+        api_key = 'replay'
+    return api_key
+
+
+def check_auth(request: Request):
+    """驗證 API token（未設定 API_KEYS 時不驗證）"""
+    if not API_KEYS:
+        return
+    token = request.headers.get('x-api-key', '')
+    authorization = request.headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        token = authorization[7:].strip()
+    if not any(hmac.compare_digest(token, key) for key in API_KEYS):
+        raise ApiError(401, '未授權：請提供有效的 API token')
+
+
+def client_id(request: Request) -> str:
+    """准入控制輪流放行的單位"""
+    return request.headers.get('x-client-id') or (request.client.host if request.client else '')
+
+
+def parse_filters(raw: Any) -> Optional[Dict[str, Any]]:
+    """
+    解析篩選條件: {"year_range": [2023, 2025], "sources": [...], "categories": [...]}
+    """
+    if raw is None:
+        return None
+    if not isinstance(raw, dict):
+        raise ApiError(400, 'filters 必須是物件')
+
+    filters: Dict[str, Any] = {'year_range': None, 'sources': [], 'categories': []}
+    year_range = raw.get('year_range')
+    if year_range is not None:
+        if not (isinstance(year_range, list) and len(year_range) == 2
+                and all(isinstance(year, int) for year in year_range)):
+            raise ApiError(400, 'filters.year_range 必須是 [起始年, 結束年]')
+        filters['year_range'] = (min(year_range), max(year_range))
+    for field in ('sources', 'categories'):
+        values = raw.get(field) or []
+        if not (isinstance(values, list) and all(isinstance(value, str) for value in values)):
+            raise ApiError(400, f'filters.{field} 必須是字串陣列')
+        filters[field] = values
+    return filters if has_filters(filters) else None
+
+
+def parse_query(body: Any) -> Dict[str, Any]:
+    """
+    驗證查詢請求
+
+    {"question": "...", "stores": [...], "filters": {...}, "fanout": false, "stream": false, "use_cache": true}
+    stores 省略時查詢全部資料來源
+    """
+    if not isinstance(body, dict):
+        raise ApiError(400, '請求內容必須是 JSON 物件')
+
+    question = body.get('question')
+    if not isinstance(question, str) or not question.strip():
+        raise ApiError(400, 'question 不可為空')
+    if len(question) > API_MAX_QUESTION_CHARS:
+        raise ApiError(400, f'question 超過 {API_MAX_QUESTION_CHARS} 字')
+
+    stores = body.get('stores') or list(STORES)
+    if not isinstance(stores, list) or not all(isinstance(store, str) for store in stores):
+        raise ApiError(400, 'stores 必須是字串陣列')
+    unknown = [store for store in stores if store not in STORES]
+    if unknown:
+        raise ApiError(400, f"未知的資料來源: {', '.join(unknown)}（可用: {', '.join(STORES)}）")
+    stores = [key for key in STORES if key in stores]
+
+    # 篩選條件需下推至 File Search 才會影響檢索與答案（見 qa_core.filter_unsupported_stores）
+    filters = parse_filters(body.get('filters'))
+    if filters is not None:
+        unsupported = filter_unsupported_stores(stores)
+        if unsupported:
+            raise ApiError(400, f"篩選條件無法套用至: {', '.join(unsupported)}"
+                                f"（未啟用 METADATA_FILTER_PUSHDOWN 或文件未帶 metadata）")
+
+    fanout = body.get('fanout', FANOUT_ENABLED)
+    return {
+        'question': question.strip(),
+        'stores': stores,
+        'filters': filters,
+        'fanout': bool(fanout) and len(stores) > 1,
+        'stream': bool(body.get('stream', False)),
+        'use_cache': bool(body.get('use_cache', True)),
+    }
+
+
+async def admit(request: Request, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    等待准入控制放行；被拒絕時回傳錯誤結果，放行時回傳 None
+
+    快取命中的查詢不呼叫 Gemini，直接放行。
+    """
+    if not ADMISSION_ENABLED:
+        return None
+    variant = ('fanout' if query['fanout'] else '') + filters_key(query['filters'])
+    if query['use_cache'] and answer_cached(query['question'], query['stores'], variant):
+        return None
+
+    try:
+        with metrics.span('admission') as tags:
+            tags['waited'] = await run_in_threadpool(
+                get_admission_controller().acquire,
+                client_id(request),
+                len(query['stores']) + 1 if query['fanout'] else 1,
+            )
+    except AdmissionRejected as e:
+        metrics.annotate(rejected=True)
+        return {'answer': str(e), 'sources': [], 'retryable': False, 'rejected': True, 'error': True}
+    return None
+
+
+async def run_query(query: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+    """以重試策略執行非串流查詢（分別查詢或一般）"""
+    query_fn = query_gemini_fanout_async if query['fanout'] else query_gemini_async
+    return await get_retry_policy().run_async(
+        lambda attempt: query_fn(
+            query['question'], query['stores'], api_key,
+            use_cache=query['use_cache'] and attempt == 0, filters=query['filters'],
+        )
+    )
+
+
+async def retry_without_sources(query: Dict[str, Any], api_key: str,
+                                result: Dict[str, Any]) -> Dict[str, Any]:
+    """串流結果沒有來源時，以重試策略重新查詢（不使用快取）"""
+    if result['sources'] or (result['error'] and not result.get('retryable')) or RETRY_MAX_ATTEMPTS <= 1:
+        return result
+
+    token = metrics.attempt_index.set(1)
+    try:
+        retried = await get_retry_policy().run_async(
+            lambda attempt: query_gemini_async(
+                query['question'], query['stores'], api_key, use_cache=False, filters=query['filters'],
+            ),
+            max_attempts=RETRY_MAX_ATTEMPTS - 1,
+        )
+    finally:
+        metrics.attempt_index.reset(token)
+
+    retried['attempts'] += 1
+    if retried['error'] and not result['error']:
+        return result
+    return retried
+
+
+def annotate_result(result: Dict[str, Any]):
+    metrics.annotate(
+        sources=len(result['sources']),
+        attempts=result.get('attempts', 1),
+        cached=bool(result.get('cached')),
+        error=bool(result.get('error')),
+        input_tokens=result.get('input_tokens'),
+        output_tokens=result.get('output_tokens'),
+    )
+
+
+def result_status(result: Dict[str, Any]) -> int:
+    """查詢結果對應的 HTTP 狀態碼"""
+    if not result.get('error'):
+        return 200
+    if result.get('rejected'):
+        return 429
+    return 503 if result.get('retryable') else 502
+
+
+def query_mode(query: Dict[str, Any], stream: bool) -> str:
+    if query['fanout']:
+        return 'fanout'
+    return 'stream' if stream else 'plain'
+
+
+def sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_events(request: Request, query: Dict[str, Any], api_key: str) -> AsyncIterator[str]:
+    """
+    SSE 事件：meta → delta…（分別查詢時沒有）→ done
+    """
+    request_id = request.state.request_id
+    mode = query_mode(query, stream=True)
+    with metrics.trace_query(query['stores'], filtered=has_filters(query['filters']),
+                             request_id=request_id, api=True, mode=mode):
+        yield sse('meta', {'request_id': request_id, 'stores': query['stores'], 'mode': mode})
+
+        result = await admit(request, query)
+        if result is None and query['fanout']:
+            result = await run_query(query, api_key)
+        elif result is None:
+            async for event in query_gemini_stream_async(
+                    query['question'], query['stores'], api_key,
+                    use_cache=query['use_cache'], filters=query['filters']):
+                if event['type'] == 'delta':
+                    yield sse('delta', {'text': event['text']})
+                elif event['type'] == 'done':
+                    result = event['result']
+            result = await retry_without_sources(query, api_key, result)
+
+        annotate_result(result)
+        yield sse('done', {'request_id': request_id, **result})
+
+
+async def query_endpoint(request: Request):
+    check_auth(request)
+    try:
+        body = await request.json()
+    except ValueError:
+        raise ApiError(400, '請求內容不是有效的 JSON')
+    query = parse_query(body)
+    api_key = request.app.state.api_key
+
+    if query['stream'] or 'text/event-stream' in request.headers.get('accept', ''):
+        return StreamingResponse(
+            stream_events(request, query, api_key),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+
+    request_id = request.state.request_id
+    with metrics.trace_query(query['stores'], filtered=has_filters(query['filters']),
+                             request_id=request_id, api=True, mode=query_mode(query, stream=False)):
+        result = await admit(request, query)
+        if result is None:
+            result = await run_query(query, api_key)
+        annotate_result(result)
+
+    headers = {'Retry-After': '5'} if result.get('rejected') else None
+    return JSONResponse({'request_id': request_id, **result}, status_code=result_status(result), headers=headers)
+
+
+async def stores_endpoint(request: Request):
+    check_auth(request)
+    stores: List[Dict[str, Any]] = [
+        {
+            'key': key,
+            'display_name': store['display_name'],
+            'description': store['description'],
+            'count': store['count'],
+        }
+        for key, store in STORES.items()
+    ]
+    return JSONResponse({'stores': stores})
+
+
+async def health_endpoint(request: Request):
+    return JSONResponse({'status': 'ok', 'backend': GEMINI_BACKEND})
+
+
+async def metrics_endpoint(request: Request):
+    return PlainTextResponse(metrics.registry.render_prometheus(), media_type='text/plain; version=0.0.4')
+
+
+async def api_error_handler(request: Request, exc: ApiError):
+    return JSONResponse(
+        {'error': str(exc), 'request_id': request.state.request_id},
+        status_code=exc.status_code,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """
+    啟動時暖機 Client 並載入 mapping 索引，所有請求共用
+    """
+    api_key = get_api_key()
+    if not api_key:
+        raise RuntimeError('請設定 GEMINI_API_KEY')
+    app.state.api_key = api_key
+
+    # 排隊中的請求在 thread 中等待准入，thread 數需大於等待佇列上限
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, ADMISSION_MAX_QUEUE + 10)
+
+    if GEMINI_WARM_UP:
+        start_client_warm_up(api_key)
+    await run_in_threadpool(load_mappings)
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route('/v1/query', query_endpoint, methods=['POST']),
+        Route('/v1/stores', stores_endpoint, methods=['GET']),
+        Route('/healthz', health_endpoint, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    middleware=[Middleware(RequestIdMiddleware)],
+    exception_handlers={ApiError: api_error_handler},
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=get_setting('API_HOST', '127.0.0.1'), port=get_setting('API_PORT', 8000))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+批次評估與延遲基準測試
+
+不經 Streamlit 介面，將問題集逐題送入 query_gemini()（含重試策略），
+用於每次部署前檢查延遲與無來源比例是否退步。
+
+問題集為 JSONL，每行: {"question": "...", "stores": ["penalties", ...]}
+（格式與 data/router_eval.jsonl 相同，stores 省略時查詢裁罰案件）
+
+    python app/batch_eval.py [--file data/router_eval.jsonl] [--concurrency 4] [--rate 2]
+    python app/batch_eval.py --save-baseline .cache/batch_baseline.json
+    python app/batch_eval.py --baseline .cache/batch_baseline.json
+
+與 baseline 比較時，p95 延遲或無來源比例超出容許範圍會以 exit code 1 結束。
+設定 GEMINI_BACKEND=replay 可在不連網的情況下量測 App 本身的吞吐量。
+"""
+
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import qa_core as qa
+import metrics
+from gemini_backend import GEMINI_BACKEND
+from settings import get_setting
+
+DEFAULT_QUESTIONS_PATH = Path(__file__).parent.parent / "data" / "router_eval.jsonl"
+DEFAULT_OUTPUT_PATH = Path(__file__).parent.parent / ".cache" / "batch_results.jsonl"
+
+
+class RateLimiter:
+    """
+    用戶端速率限制：相鄰兩次請求的開始時間至少間隔 1 / rate 秒
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_for = max(0.0, self._next_at - now)
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+def load_questions(path: Path, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """讀取問題集"""
+    rows = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            stores = [s for s in row.get('stores') or ['penalties'] if s in qa.STORES]
+            rows.append({'question': row['question'], 'stores': stores or ['penalties']})
+    return rows[:limit] if limit else rows
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近排名法百分位數"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p * len(values)) - 1))
+    return values[index]
+
+
+def run_one(row: Dict[str, Any], api_key: str, use_cache: bool) -> Dict[str, Any]:
+    """執行單一問題（含重試策略）"""
+    question, stores = row['question'], row['stores']
+    start_time = time.time()
+    with metrics.trace_query(stores, mode='batch'):
+        result = qa.get_retry_policy().run(
+            lambda attempt: qa.query_gemini(question, stores, api_key, use_cache=use_cache and attempt == 0)
+        )
+        metrics.annotate(
+            sources=len(result.get('sources', [])),
+            attempts=result.get('attempts', 1),
+            cached=bool(result.get('cached')),
+            error=bool(result.get('error')),
+            input_tokens=result.get('input_tokens'),
+            output_tokens=result.get('output_tokens'),
+        )
+    attempts = result.get('attempts', 1)
+    return {
+        'question': question,
+        'stores': stores,
+        'tier': qa.select_tier(question, stores)['tier'],
+        'answer': result.get('answer', ''),
+        'sources': [
+            {k: s.get(k) for k in ('filename', 'raw_id', 'date', 'score')}
+            for s in result.get('sources', [])
+        ],
+        'latency': time.time() - start_time,
+        'attempts': attempts,
+        'retries': max(0, attempts - 1),
+        'hedge_win': bool(result.get('hedge_win')),
+        'empty_sources': not result.get('sources'),
+        'cached': bool(result.get('cached')),
+        'error': bool(result.get('error')),
+        'input_tokens': result.get('input_tokens'),
+        'output_tokens': result.get('output_tokens'),
+    }
+
+
+def summarize_tiers(results: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """各模型分級的題數、延遲與平均 token 數（評估分級策略用）"""
+    tiers = {}
+    for tier in sorted({r['tier'] for r in results}):
+        rows = [r for r in results if r['tier'] == tier]
+        latencies = [r['latency'] for r in rows]
+        stats = {
+            'count': len(rows),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'empty_source_rate': sum(r['empty_sources'] for r in rows) / len(rows),
+        }
+        for key in ('input_tokens', 'output_tokens'):
+            counts = [r[key] for r in rows if r.get(key) is not None]
+            stats[key] = sum(counts) / len(counts) if counts else None
+        tiers[tier] = stats
+    return tiers
+
+
+def summarize(results: List[Dict[str, Any]], wall_time: float) -> Dict[str, Any]:
+    """計算延遲百分位數、吞吐量與無來源比例"""
+    latencies = [r['latency'] for r in results]
+    n = len(results) or 1
+    return {
+        'count': len(results),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'mean': sum(latencies) / n,
+        'throughput': len(results) / wall_time if wall_time > 0 else 0.0,
+        'empty_source_rate': sum(r['empty_sources'] for r in results) / n,
+        'error_rate': sum(r['error'] for r in results) / n,
+        'retry_rate': sum(r['retries'] > 0 for r in results) / n,
+        'wall_time': wall_time,
+        'tiers': summarize_tiers(results),
+    }
+
+
+def compare(summary: Dict[str, Any], baseline: Dict[str, Any],
+            max_latency_regression: float, max_empty_increase: float) -> List[str]:
+    """
+    與 baseline 比較，回傳退步項目說明（空 list 表示通過）
+    """
+    regressions = []
+    if baseline.get('p95') and summary['p95'] > baseline['p95'] * (1 + max_latency_regression):
+        regressions.append(
+            f"p95 延遲 {baseline['p95']:.2f} → {summary['p95']:.2f} 秒"
+            f"（容許 +{max_latency_regression:.0%}）"
+        )
+    if summary['empty_source_rate'] > baseline.get('empty_source_rate', 0.0) + max_empty_increase:
+        regressions.append(
+            f"無來源比例 {baseline.get('empty_source_rate', 0.0):.1%} → {summary['empty_source_rate']:.1%}"
+            f"（容許 +{max_empty_increase:.0%}）"
+        )
+    if summary['error_rate'] > baseline.get('error_rate', 0.0) + max_empty_increase:
+        regressions.append(f"錯誤比例 {baseline.get('error_rate', 0.0):.1%} → {summary['error_rate']:.1%}")
+    return regressions
+
+
+def print_summary(summary: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def delta(key: str, fmt: str) -> str:
+        if not baseline or key not in baseline:
+            return ''
+        return f"（baseline {format(baseline[key], fmt)}）"
+
+    print(f"題數: {summary['count']}　總耗時: {summary['wall_time']:.1f} 秒")
+    print(f"延遲: p50 {summary['p50']:.2f}{delta('p50', '.2f')}　"
+          f"p95 {summary['p95']:.2f}{delta('p95', '.2f')}　"
+          f"p99 {summary['p99']:.2f}{delta('p99', '.2f')} 秒")
+    print(f"吞吐量: {summary['throughput']:.2f} 題/秒{delta('throughput', '.2f')}")
+    print(f"無來源: {summary['empty_source_rate']:.1%}{delta('empty_source_rate', '.1%')}　"
+          f"錯誤: {summary['error_rate']:.1%}{delta('error_rate', '.1%')}　"
+          f"重試: {summary['retry_rate']:.1%}{delta('retry_rate', '.1%')}")
+    if len(summary.get('tiers', {})) > 1:
+        for tier, stats in summary['tiers'].items():
+            tokens = "".join(
+                f"　平均{label} {stats[key]:,.0f} tokens"
+                for key, label in (('input_tokens', '輸入'), ('output_tokens', '輸出'))
+                if stats[key] is not None
+            )
+            print(f"  {tier}: {stats['count']} 題　p50 {stats['p50']:.2f} / p95 {stats['p95']:.2f} 秒　"
+                  f"無來源 {stats['empty_source_rate']:.1%}{tokens}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='批次評估與延遲基準測試')
+    parser.add_argument('--file', default=str(DEFAULT_QUESTIONS_PATH), help='問題集 (JSONL)')
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT_PATH), help='逐題結果輸出 (JSONL)')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時執行的問題數')
+    parser.add_argument('--rate', type=float, default=2.0, help='每秒最多送出的問題數（0 表示不限制）')
+    parser.add_argument('--limit', type=int, default=None, help='只執行前 N 題')
+    parser.add_argument('--use-cache', action='store_true', help='允許使用查詢快取（預設略過快取以量測實際延遲）')
+    parser.add_argument('--baseline', default=None, help='與此 baseline 摘要比較')
+    parser.add_argument('--save-baseline', default=None, help='將本次摘要存為 baseline')
+    parser.add_argument('--max-latency-regression', type=float, default=0.2, help='p95 延遲容許增加比例')
+    parser.add_argument('--max-empty-increase', type=float, default=0.05, help='無來源 / 錯誤比例容許增加值')
+    args = parser.parse_args(argv)
+
+    api_key = get_setting('GEMINI_API_KEY', '')
+    if not api_key and GEMINI_BACKEND == 'replay':
+        api_key = 'replay'
+    if not api_key:
+        print("請設定 GEMINI_API_KEY", file=sys.stderr)
+        return 2
+
+    rows = load_questions(Path(args.file), args.limit)
+    limiter = RateLimiter(args.rate)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(rows)
+
+    def task(i: int) -> Dict[str, Any]:
+        limiter.acquire()
+        return run_one(rows[i], api_key, args.use_cache)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = {executor.submit(task, i): i for i in range(len(rows))}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            results[i] = future.result()
+            r = results[i]
+            status = "錯誤" if r['error'] else ("無來源" if r['empty_sources'] else f"{len(r['sources'])} 筆來源")
+            print(f"[{done}/{len(rows)}] {r['latency']:.2f} 秒　{status}　嘗試 {r['attempts']} 次　{r['question'][:30]}")
+    wall_time = time.time() - start_time
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+
+    summary = summarize(results, wall_time)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print()
+    print_summary(summary, baseline)
+    print(f"逐題結果: {output_path}")
+
+    if args.save_baseline:
+        Path(args.save_baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"已儲存 baseline: {args.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare(summary, baseline, args.max_latency_regression, args.max_empty_increase)
+        if regressions:
+            print("❌ 效能退步：")
+            for text in regressions:
+                print(f"  {text}")
+            return 1
+        print("✅ 未超出 baseline 容許範圍")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+多輪對話
+
+保留每個 session 的問答紀錄與先前檢索到的文件，追問時不必重打完整脈絡
+（例如「那第二個案例的罰鍰是多少？」）：
+
+- 對話脈絡（滾動摘要 + 最近幾輪問答）維持在 token 預算內，超出時較早的輪次壓縮進摘要
+- 追問指向上一輪的文件時（第 N 個、上述、該案…），直接以上一輪的來源段落回答，不重新檢索
+
+token 數以字元估算（CJK 字元約 1 token，其他字元約 4 字元 1 token），
+實際的輸入 token 數以 Gemini 回應的 usage_metadata 為準。
+"""
+
+import math
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+# CJK 文字與全形標點
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 指向上一輪結果的追問用語
+FOLLOWUP_PATTERN = re.compile(
+    r'第\s*[一二三四五六七八九十\d]+\s*(個|筆|件|則|家|案|項|點|條)'
+    r'|上述|前述|上面|剛才|剛剛|以上|其中|該案|此案|該函|該公告|該機構|該公司|該銀行'
+    r'|這個|這件|這些|這則|這家|那個|那件|那些|那則|那家'
+)
+
+# 摘要最多占 token 預算的比例，其餘保留給最近幾輪問答
+SUMMARY_SHARE = 0.4
+# 放入脈絡的每輪答案字數
+TURN_ANSWER_CHARS = 400
+# 摘要失敗時，每輪保留的答案字數
+FALLBACK_ANSWER_CHARS = 80
+# 沿用上一輪來源時，最多提供的文件數
+MAX_REUSED_SOURCES = 10
+
+
+def estimate_tokens(text: str) -> int:
+    """估算 token 數"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """
+    截斷文字至約 max_tokens 個 token
+
+    keep_end=True 時保留結尾（較新的內容）
+    """
+    if max_tokens <= 0:
+        return ''
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    # 二分搜尋可保留的最大字數
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[-mid:] if keep_end else text[:mid]
+        if estimate_tokens(part) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return '⋯' + text[-low:] if keep_end else text[:low] + '⋯'
+
+
+def format_turn(turn: Dict[str, Any], answer_chars: int = TURN_ANSWER_CHARS) -> str:
+    """將一輪問答格式化為脈絡文字"""
+    answer = turn['answer']
+    if len(answer) > answer_chars:
+        answer = answer[:answer_chars] + '⋯'
+    return f"問：{turn['question']}\n答：{answer}"
+
+
+def build_summary_prompt(summary: str, turns: List[Dict[str, Any]], max_chars: int) -> str:
+    """產生滾動摘要的提示"""
+    history = "\n\n".join(format_turn(turn) for turn in turns)
+    previous = f"【既有摘要】\n{summary}\n\n" if summary else ""
+    return (
+        f"{previous}【新增對話】\n{history}\n\n"
+        f"請將既有摘要與新增對話整合為 {max_chars} 字以內的繁體中文摘要，"
+        "保留使用者關心的主題，以及提到的機構名稱、金額、發文字號與日期。只輸出摘要內容。"
+    )
+
+
+class Conversation:
+    """
+    單一 session 的對話狀態
+    """
+
+    def __init__(self, token_budget: int = 2000):
+        self.token_budget = token_budget
+        self.summary = ''
+        self.turns: List[Dict[str, Any]] = []     # 尚未壓縮的最近幾輪
+        self.turn_count = 0
+        self.summarized_turns = 0
+        self.doc_ids: List[str] = []              # 對話中檢索過的文件（依首次出現順序）
+
+    @property
+    def summary_budget(self) -> int:
+        return int(self.token_budget * SUMMARY_SHARE)
+
+    def _full_context(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append(f"【先前對話摘要】\n{self.summary}")
+        if self.turns:
+            parts.append("【先前問答】\n" + "\n\n".join(format_turn(turn) for turn in self.turns))
+        return "\n\n".join(parts)
+
+    def context_text(self) -> str:
+        """
+        對話脈絡（摘要 + 最近幾輪問答），保證不超過 token 預算
+        """
+        return truncate_tokens(self._full_context(), self.token_budget, keep_end=True)
+
+    def context_tokens(self) -> int:
+        return estimate_tokens(self.context_text())
+
+    def build_prompt(self, question: str) -> str:
+        """將對話脈絡與目前問題組成查詢內容；第一輪直接回傳問題"""
+        context = self.context_text()
+        if not context:
+            return question
+        return f"{context}\n\n【目前問題】\n{question}"
+
+    def reusable_sources(self, question: str) -> List[Dict[str, Any]]:
+        """
+        追問指向上一輪的文件時，回傳上一輪的來源（可直接作為回答依據）；否則回傳空 list
+        """
+        if not self.turns or not FOLLOWUP_PATTERN.search(question):
+            return []
+        return [s for s in self.turns[-1]['sources'] if s.get('snippet')][:MAX_REUSED_SOURCES]
+
+    def add_turn(self, question: str, answer: str, sources: List[Dict[str, Any]],
+                 summarizer: Optional[Callable[[str], str]] = None) -> bool:
+        """
+        加入一輪問答，超出預算時壓縮較早的輪次
+
+        summarizer(prompt) 回傳摘要文字（例如呼叫 Gemini）；未提供或失敗時改用擷取式摘要。
+        回傳是否進行了壓縮。
+        """
+        self.turns.append({
+            'question': question,
+            'answer': answer,
+            'sources': [dict(s) for s in sources],
+        })
+        self.turn_count += 1
+        for source in sources:
+            doc_id = source.get('doc_id') or source.get('raw_id')
+            if doc_id and doc_id not in self.doc_ids:
+                self.doc_ids.append(doc_id)
+        return self.compact(summarizer)
+
+    def compact(self, summarizer: Optional[Callable[[str], str]] = None) -> bool:
+        """
+        脈絡超出預算時，將較早的輪次併入摘要（至少保留最近一輪）
+
+        最近幾輪保留到 token_budget - summary_budget 以內，摘要截斷至 summary_budget 以內。
+        """
+        if len(self.turns) <= 1 or estimate_tokens(self._full_context()) <= self.token_budget:
+            return False
+
+        turns_budget = self.token_budget - self.summary_budget
+        pending = []
+        while len(self.turns) > 1 and estimate_tokens(
+                "\n\n".join(format_turn(turn) for turn in self.turns)) > turns_budget:
+            pending.append(self.turns.pop(0))
+        if not pending:
+            return False
+
+        summary = None
+        if summarizer is not None:
+            try:
+                summary = summarizer(build_summary_prompt(self.summary, pending, self.summary_budget))
+            except Exception:
+                summary = None
+        if not summary:
+            summary = "\n".join(
+                filter(None, [self.summary] + [
+                    format_turn(turn, FALLBACK_ANSWER_CHARS).replace("\n", "；") for turn in pending
+                ])
+            )
+
+        self.summary = truncate_tokens(summary.strip(), self.summary_budget, keep_end=True)
+        self.summarized_turns += len(pending)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳：turns（總輪數）, summarized（已壓縮輪數）, context_tokens, budget, documents
+        """
+        return {
+            'turns': self.turn_count,
+            'summarized': self.summarized_turns,
+            'context_tokens': self.context_tokens(),
+            'budget': self.token_budget,
+            'documents': len(self.doc_ids),
+        }
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+"""
+語料同步
+
+比對本地文件與整合 mapping，只將新增或內容變更的文件上傳至 File Search Store，
+並將 data/ 下兩種世代的 mapping 整合為單一檔案 data/corpus_mapping.json：
+
+    {doc_id: {store, display_name, gemini_file_id, document_name, content_hash, uploaded_at,
+              date, source, category, original_url, ...}}
+
+文件目錄（--source）結構：
+    <source>/<store>/<doc_id>.txt | .md | .pdf     文件內容
+    <source>/<store>/<doc_id>.json                （選用）metadata：display_name、date、source、category、original_url…
+
+- 整合 mapping 不存在時由舊格式建立：同一文件在兩個世代的 gemini_file_id 不一致時，
+  以日期與 doc_id 相符的紀錄為準，都相符或都不相符時以 *_new（目前 App 使用的版本）為準
+- 變更判斷：紀錄有 content_hash 時比對雜湊；舊紀錄沒有雜湊時，檔案修改時間晚於 uploaded_at 才視為變更，
+  否則直接採用目前的雜湊（不重新上傳）
+- 以有上限的 thread pool 並行上傳，每完成一筆寫入 checkpoint；中斷後重新執行會略過已完成的文件
+- 完成後以暫存檔 + os.replace 原子替換整合 mapping，再刪除 checkpoint
+- mapping 中有、文件目錄中已不存在的文件（orphan）只回報，加上 --prune 才從 Store 刪除
+
+    python app/corpus_sync.py                                   # 只由舊格式建立整合 mapping
+    python app/corpus_sync.py --source /path/to/docs --dry-run  # 列出差異
+    python app/corpus_sync.py --source /path/to/docs [--workers 4] [--prune]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import qa_core as qa
+from gemini_client import get_client, is_timeout_error
+from mapping_index import DEFAULT_DATA_PATH, UNIFIED_MAPPING_FILE
+from retry_policy import RETRYABLE_STATUS_CODES
+from settings import get_setting
+
+DEFAULT_CHECKPOINT_PATH = Path(__file__).parent.parent / ".cache" / "corpus_sync.checkpoint.jsonl"
+
+STORE_IDS = {key: store['store_id'] for key, store in qa.STORES.items()}
+
+# 舊格式 mapping（相對於 data/）：(store, 舊世代, 新世代)
+LEGACY_FILES = [
+    ('law_interpretations', 'law_interpretations/law_interpretations_mapping.json',
+     'law_interpretations/gemini_id_mapping_new.json'),
+    ('announcements', 'announcements/announcements_mapping.json',
+     'announcements/gemini_id_mapping_new.json'),
+]
+
+MIME_TYPES = {
+    '.txt': 'text/plain',
+    '.md': 'text/markdown',
+    '.pdf': 'application/pdf',
+}
+
+# doc_id 中的日期：fsc_law_202511140001、fsc_unk_20251114_0001、fsc_pen_20250925_0001
+DOC_DATE_PATTERN = re.compile(r'_(\d{4})(\d{2})(\d{2})')
+
+# 上傳重試
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 2.0
+# orphan 超過該 Store 文件數的此比例時不執行 --prune（文件目錄可能不完整）
+MAX_PRUNE_RATIO = 0.1
+# 等待 File Search 匯入完成的上限（秒）
+IMPORT_TIMEOUT = get_setting('CORPUS_IMPORT_TIMEOUT', 300.0)
+
+
+def doc_date(doc_id: str) -> str:
+    """由 doc_id 取出日期（YYYY-MM-DD），取不到時回傳空字串"""
+    match = DOC_DATE_PATTERN.search(doc_id)
+    return '-'.join(match.groups()) if match else ''
+
+
+def load_json(path: Path) -> Dict[str, Any]:
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _choose_generation(doc_id: str, old: Dict[str, Any], new: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """兩個世代不一致時選出採用的紀錄，回傳 (採用, 捨棄)"""
+    expected = doc_date(doc_id)
+    if expected and old.get('date') == expected and new.get('date') != expected:
+        return old, new
+    return new, old
+
+
+def bootstrap_mapping(data_path: Path) -> Tuple[Dict[str, Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    由舊格式 mapping 建立整合 mapping
+
+    回傳: (mapping, conflicts)，conflicts 為兩個世代 gemini_file_id 不一致的文件
+    """
+    data_path = Path(data_path)
+    mapping: Dict[str, Dict[str, Any]] = {}
+    conflicts = []
+
+    # 裁罰案件：{files/xxx: doc_id} + （選用）file_mapping.json
+    penalties_info = load_json(data_path / 'penalties' / 'file_mapping.json')
+    for file_id, doc_id in load_json(data_path / 'penalties' / 'gemini_id_mapping.json').items():
+        record = dict(penalties_info.get(doc_id) or {})
+        record.update({'store': 'penalties', 'gemini_file_id': file_id})
+        record.setdefault('date', doc_date(doc_id))
+        mapping[doc_id] = record
+
+    # 法令函釋 / 重要公告：兩個世代
+    for store, old_path, new_path in LEGACY_FILES:
+        old_records = load_json(data_path / old_path)
+        new_records = load_json(data_path / new_path)
+        for doc_id in sorted(set(old_records) | set(new_records)):
+            old, new = old_records.get(doc_id), new_records.get(doc_id)
+            if old is None or new is None:
+                record = dict(old or new)
+            elif old.get('gemini_file_id') == new.get('gemini_file_id'):
+                record = {**old, **new}
+            else:
+                chosen, other = _choose_generation(doc_id, old, new)
+                record = dict(chosen)
+                # 另一個世代的欄位只在指向同一份內容（顯示名稱相同）時補上
+                if other.get('display_name') == chosen.get('display_name'):
+                    record = {**other, **chosen}
+                record['stale_file_ids'] = [other['gemini_file_id']]
+                conflicts.append({
+                    'doc_id': doc_id,
+                    'chosen': chosen.get('gemini_file_id'),
+                    'stale': other.get('gemini_file_id'),
+                })
+            record['store'] = store
+            mapping[doc_id] = record
+
+    return mapping, conflicts
+
+
+def file_hash(path: Path) -> str:
+    """檔案內容的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_source(source_path: Path, stores: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    掃描文件目錄
+
+    回傳: {doc_id: {'store', 'path', 'meta'}}
+    """
+    documents = {}
+    for store in stores:
+        store_dir = Path(source_path) / store
+        if not store_dir.is_dir():
+            continue
+        for path in sorted(store_dir.iterdir()):
+            if path.suffix.lower() not in MIME_TYPES:
+                continue
+            meta_path = path.with_suffix('.json')
+            documents[path.stem] = {
+                'store': store,
+                'path': path,
+                'meta': load_json(meta_path) if meta_path.exists() else {},
+            }
+    return documents
+
+
+def _uploaded_at(record: Dict[str, Any]) -> Optional[float]:
+    value = record.get('uploaded_at')
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def plan_sync(mapping: Dict[str, Dict[str, Any]], documents: Dict[str, Dict[str, Any]],
+              stores: List[str]) -> Dict[str, Any]:
+    """
+    比對整合 mapping 與文件目錄
+
+    回傳: {'new': [doc_id], 'changed': [doc_id], 'adopted': {doc_id: hash},
+           'unchanged': int, 'orphaned': [doc_id], 'hashes': {doc_id: hash}}
+    """
+    plan = {'new': [], 'changed': [], 'adopted': {}, 'unchanged': 0, 'orphaned': [], 'hashes': {}}
+
+    for doc_id, doc in documents.items():
+        content_hash = file_hash(doc['path'])
+        plan['hashes'][doc_id] = content_hash
+        record = mapping.get(doc_id)
+
+        if record is None or not record.get('gemini_file_id'):
+            plan['new'].append(doc_id)
+        elif record.get('store') != doc['store']:
+            plan['changed'].append(doc_id)
+        elif record.get('content_hash'):
+            if record['content_hash'] == content_hash:
+                plan['unchanged'] += 1
+            else:
+                plan['changed'].append(doc_id)
+        else:
+            # 舊紀錄沒有雜湊：檔案在上傳後修改過才視為變更
+            uploaded_at = _uploaded_at(record)
+            if uploaded_at is not None and doc['path'].stat().st_mtime > uploaded_at:
+                plan['changed'].append(doc_id)
+            else:
+                plan['adopted'][doc_id] = content_hash
+
+    # 只有已掃描的 Store 才判斷 orphan（未提供文件目錄的 Store 不受影響）
+    scanned = {doc['store'] for doc in documents.values()}
+    plan['orphaned'] = sorted(
+        doc_id for doc_id, record in mapping.items()
+        if record.get('store') in scanned and record.get('store') in stores and doc_id not in documents
+    )
+    return plan
+
+
+def build_custom_metadata(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    File Search 的 custom_metadata：doc_id、source、category、year（供 metadata_filter 使用）
+    """
+    metadata = [{'key': 'doc_id', 'string_value': record['doc_id']}]
+    for key in ('source', 'category'):
+        if record.get(key):
+            metadata.append({'key': key, 'string_value': record[key]})
+    year = (record.get('date') or '')[:4]
+    if year.isdigit():
+        metadata.append({'key': 'year', 'numeric_value': int(year)})
+    return metadata
+
+
+def with_retry(fn: Callable[[], Any]) -> Any:
+    """429 / 5xx / 逾時以指數退避 + jitter 重試"""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return fn()
+        except Exception as e:
+            retryable = is_timeout_error(e) or getattr(e, 'code', None) in RETRYABLE_STATUS_CODES
+            if not retryable or attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(BACKOFF_BASE ** attempt + random.uniform(0, 1))
+
+
+def upload_document(client, doc: Dict[str, Any], record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    上傳文件並匯入 File Search Store，等待匯入完成
+
+    回傳: {'gemini_file_id', 'document_name'}
+    """
+    path = doc['path']
+    uploaded = with_retry(lambda: client.files.upload(
+        file=str(path),
+        config={
+            'display_name': record.get('display_name') or record['doc_id'],
+            'mime_type': MIME_TYPES[path.suffix.lower()],
+        },
+    ))
+
+    operation = with_retry(lambda: client.file_search_stores.import_file(
+        file_search_store_name=STORE_IDS[doc['store']],
+        file_name=uploaded.name,
+        config={'custom_metadata': build_custom_metadata(record)},
+    ))
+
+    deadline = time.time() + IMPORT_TIMEOUT
+    while not operation.done:
+        if time.time() > deadline:
+            raise TimeoutError(f"匯入逾時: {record['doc_id']}")
+        time.sleep(1.0)
+        operation = with_retry(lambda: client.operations.get(operation))
+    if operation.error:
+        raise RuntimeError(f"匯入失敗: {operation.error}")
+
+    response = operation.response
+    return {
+        'gemini_file_id': uploaded.name,
+        'document_name': getattr(response, 'document_name', None) or '',
+    }
+
+
+def list_store_documents(client, store: str) -> Dict[str, str]:
+    """
+    列出 Store 中的文件：{doc_id 或 display_name: document name}
+
+    舊紀錄沒有 document_name，刪除時以此對應
+    """
+    documents = {}
+    for document in client.file_search_stores.documents.list(parent=STORE_IDS[store]):
+        documents[document.display_name or ''] = document.name
+        for item in document.custom_metadata or []:
+            if item.key == 'doc_id' and item.string_value:
+                documents[item.string_value] = document.name
+    return documents
+
+
+def delete_document(client, record: Dict[str, Any], store_documents: Dict[str, str],
+                    protected: Optional[set] = None) -> bool:
+    """
+    從 Store 刪除文件（含已上傳的檔案）；找不到對應文件時回傳 False
+
+    protected 為本次新匯入的文件，同一 doc_id 的新版本不會被誤刪
+    """
+    name = (record.get('document_name')
+            or store_documents.get(record['doc_id'])
+            or store_documents.get(record.get('display_name') or ''))
+    if not name or name in (protected or set()):
+        return False
+    with_retry(lambda: client.file_search_stores.documents.delete(name=name, config={'force': True}))
+    if record.get('gemini_file_id'):
+        try:
+            client.files.delete(name=record['gemini_file_id'])
+        except Exception:
+            pass    # 上傳的檔案 48 小時後自動刪除
+    return True
+
+
+class Checkpoint:
+    """
+    已完成上傳的文件紀錄（JSONL，逐筆附加並 fsync），中斷後重新執行時略過
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        if not self.path.exists():
+            return records
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue    # 中斷時寫到一半的最後一行
+                records[row['doc_id']] = row['record']
+        return records
+
+    def append(self, doc_id: str, record: Dict[str, Any]):
+        line = json.dumps({'doc_id': doc_id, 'record': record}, ensure_ascii=False)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+def write_mapping(path: Path, mapping: Dict[str, Dict[str, Any]]):
+    """先寫入暫存檔再以 os.replace 原子替換"""
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(mapping.items())), f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def build_record(doc_id: str, doc: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """合併既有紀錄與文件目錄中的 metadata"""
+    record = dict(previous or {})
+    record.pop('stale_file_ids', None)
+    record.update(doc['meta'])
+    record['store'] = doc['store']
+    record['doc_id'] = doc_id
+    record.setdefault('date', doc_date(doc_id))
+    return record
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='同步文件與 File Search Store，並整合 mapping')
+    parser.add_argument('--data', default=str(DEFAULT_DATA_PATH), help='資料目錄（mapping JSON）')
+    parser.add_argument('--source', default=None, help='文件目錄（<store>/<doc_id>.txt|.md|.pdf）；省略時只整合 mapping')
+    parser.add_argument('--stores', nargs='+', default=list(STORE_IDS), choices=list(STORE_IDS), help='要同步的 Store')
+    parser.add_argument('--workers', type=int, default=4, help='同時上傳的文件數')
+    parser.add_argument('--checkpoint', default=str(DEFAULT_CHECKPOINT_PATH), help='checkpoint 路徑')
+    parser.add_argument('--dry-run', action='store_true', help='只列出差異，不上傳')
+    parser.add_argument('--prune', action='store_true', help='從 Store 刪除文件目錄中已不存在的文件')
+    parser.add_argument('--force-prune', action='store_true', help=f'orphan 超過 {MAX_PRUNE_RATIO:.0%} 時仍執行 --prune')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+    data_path = Path(args.data)
+    output_path = data_path / UNIFIED_MAPPING_FILE
+
+    if output_path.exists():
+        mapping = load_json(output_path)
+    else:
+        mapping, conflicts = bootstrap_mapping(data_path)
+        print(f"由舊格式建立整合 mapping：{len(mapping):,} 筆，兩個世代不一致 {len(conflicts):,} 筆")
+        for conflict in conflicts[:10]:
+            print(f"  {conflict['doc_id']}: 採用 {conflict['chosen']}，捨棄 {conflict['stale']}")
+    for doc_id, record in mapping.items():
+        record['doc_id'] = doc_id
+
+    if not args.source:
+        if not args.dry_run:
+            write_mapping(output_path, mapping)
+            print(f"✅ 已寫入 {output_path}")
+        return 0
+
+    documents = scan_source(Path(args.source), args.stores)
+    plan = plan_sync(mapping, documents, args.stores)
+    print(f"文件 {len(documents):,} 筆：新增 {len(plan['new']):,}　變更 {len(plan['changed']):,}　"
+          f"未變更 {plan['unchanged'] + len(plan['adopted']):,}（補上雜湊 {len(plan['adopted']):,}）　"
+          f"orphan {len(plan['orphaned']):,}")
+
+    if args.dry_run:
+        for label, doc_ids in (('新增', plan['new']), ('變更', plan['changed']), ('orphan', plan['orphaned'])):
+            for doc_id in doc_ids[:20]:
+                print(f"  [{label}] {doc_id}")
+        return 0
+
+    if args.prune and plan['orphaned'] and not args.force_prune:
+        scanned = {mapping[doc_id]['store'] for doc_id in plan['orphaned']}
+        total = sum(1 for record in mapping.values() if record.get('store') in scanned)
+        if len(plan['orphaned']) > total * MAX_PRUNE_RATIO:
+            print(f"⚠️ orphan {len(plan['orphaned']):,} 筆超過文件數的 {MAX_PRUNE_RATIO:.0%}，"
+                  f"文件目錄可能不完整，略過 --prune（確認無誤請加上 --force-prune）")
+            args.prune = False
+
+    for doc_id, content_hash in plan['adopted'].items():
+        mapping[doc_id]['content_hash'] = content_hash
+
+    checkpoint = Checkpoint(Path(args.checkpoint))
+    completed = checkpoint.load()
+    pending = [doc_id for doc_id in plan['new'] + plan['changed'] if doc_id not in completed]
+    if completed:
+        print(f"由 checkpoint 接續：已完成 {len(completed):,} 筆")
+
+    api_key = get_setting('GEMINI_API_KEY', '')
+    if (pending or args.prune) and not api_key:
+        print("請設定 GEMINI_API_KEY", file=sys.stderr)
+        return 2
+    client = get_client(api_key) if pending or args.prune else None
+
+    # 內容變更的文件：新版本匯入成功後才刪除舊版本
+    replaced: Dict[str, Dict[str, Any]] = {
+        doc_id: mapping[doc_id] for doc_id in plan['changed'] if doc_id in mapping
+    }
+
+    def task(doc_id: str) -> Dict[str, Any]:
+        doc = documents[doc_id]
+        record = build_record(doc_id, doc, mapping.get(doc_id))
+        record.update(upload_document(client, doc, record))
+        record['content_hash'] = plan['hashes'][doc_id]
+        record['uploaded_at'] = datetime.now().isoformat()
+        checkpoint.append(doc_id, record)
+        return record
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(task, doc_id): doc_id for doc_id in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            doc_id = futures[future]
+            try:
+                completed[doc_id] = future.result()
+                print(f"[{done}/{len(pending)}] ✅ {doc_id}")
+            except Exception as e:
+                failures.append(doc_id)
+                print(f"[{done}/{len(pending)}] ❌ {doc_id}: {e}")
+
+    mapping.update(completed)
+
+    # 刪除舊版本與 orphan
+    to_delete = [(doc_id, replaced[doc_id]) for doc_id in replaced if doc_id in completed]
+    if args.prune:
+        to_delete += [(doc_id, mapping[doc_id]) for doc_id in plan['orphaned']]
+    store_documents: Dict[str, Dict[str, str]] = {}
+    protected = {record.get('document_name') for record in completed.values()} - {''}
+    for doc_id, record in to_delete:
+        store = record.get('store')
+        if not record.get('document_name') and store not in store_documents:
+            store_documents[store] = list_store_documents(client, store)
+        try:
+            if not delete_document(client, record, store_documents.get(store, {}), protected):
+                print(f"  ⚠️ Store 中找不到 {doc_id} 的舊文件")
+        except Exception as e:
+            print(f"  ⚠️ 刪除 {doc_id} 失敗: {e}")
+    if args.prune:
+        for doc_id in plan['orphaned']:
+            mapping.pop(doc_id, None)
+
+    write_mapping(output_path, mapping)
+    if failures:
+        print(f"❌ {len(failures):,} 筆失敗，已完成的部分保留在 checkpoint，重新執行會接續")
+        return 1
+
+    checkpoint.clear()
+    print(f"✅ 已寫入 {output_path}（{len(mapping):,} 筆），耗時 {time.time() - start_time:.1f} 秒")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+發文字號 / 法規名稱本地查詢
+
+以 law_interpretations_mapping.json 的 law_name、document_number，
+以及 announcements_mapping.json 的 announcement_number 建立記憶體內反向索引：
+
+- 發文字號：取「字第」後的數字完全比對（容忍空白、前綴日期等格式差異）
+- 法規名稱：CJK 字元 bigram 比對，依法規名稱 bigram 的覆蓋率排序
+
+純查詢型問題（只有發文字號 / 法規名稱，或帶有「查詢」「全文」等明確的查詢用語，
+例如「查詢 金管保壽字第11404942301號」）可直接回傳相符文件，不必呼叫 Gemini；
+其他問題（例如「洗錢防制法的罰則」「證券交易法是什麼」）可將相符文件作為提示附加在查詢中。
+"""
+
+import json
+import re
+import unicodedata
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+# 發文字號：金管保壽字第11404942301號
+DOC_NUMBER_PATTERN = re.compile(r'字第\s*(\d{6,})\s*號?')
+# 內文中以「」標示的法規名稱
+QUOTED_NAME_PATTERN = re.compile(r'「([^「」]{4,40})」')
+# 法規名稱結尾
+LAW_NAME_SUFFIXES = ('法', '條例', '規則', '準則', '細則', '標準', '要點',
+                     '注意事項', '規範', '須知', '原則', '程序')
+
+# 明確的查詢用語與不影響語意的贅字；移除相符字串與這些用語後沒有剩餘文字才視為純查詢
+# （「是什麼」「罰則」等詢問內容的用語不在此列，這類問題仍需由 Gemini 回答）
+LOOKUP_PHRASES = ['發文字號', '文號', '全文', '原文', '查詢', '連結', '網址',
+                  '請問', '我要', '幫我', '一下', '的']
+
+# 文件類別中文名稱
+CATEGORY_LABELS = {
+    'law_amendment': '法規修正',
+    'law_enactment': '法規訂定',
+    'law_repeal': '法規廢止',
+    'law_clarification': '法令解釋',
+    'law_publication': '法規發布',
+    'law_notice': '法規公告',
+    'law_interpretation_decree': '解釋令',
+    'law_approval': '核定',
+    'law_adjustment': '調整',
+    'law_other': '其他函釋',
+    'ann_amendment': '修正公告',
+    'ann_regulation': '法規公告',
+    'ann_enactment': '訂定公告',
+    'ann_designation': '指定公告',
+    'penalty': '裁罰',
+}
+
+SOURCE_FILES = [
+    ('law_interpretations', 'law_interpretations/law_interpretations_mapping.json'),
+    ('announcements', 'announcements/announcements_mapping.json'),
+]
+
+# corpus_sync 產生的整合 mapping，存在時取代上述檔案
+UNIFIED_MAPPING_FILE = 'corpus_mapping.json'
+
+
+def lookup_fingerprint(data_path: Path) -> str:
+    """以來源 JSON 的修改時間與大小產生 fingerprint"""
+    parts = []
+    for rel_path in [rel_path for _, rel_path in SOURCE_FILES] + [UNIFIED_MAPPING_FILE]:
+        path = Path(data_path) / rel_path
+        if path.exists():
+            stat = path.stat()
+            parts.append(f"{rel_path}:{stat.st_mtime_ns}:{stat.st_size}")
+    return '|'.join(parts)
+
+
+def normalize_text(text: str) -> str:
+    """NFKC 正規化並移除所有空白"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or ''))
+
+
+def cjk_bigrams(text: str) -> Set[str]:
+    """取得字元 bigram（忽略標點與空白）"""
+    chars = re.sub(r'[^\w]', '', normalize_text(text))
+    return {chars[i:i + 2] for i in range(len(chars) - 1)}
+
+
+def extract_doc_numbers(text: str) -> List[str]:
+    """從文字中取出發文字號的數字部分"""
+    return DOC_NUMBER_PATTERN.findall(normalize_text(text))
+
+
+def extract_law_names(text: str) -> List[str]:
+    """
+    取出法規名稱
+
+    欄位本身是乾淨的法規名稱時直接使用，否則取其中以「」標示的名稱
+    """
+    text = normalize_text(text)
+    if not text:
+        return []
+    if len(text) <= 40 and '字第' not in text and text.endswith(LAW_NAME_SUFFIXES):
+        return [text]
+    return [name for name in QUOTED_NAME_PATTERN.findall(text) if name.endswith(LAW_NAME_SUFFIXES)]
+
+
+class DocLookup:
+    """
+    發文字號 / 法規名稱反向索引
+    """
+
+    def __init__(self, min_coverage: float = 0.8, max_results: int = 10):
+        self.min_coverage = min_coverage
+        self.max_results = max_results
+
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.by_number: Dict[str, List[str]] = defaultdict(list)      # 數字 → doc_ids
+        self.by_law_name: Dict[str, List[str]] = defaultdict(list)    # 法規名稱 → doc_ids
+        self.bigram_index: Dict[str, Set[str]] = defaultdict(set)     # bigram → 法規名稱
+        self.law_name_bigrams: Dict[str, Set[str]] = {}
+
+    @classmethod
+    def from_data_path(cls, data_path: Path, **kwargs) -> 'DocLookup':
+        """
+        從 data/ 下的 mapping JSON 建立索引
+        """
+        lookup = cls(**kwargs)
+
+        unified = Path(data_path) / UNIFIED_MAPPING_FILE
+        if unified.exists():
+            with open(unified, 'r', encoding='utf-8') as f:
+                for doc_id, info in json.load(f).items():
+                    if info.get('store') in ('law_interpretations', 'announcements'):
+                        lookup.add(doc_id, info['store'], info)
+            return lookup
+
+        for store, rel_path in SOURCE_FILES:
+            path = Path(data_path) / rel_path
+            if not path.exists():
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for doc_id, info in json.load(f).items():
+                    lookup.add(doc_id, store, info)
+        return lookup
+
+    def add(self, doc_id: str, store: str, info: Dict[str, Any]):
+        """加入一筆文件"""
+        number_text = info.get('document_number') or info.get('announcement_number') or ''
+        numbers = extract_doc_numbers(number_text)
+        law_names = extract_law_names(info.get('law_name') or '') or extract_law_names(number_text)
+
+        if not numbers and not law_names:
+            return
+
+        number_match = DOC_NUMBER_PATTERN.search(normalize_text(number_text))
+        self.documents[doc_id] = {
+            'doc_id': doc_id,
+            'store': store,
+            'law_name': law_names[0] if law_names else '',
+            'document_number': self._clean_number(number_text, number_match),
+            'date': info.get('date') or '',
+            'source': info.get('source') or '',
+            'category': info.get('category') or '',
+            'original_url': info.get('original_url') or '',
+        }
+
+        for number in numbers:
+            self.by_number[number].append(doc_id)
+
+        for name in law_names:
+            if name not in self.law_name_bigrams:
+                bigrams = cjk_bigrams(name)
+                self.law_name_bigrams[name] = bigrams
+                for bigram in bigrams:
+                    self.bigram_index[bigram].add(name)
+            self.by_law_name[name].append(doc_id)
+
+    @staticmethod
+    def _clean_number(number_text: str, match: Optional[re.Match]) -> str:
+        """取出可顯示的發文字號（例如 金管保壽字第11404942301號）"""
+        text = normalize_text(number_text)
+        if match is None:
+            return ''
+        prefix = re.findall(r'[一-鿿()（）]{0,8}$', text[:match.start()])
+        prefix = re.sub(r'^.*日', '', prefix[0]).lstrip('(（') if prefix else ''
+        return f"{prefix}字第{match.group(1)}號"
+
+    def _sorted_docs(self, doc_ids: List[str], law_name: str = '') -> List[Dict[str, Any]]:
+        """依日期由新到舊排序；依法規名稱比對時，顯示的法規名稱以相符名稱為準"""
+        docs = {doc_id: dict(self.documents[doc_id]) for doc_id in doc_ids}
+        if law_name:
+            for doc in docs.values():
+                doc['law_name'] = law_name
+        return sorted(docs.values(), key=lambda d: d['date'], reverse=True)[:self.max_results]
+
+    def _is_pure(self, question: str, matched: List[str]) -> bool:
+        """移除相符字串與查詢用語後沒有剩餘文字（問題只有發文字號 / 法規名稱與查詢用語）"""
+        text = normalize_text(question)
+        for part in sorted(matched, key=len, reverse=True) + LOOKUP_PHRASES:
+            text = text.replace(part, '')
+        return not re.sub(r'[^\w]', '', text)
+
+    def match(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        比對問題中的發文字號或法規名稱
+
+        回傳: {'kind': 'document_number' | 'law_name', 'matches': [...], 'terms': [...],
+               'pure': 是否為純查詢, 'coverage': 法規名稱覆蓋率}
+        沒有相符文件時回傳 None
+        """
+        text = normalize_text(question)
+
+        # 發文字號完全比對
+        numbers = [n for n in DOC_NUMBER_PATTERN.findall(text) if n in self.by_number]
+        if numbers:
+            doc_ids = [doc_id for n in numbers for doc_id in self.by_number[n]]
+            matched_text = [m.group(0) for m in re.finditer(r'[一-鿿()（）]*' + DOC_NUMBER_PATTERN.pattern, text)]
+            return {
+                'kind': 'document_number',
+                'matches': self._sorted_docs(doc_ids),
+                'terms': numbers,
+                'pure': self._is_pure(question, matched_text),
+                'coverage': 1.0,
+            }
+
+        # 法規名稱 bigram 比對
+        question_bigrams = cjk_bigrams(text)
+        candidates = set()
+        for bigram in question_bigrams:
+            candidates |= self.bigram_index.get(bigram, set())
+
+        best_names = []
+        best_key = (0.0, 0)
+        for name in candidates:
+            name_bigrams = self.law_name_bigrams[name]
+            coverage = len(name_bigrams & question_bigrams) / len(name_bigrams) if name_bigrams else 0.0
+            key = (coverage, len(name))
+            if coverage < self.min_coverage:
+                continue
+            if key > best_key:
+                best_key, best_names = key, [name]
+            elif key == best_key:
+                best_names.append(name)
+
+        if not best_names:
+            return None
+
+        coverage = best_key[0]
+        exact = [name for name in best_names if name in text]
+        doc_ids = [doc_id for name in best_names for doc_id in self.by_law_name[name]]
+        return {
+            'kind': 'law_name',
+            'matches': self._sorted_docs(doc_ids, law_name=best_names[0] if len(best_names) == 1 else ''),
+            'terms': best_names,
+            'pure': bool(exact) and self._is_pure(question, exact),
+            'coverage': coverage,
+        }
+
+
+def build_lookup_hint(matches: List[Dict[str, Any]], limit: int = 5) -> str:
+    """
+    將相符文件組成附加在問題後的提示
+    """
+    lines = []
+    for doc in matches[:limit]:
+        parts = [doc['date'], doc['law_name'], doc['document_number']]
+        lines.append("- " + " ".join(p for p in parts if p))
+    return "\n\n（可能相關的文件：\n" + "\n".join(lines) + "）"
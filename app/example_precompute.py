@@ -0,0 +1,165 @@
+"""
+範例問題預先計算
+
+在背景 thread 預先查詢每個範例問題在每種 Store 組合下的答案與來源，
+使用者點選範例時直接顯示，不需等待 Gemini。
+
+- 啟動時執行一次，之後每隔 refresh_interval 秒重新計算
+- 每輪最多使用 budget 次上游呼叫（含重試），優先計算尚未計算或最舊的項目，
+  預算不足時其餘項目留待下一輪
+- 重新計算失敗時保留先前的結果；超過 max_age 的結果不再使用
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ExamplePrecomputer:
+    """
+    範例問題 × Store 組合的預先計算結果與背景排程（thread-safe，每個 process 一個）
+    """
+
+    def __init__(self, questions: Sequence[str], combinations: Sequence[Tuple[str, ...]],
+                 compute: Callable[[str, List[str]], Dict[str, Any]],
+                 refresh_interval: float = 21600.0, budget: int = 60, max_age: Optional[float] = None):
+        """
+        compute(question, stores) 回傳 query_gemini() 格式的結果（可含 attempts）
+        max_age 未指定時為 refresh_interval 的 3 倍
+        """
+        self.questions = list(questions)
+        self.combinations = [tuple(combo) for combo in combinations]
+        self.compute = compute
+        self.refresh_interval = refresh_interval
+        self.budget = budget
+        self.max_age = max_age if max_age is not None else refresh_interval * 3
+
+        # (question, combo) → {'result', 'computed_at', 'error', 'duration'}
+        self._entries: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._counters = {
+            'runs': 0,
+            'calls': 0,
+            'failures': 0,
+            'served': 0,
+        }
+        self._last_run_at: Optional[float] = None
+
+    @staticmethod
+    def _key(question: str, stores: Sequence[str]) -> Tuple[str, Tuple[str, ...]]:
+        """與勾選順序無關的 key"""
+        return question.strip(), tuple(sorted(stores))
+
+    def start(self) -> threading.Thread:
+        """啟動背景排程（只啟動一次）"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='example-precompute', daemon=True)
+                self._thread.start()
+            return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning("範例預先計算失敗: %s", e)
+            self._stop.wait(self.refresh_interval)
+
+    def _pending(self) -> List[Tuple[str, Tuple[str, ...]]]:
+        """依計算時間排序（尚未計算的最優先）"""
+        items = [(question, combo) for question in self.questions for combo in self.combinations]
+        with self._lock:
+            computed_at = {key: entry['computed_at'] for key, entry in self._entries.items()
+                           if entry.get('result') is not None}
+        return sorted(items, key=lambda item: computed_at.get(self._key(*item), 0.0))
+
+    def run_once(self) -> int:
+        """
+        執行一輪預先計算，回傳使用的上游呼叫次數
+        """
+        calls = 0
+        for question, combo in self._pending():
+            if calls >= self.budget or self._stop.is_set():
+                break
+
+            start = time.time()
+            try:
+                result = self.compute(question, list(combo))
+            except Exception as e:
+                result = {'answer': str(e), 'sources': [], 'error': True}
+            calls += max(1, result.get('attempts', 1))
+
+            with self._lock:
+                entry = self._entries.setdefault(self._key(question, combo), {'result': None, 'computed_at': 0.0})
+                entry['duration'] = time.time() - start
+                if result.get('error') or not result.get('sources'):
+                    # 保留先前的結果，下一輪再試
+                    entry['error'] = result.get('answer') if result.get('error') else '未找到參考來源'
+                    self._counters['failures'] += 1
+                else:
+                    entry.update(result=result, computed_at=time.time(), error=None)
+
+        with self._lock:
+            self._counters['runs'] += 1
+            self._counters['calls'] += calls
+            self._last_run_at = time.time()
+        return calls
+
+    def get(self, question: str, stores: Sequence[str]) -> Optional[Dict[str, Any]]:
+        """
+        取得預先計算的結果；尚未計算或已超過 max_age 時回傳 None
+
+        回傳的結果另含 precomputed_at（計算時間）
+        """
+        key = self._key(question, stores)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['result'] is None:
+                return None
+            if time.time() - entry['computed_at'] > self.max_age:
+                return None
+            self._counters['served'] += 1
+            return dict(entry['result'], precomputed_at=entry['computed_at'])
+
+    def freshness(self) -> List[Dict[str, Any]]:
+        """
+        各項目的狀態：question, stores, computed_at, age（秒，尚未計算為 None）, error
+        """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for question in self.questions:
+                for combo in self.combinations:
+                    entry = self._entries.get(self._key(question, combo)) or {}
+                    computed_at = entry.get('computed_at') if entry.get('result') is not None else None
+                    rows.append({
+                        'question': question,
+                        'stores': list(combo),
+                        'computed_at': computed_at,
+                        'age': now - computed_at if computed_at else None,
+                        'error': entry.get('error'),
+                    })
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳統計：total, ready, oldest_age, runs, calls, failures, served, last_run_at
+        """
+        rows = self.freshness()
+        ages = [row['age'] for row in rows if row['age'] is not None and row['age'] <= self.max_age]
+        with self._lock:
+            stats = dict(self._counters)
+            stats['last_run_at'] = self._last_run_at
+        stats['total'] = len(rows)
+        stats['ready'] = len(ages)
+        stats['oldest_age'] = max(ages) if ages else None
+        return stats
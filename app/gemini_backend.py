@@ -0,0 +1,395 @@
+"""
+Gemini 後端切換（live / record / replay）
+
+以 GEMINI_BACKEND 設定選擇 get_client() 回傳的 Client：
+- live:   直接呼叫 Gemini API
+- record: 呼叫 Gemini API，並將請求 / 回應（含 grounding_chunks）存入 cassette 目錄
+- replay: 不連網，回放 cassette 中的回應；找不到時產生合成回應
+          （可設定延遲分佈與錯誤率，用於量測 App 本身的負擔與吞吐量）
+
+cassette 以「模型 + 問題 + GenerateContentConfig」的 hash 為檔名，
+每個檔案記錄非串流回應（response）及 / 或串流 chunk（stream）。
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from settings import get_setting
+
+BACKENDS = ('live', 'record', 'replay')
+
+GEMINI_BACKEND = get_setting('GEMINI_BACKEND', 'live')
+GEMINI_CASSETTE_DIR = get_setting(
+    'GEMINI_CASSETTE_DIR',
+    str(Path(__file__).parent.parent / '.cache' / 'cassettes'),
+)
+# 回放延遲：對數常態分佈（中位數、sigma；sigma 為 0 時固定延遲）
+REPLAY_LATENCY_MEDIAN = get_setting('REPLAY_LATENCY_MEDIAN', 1.0)   # 秒
+REPLAY_LATENCY_SIGMA = get_setting('REPLAY_LATENCY_SIGMA', 0.5)
+REPLAY_ERROR_RATE = get_setting('REPLAY_ERROR_RATE', 0.0)           # 回傳 429 / 503 的比例
+REPLAY_SYNTHETIC = get_setting('REPLAY_SYNTHETIC', True)            # cassette 找不到時產生合成回應
+REPLAY_SEED = get_setting('REPLAY_SEED', 0)
+
+# 合成回應的參考來源數
+SYNTHETIC_SOURCES = 5
+
+
+def request_key(model: str, contents: Any, config: Any = None) -> str:
+    """以模型、問題與 config 產生 cassette key"""
+    payload = {
+        'model': model,
+        'contents': contents if isinstance(contents, str) else _dump(contents),
+        'config': _dump(config) if config is not None else None,
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _dump(obj: Any) -> Any:
+    """pydantic 物件 → JSON 相容的 dict"""
+    if hasattr(obj, 'model_dump'):
+        return obj.model_dump(mode='json', exclude_none=True)
+    if isinstance(obj, list):
+        return [_dump(item) for item in obj]
+    return obj
+
+
+def _to_response(data: Dict[str, Any]):
+    from google.genai import types
+    return types.GenerateContentResponse.model_validate(data)
+
+
+def _response_data(text: str, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    candidate: Dict[str, Any] = {'content': {'parts': [{'text': text}], 'role': 'model'}}
+    if chunks:
+        candidate['grounding_metadata'] = {'grounding_chunks': chunks}
+    return {'candidates': [candidate]}
+
+
+def _response_text(data: Dict[str, Any]) -> str:
+    try:
+        parts = data['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        return ''
+    return ''.join(part.get('text', '') for part in parts)
+
+
+def _grounding_chunks(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        return data['candidates'][0]['grounding_metadata']['grounding_chunks'] or []
+    except (KeyError, IndexError, TypeError):
+        return []
+
+
+class Cassette:
+    """
+    cassette 目錄（每個請求一個 JSON 檔）
+    """
+
+    def __init__(self, path: str = GEMINI_CASSETTE_DIR):
+        self.path = Path(path)
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._file(key)
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, key: str, request: Dict[str, Any], **entries):
+        """合併寫入（先寫暫存檔再 os.replace）"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        record = self.load(key) or {'request': request}
+        record.update(entries)
+        tmp_path = self._file(key).with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, self._file(key))
+
+
+# === record ===
+
+class _RecordingModels:
+    def __init__(self, models, cassette: Cassette):
+        self._models = models
+        self._cassette = cassette
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        start_time = time.time()
+        response = self._models.generate_content(model=model, contents=contents, config=config)
+        self._cassette.save(
+            request_key(model, contents, config),
+            {'model': model, 'contents': contents},
+            response=_dump(response),
+            latency=time.time() - start_time,
+        )
+        return response
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[Any]:
+        start_time = time.time()
+        chunks = []
+        for chunk in self._models.generate_content_stream(model=model, contents=contents, config=config):
+            chunks.append(_dump(chunk))
+            yield chunk
+        self._cassette.save(
+            request_key(model, contents, config),
+            {'model': model, 'contents': contents},
+            stream=chunks,
+            latency=time.time() - start_time,
+        )
+
+    def get(self, model: str):
+        return self._models.get(model=model)
+
+
+class _RecordingAsyncModels:
+    def __init__(self, models, cassette: Cassette):
+        self._models = models
+        self._cassette = cassette
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        start_time = time.time()
+        response = await self._models.generate_content(model=model, contents=contents, config=config)
+        self._cassette.save(
+            request_key(model, contents, config),
+            {'model': model, 'contents': contents},
+            response=_dump(response),
+            latency=time.time() - start_time,
+        )
+        return response
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> AsyncIterator[Any]:
+        start_time = time.time()
+        stream = await self._models.generate_content_stream(model=model, contents=contents, config=config)
+
+        async def _iterate():
+            chunks = []
+            async for chunk in stream:
+                chunks.append(_dump(chunk))
+                yield chunk
+            self._cassette.save(
+                request_key(model, contents, config),
+                {'model': model, 'contents': contents},
+                stream=chunks,
+                latency=time.time() - start_time,
+            )
+
+        return _iterate()
+
+
+class RecordingClient:
+    """
+    包裝 genai.Client，將每次回應寫入 cassette
+    """
+
+    def __init__(self, client, cassette: Cassette):
+        self._client = client
+        self.models = _RecordingModels(client.models, cassette)
+        self.aio = SimpleNamespace(models=_RecordingAsyncModels(client.aio.models, cassette))
+
+
+# === replay ===
+
+class ReplayClient:
+    """
+    不連網的 Client：回放 cassette 或產生合成回應
+
+    延遲依對數常態分佈抽樣；依 error_rate 回傳 429 / 503；
+    延遲超過 timeout 時拋出 httpx 逾時例外（與 live 的 Client 行為一致）。
+    """
+
+    def __init__(self, cassette: Cassette, latency_median: float = REPLAY_LATENCY_MEDIAN,
+                 latency_sigma: float = REPLAY_LATENCY_SIGMA, error_rate: float = REPLAY_ERROR_RATE,
+                 synthetic: bool = REPLAY_SYNTHETIC, seed: Optional[int] = REPLAY_SEED,
+                 timeout: Optional[float] = None):
+        self.cassette = cassette
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.synthetic = synthetic
+        self.timeout = timeout
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._source_ids: Optional[List[str]] = None
+
+        self.models = _ReplayModels(self)
+        self.aio = SimpleNamespace(models=_ReplayAsyncModels(self))
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            if self.latency_sigma <= 0:
+                return self.latency_median
+            return self._random.lognormvariate(math.log(max(self.latency_median, 1e-6)), self.latency_sigma)
+
+    def sample_error(self) -> Optional[Exception]:
+        """依 error_rate 抽樣錯誤（429 與 503 各半）"""
+        with self._lock:
+            if self.error_rate <= 0 or self._random.random() >= self.error_rate:
+                return None
+            code = self._random.choice([429, 503])
+
+        from google.genai import errors
+        status = 'RESOURCE_EXHAUSTED' if code == 429 else 'UNAVAILABLE'
+        error_class = errors.ClientError if code == 429 else errors.ServerError
+        return error_class(code, {'error': {'code': code, 'message': 'replay error', 'status': status}})
+
+    def timeout_error(self) -> Exception:
+        import httpx
+        return httpx.ReadTimeout(f"replay latency exceeded {self.timeout:g}s")
+
+    def _sample_source_ids(self, k: int) -> List[str]:
+        """合成回應的來源：從 mapping 中抽樣實際的 Gemini file ID，讓來源解析照常執行"""
+        with self._lock:
+            if self._source_ids is None:
+                from mapping_index import iter_mapping_records
+                ids = sorted({short_id for _, _, short_id, _ in iter_mapping_records() if short_id})
+                self._source_ids = ids or [f"synthetic-{i}" for i in range(100)]
+            return self._random.sample(self._source_ids, min(k, len(self._source_ids)))
+
+    def lookup(self, model: str, contents: Any, config: Any = None) -> Dict[str, Any]:
+        """
+        取得回放資料: {'response': dict, 'stream': [dict, ...] 或 None}
+        """
+        record = self.cassette.load(request_key(model, contents, config))
+        if record is not None:
+            return {'response': record.get('response') or self._merge_stream(record['stream']),
+                    'stream': record.get('stream')}
+
+        if not self.synthetic:
+            raise LookupError(f"cassette 中沒有此請求: {request_key(model, contents, config)}")
+
+        question = contents if isinstance(contents, str) else json.dumps(_dump(contents), ensure_ascii=False)
+        chunks = [
+            {'retrieved_context': {'title': short_id, 'text': f"（合成內容）{question[:200]}"}}
+            for short_id in self._sample_source_ids(SYNTHETIC_SOURCES)
+        ]
+        text = f"（回放模式合成回應）{question[:200]}"
+        return {'response': _response_data(text, chunks), 'stream': None}
+
+    @staticmethod
+    def _merge_stream(stream: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """將串流 chunk 合併為單一回應"""
+        text = ''.join(_response_text(chunk) for chunk in stream)
+        chunks = []
+        for chunk in stream:
+            chunks = _grounding_chunks(chunk) or chunks
+        return _response_data(text, chunks)
+
+    @staticmethod
+    def split_stream(response: Dict[str, Any], pieces: int = 20) -> List[Dict[str, Any]]:
+        """將非串流回應切成串流 chunk，最後一個 chunk 帶 grounding_chunks"""
+        text = _response_text(response)
+        size = max(1, math.ceil(len(text) / pieces))
+        stream = [_response_data(text[i:i + size], []) for i in range(0, len(text), size)]
+        stream.append(_response_data('', _grounding_chunks(response)))
+        return stream
+
+
+class _ReplayModels:
+    def __init__(self, client: ReplayClient):
+        self._client = client
+
+    def _wait(self) -> float:
+        """依抽樣延遲等待；超過逾時則拋出逾時例外"""
+        latency = self._client.sample_latency()
+        timeout = self._client.timeout
+        if timeout and latency > timeout:
+            time.sleep(timeout)
+            raise self._client.timeout_error()
+        return latency
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        data = self._client.lookup(model, contents, config)
+        time.sleep(self._wait())
+        error = self._client.sample_error()
+        if error is not None:
+            raise error
+        return _to_response(data['response'])
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[Any]:
+        data = self._client.lookup(model, contents, config)
+        latency = self._wait()
+        error = self._client.sample_error()
+
+        # 首字約佔總延遲的三成，其餘平均分配給後續 chunk
+        stream = data['stream'] or ReplayClient.split_stream(data['response'])
+        time.sleep(latency * 0.3)
+        if error is not None:
+            raise error
+        for chunk in stream:
+            yield _to_response(chunk)
+            time.sleep(latency * 0.7 / len(stream))
+
+    def get(self, model: str):
+        return None
+
+
+class _ReplayAsyncModels:
+    def __init__(self, client: ReplayClient):
+        self._client = client
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        data = self._client.lookup(model, contents, config)
+        latency = self._client.sample_latency()
+        timeout = self._client.timeout
+        if timeout and latency > timeout:
+            await asyncio.sleep(timeout)
+            raise self._client.timeout_error()
+        await asyncio.sleep(latency)
+        error = self._client.sample_error()
+        if error is not None:
+            raise error
+        return _to_response(data['response'])
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> AsyncIterator[Any]:
+        data = self._client.lookup(model, contents, config)
+        latency = self._client.sample_latency()
+        timeout = self._client.timeout
+        if timeout and latency > timeout:
+            await asyncio.sleep(timeout)
+            raise self._client.timeout_error()
+        error = self._client.sample_error()
+
+        # 與同步版本相同：首字約佔總延遲的三成
+        stream = data['stream'] or ReplayClient.split_stream(data['response'])
+        await asyncio.sleep(latency * 0.3)
+        if error is not None:
+            raise error
+
+        async def _iterate():
+            for chunk in stream:
+                yield _to_response(chunk)
+                await asyncio.sleep(latency * 0.7 / len(stream))
+
+        return _iterate()
+
+
+def create_client(api_key: str, http_options: Any = None, timeout: Optional[float] = None,
+                  backend: str = GEMINI_BACKEND):
+    """
+    依 backend 建立 Client
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"GEMINI_BACKEND 必須是 {', '.join(BACKENDS)} 之一: {backend}")
+
+    if backend == 'replay':
+        return ReplayClient(Cassette(GEMINI_CASSETTE_DIR), timeout=timeout)
+
+    from google import genai
+    client = genai.Client(api_key=api_key, http_options=http_options)
+    if backend == 'record':
+        return RecordingClient(client, Cassette(GEMINI_CASSETTE_DIR))
+    return client
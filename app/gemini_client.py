@@ -0,0 +1,133 @@
+"""
+Gemini Client 共用管理
+
+每個 process 只建立一個 genai.Client（依 API Key 區分），
+由所有 Streamlit session 與 rerun 共用，保持 HTTP 連線池與 keep-alive，
+避免每次查詢重新 import、建立連線與 TLS handshake。
+
+GEMINI_BACKEND 可切換為 record / replay（見 gemini_backend）。
+"""
+
+import asyncio
+import contextvars
+import threading
+from typing import Any, Dict, Optional
+
+from metrics import span
+from settings import get_setting
+
+# 連線池大小（同時保持的連線數）
+GEMINI_POOL_SIZE = get_setting('GEMINI_POOL_SIZE', 10)
+# 單次請求逾時（秒），0 表示不設逾時
+GEMINI_TIMEOUT = get_setting('GEMINI_TIMEOUT', 60.0)
+
+_clients: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+# 供 client.aio 使用的常駐 event loop（async 連線池綁定在同一個 loop 上）
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def build_http_options(pool_size: int = GEMINI_POOL_SIZE, timeout: float = GEMINI_TIMEOUT):
+    """
+    建立 HttpOptions：連線池上限、keep-alive 與逾時（HttpOptions.timeout 單位為毫秒）
+    """
+    import httpx
+    from google.genai import types
+
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+    )
+    return types.HttpOptions(
+        timeout=int(timeout * 1000) if timeout else None,
+        client_args={'limits': limits},
+        async_client_args={'limits': limits},
+    )
+
+
+def get_client(api_key: str):
+    """
+    取得共用的 genai.Client（thread-safe，每個 API Key 只建立一次）
+
+    依 GEMINI_BACKEND 回傳 live、record 或 replay 的 Client
+    """
+    client = _clients.get(api_key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(api_key)
+        if client is None:
+            with span('client_init'):
+                from gemini_backend import GEMINI_BACKEND, create_client
+                http_options = build_http_options() if GEMINI_BACKEND != 'replay' else None
+                client = create_client(api_key, http_options, timeout=GEMINI_TIMEOUT)
+            _clients[api_key] = client
+    return client
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    取得在背景 thread 執行的共用 event loop（每個 process 一個）
+    """
+    global _loop
+    if _loop is not None:
+        return _loop
+
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='gemini-aio', daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def run_async(coro, timeout: Optional[float] = None):
+    """
+    在共用 event loop 上執行 coroutine 並等待結果（可由任何 thread 呼叫）
+
+    coroutine 會帶入呼叫端的 contextvars（例如 metrics 的 trace）
+    """
+    context = contextvars.copy_context()
+
+    async def _run():
+        for var, value in context.items():
+            var.set(value)
+        return await coro
+
+    future = asyncio.run_coroutine_threadsafe(_run(), get_event_loop())
+    return future.result(timeout)
+
+
+def warm_up(api_key: str, model: str, background: bool = True) -> Optional[threading.Thread]:
+    """
+    預先 import google.genai、建立 Client 並發出一次輕量請求建立連線
+
+    background=True 時在背景 thread 執行並回傳該 thread。
+    暖機失敗不影響正常查詢。
+    """
+    def _run():
+        try:
+            client = get_client(api_key)
+            client.models.get(model=model)
+        except Exception:
+            pass
+
+    if not background:
+        _run()
+        return None
+
+    thread = threading.Thread(target=_run, name='gemini-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def is_timeout_error(error: Exception) -> bool:
+    """判斷例外是否為請求逾時"""
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(error, httpx.TimeoutException)
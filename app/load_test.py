@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Streamlit 併發 session 負載測試
+
+以 Streamlit 的 AppTest 在同一個 process 中同時執行 N 個 session（與實際部署相同，
+共用 st.cache_resource 與 qa_core 的資源），每個 session 依序執行常見的操作流程：
+
+    開啟頁面 → 勾選資料來源 → 送出問題 → 載入更多來源 → 清除 → 點選範例問題 → 送出
+
+Gemini 使用回放後端（GEMINI_BACKEND=replay 合成回應），延遲分佈可設定，
+量測的是 App 本身的負擔：每次 rerun 的延遲、每個 session 增加的記憶體與飽和點。
+
+- 依序以 --sessions 指定的併發數執行，每個併發數執行 --flows 輪
+- 飽和點：吞吐量（流程 / 秒）增加不到 10%，或 p95 rerun 延遲超過 --max-p95 的最小併發數
+- 記憶體：背景取樣 RSS，以（峰值 - 開始前）/ 併發數估算每個 session 的記憶體
+
+    python app/load_test.py [--sessions 1 2 4 8] [--flows 2] [--latency 1.0]
+    python app/load_test.py --save-baseline .cache/load_baseline.json
+    python app/load_test.py --baseline .cache/load_baseline.json
+
+與 baseline 比較時，各操作的 p95 延遲或每個 session 的記憶體超出容許範圍會以 exit code 1 結束。
+查詢快取、範例預先計算與准入控制預設關閉，每次送出都會經過完整的查詢與顯示流程。
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+APP_PATH = Path(__file__).parent / "main.py"
+DEFAULT_OUTPUT_PATH = Path(__file__).parent.parent / ".cache" / "load_results.jsonl"
+
+# 送出的問題（與範例問題不同，避免與範例流程重複）
+QUESTIONS = [
+    "哪些銀行因為理專挪用客戶款項被裁罰？",
+    "保險業資本適足率不足會有什麼處分？",
+    "證券商未落實洗錢防制被罰的案例",
+    "金融控股公司大股東適格性審查的規定",
+    "投信事業違反內部控制制度的裁罰",
+    "電子支付機構儲值款項的管理規定",
+]
+
+# 勾選的額外資料來源（裁罰案件預設已勾選）
+EXTRA_STORES = ['law_interpretations', 'announcements']
+
+# 吞吐量增加不到此比例即視為飽和
+SATURATION_GAIN = 0.1
+
+
+def configure_environment(args: argparse.Namespace):
+    """設定回放後端與關閉會掩蓋負擔的功能（須在第一次執行 App 之前）"""
+    os.environ.update({
+        'GEMINI_BACKEND': 'replay',
+        'REPLAY_SYNTHETIC': 'true',
+        'REPLAY_LATENCY_MEDIAN': str(args.latency),
+        'REPLAY_LATENCY_SIGMA': str(args.sigma),
+        'REPLAY_ERROR_RATE': '0',
+        'GEMINI_WARM_UP': 'false',
+        'ANSWER_CACHE_ENABLED': 'true' if args.use_cache else 'false',
+        'EXAMPLE_PRECOMPUTE_ENABLED': 'false',
+        'ADMISSION_ENABLED': 'true' if args.admission else 'false',
+        'SOURCES_PAGE_SIZE': str(args.page_size),
+    })
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近排名法百分位數"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p * len(values)) - 1))
+    return values[index]
+
+
+def current_rss() -> float:
+    """目前的 RSS（MB）；無法讀取 /proc 時改用峰值 RSS"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 為 KB，macOS 為 bytes
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+
+class RssSampler:
+    """
+    背景取樣 RSS，記錄期間的峰值
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> 'RssSampler':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def find_button(at, label: str = '', key: str = ''):
+    """依 key 或標籤取得按鈕，找不到時回傳 None"""
+    for button in at.button:
+        if (key and button.key == key) or (label and button.label.startswith(label)):
+            return button
+    return None
+
+
+def run_flow(session: int, flow: int, timeout: float, rng: random.Random) -> Dict[str, Any]:
+    """
+    執行一個 session 的完整操作流程
+
+    回傳: {'session', 'flow', 'steps': [{'step', 'latency', 'error'}], 'latency', 'error'}
+    """
+    from streamlit.testing.v1 import AppTest
+
+    steps = []
+    at = AppTest.from_file(str(APP_PATH), default_timeout=timeout)
+
+    def step(name: str, action, when=lambda: True):
+        if not when():
+            return True
+        start_time = time.perf_counter()
+        error = None
+        try:
+            action()
+            if at.exception:
+                error = str(at.exception[0].value)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        steps.append({'step': name, 'latency': time.perf_counter() - start_time, 'error': error})
+        return error is None
+
+    def submit(question: str):
+        def action():
+            at.session_state['current_question'] = question
+            at.text_area[0].input(question)
+            find_button(at, label='🔍 查詢').click().run()
+        return action
+
+    def more_sources():
+        find_button(at, key='more_sources').click().run()
+
+    def example():
+        find_button(at, label='🗑️ 清除').click().run()
+        examples = [button for button in at.button if (button.key or '').startswith('example_')]
+        rng.choice(examples).click().run()
+
+    start_time = time.perf_counter()
+    ok = step('load', at.run)
+    if ok:
+        store = rng.choice(EXTRA_STORES)
+        ok = step('select_stores', lambda: at.checkbox(key=f'store_{store}').check().run())
+    if ok:
+        ok = step('submit', submit(rng.choice(QUESTIONS)))
+    if ok:
+        ok = step('more_sources', more_sources, when=lambda: find_button(at, key='more_sources') is not None)
+    if ok:
+        ok = step('example', example)
+    if ok:
+        ok = step('submit_example', lambda: find_button(at, label='🔍 查詢').click().run())
+
+    return {
+        'session': session,
+        'flow': flow,
+        'steps': steps,
+        'latency': time.perf_counter() - start_time,
+        'error': not ok,
+    }
+
+
+def run_level(sessions: int, flows: int, timeout: float, seed: int) -> Dict[str, Any]:
+    """
+    以 sessions 個併發 session 各執行 flows 輪流程
+
+    回傳: {'sessions', 'results', 'wall_time', 'rss_before', 'rss_peak'}
+    """
+    rss_before = current_rss()
+
+    def worker(session: int) -> List[Dict[str, Any]]:
+        rng = random.Random(seed * 1000 + session)
+        return [run_flow(session, flow, timeout, rng) for flow in range(flows)]
+
+    start_time = time.time()
+    with RssSampler() as sampler:
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            results = [r for rows in executor.map(worker, range(sessions)) for r in rows]
+    return {
+        'sessions': sessions,
+        'results': results,
+        'wall_time': time.time() - start_time,
+        'rss_before': rss_before,
+        'rss_peak': sampler.peak,
+    }
+
+
+def summarize_level(level: Dict[str, Any]) -> Dict[str, Any]:
+    """計算單一併發數的 rerun 延遲百分位數、吞吐量與記憶體"""
+    results = level['results']
+    by_step: Dict[str, List[float]] = defaultdict(list)
+    for r in results:
+        for s in r['steps']:
+            if s['error'] is None:
+                by_step[s['step']].append(s['latency'])
+    all_latencies = [latency for latencies in by_step.values() for latency in latencies]
+    n = len(results) or 1
+    return {
+        'sessions': level['sessions'],
+        'flows': len(results),
+        'p50': percentile(all_latencies, 0.50),
+        'p95': percentile(all_latencies, 0.95),
+        'p99': percentile(all_latencies, 0.99),
+        'steps': {
+            step: {'p50': percentile(v, 0.50), 'p95': percentile(v, 0.95), 'count': len(v)}
+            for step, v in by_step.items()
+        },
+        'throughput': len(results) / level['wall_time'] if level['wall_time'] > 0 else 0.0,
+        'error_rate': sum(r['error'] for r in results) / n,
+        'rss_peak': level['rss_peak'],
+        'rss_per_session': max(0.0, level['rss_peak'] - level['rss_before']) / level['sessions'],
+        'wall_time': level['wall_time'],
+    }
+
+
+def saturation_point(levels: List[Dict[str, Any]], max_p95: float) -> Optional[int]:
+    """
+    吞吐量增加不到 SATURATION_GAIN 或 p95 超過 max_p95 的最小併發數；未飽和時回傳 None
+    """
+    previous = None
+    for level in levels:
+        if level['p95'] > max_p95 or level['error_rate'] > 0:
+            return level['sessions']
+        if previous is not None and level['throughput'] < previous['throughput'] * (1 + SATURATION_GAIN):
+            return level['sessions']
+        previous = level
+    return None
+
+
+def summarize(levels: List[Dict[str, Any]], args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        'latency': args.latency,
+        'levels': levels,
+        'saturation': saturation_point(levels, args.max_p95),
+        'rss_per_session': max((level['rss_per_session'] for level in levels), default=0.0),
+    }
+
+
+def compare(summary: Dict[str, Any], baseline: Dict[str, Any],
+            max_latency_regression: float, max_rss_regression: float) -> List[str]:
+    """
+    與 baseline 比較相同併發數下各操作的 p95 延遲與每個 session 的記憶體，回傳退步項目說明
+    """
+    regressions = []
+    baseline_levels = {level['sessions']: level for level in baseline.get('levels', [])}
+    for level in summary['levels']:
+        base = baseline_levels.get(level['sessions'])
+        if base is None:
+            continue
+        for step, stats in level['steps'].items():
+            base_p95 = base.get('steps', {}).get(step, {}).get('p95')
+            if base_p95 and stats['p95'] > base_p95 * (1 + max_latency_regression):
+                regressions.append(
+                    f"{level['sessions']} sessions {step} p95 {base_p95:.2f} → {stats['p95']:.2f} 秒"
+                    f"（容許 +{max_latency_regression:.0%}）"
+                )
+    base_rss = baseline.get('rss_per_session')
+    if base_rss and summary['rss_per_session'] > base_rss * (1 + max_rss_regression):
+        regressions.append(
+            f"每個 session 記憶體 {base_rss:.1f} → {summary['rss_per_session']:.1f} MB"
+            f"（容許 +{max_rss_regression:.0%}）"
+        )
+    if baseline.get('saturation') and summary['saturation'] and summary['saturation'] < baseline['saturation']:
+        regressions.append(f"飽和點 {baseline['saturation']} → {summary['saturation']} sessions")
+    return regressions
+
+
+def print_summary(summary: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    baseline_levels = {level['sessions']: level for level in (baseline or {}).get('levels', [])}
+    for level in summary['levels']:
+        base = baseline_levels.get(level['sessions'])
+        base_text = f"（baseline p95 {base['p95']:.2f}）" if base else ""
+        print(f"{level['sessions']:>3} sessions：rerun p50 {level['p50']:.2f} / p95 {level['p95']:.2f}{base_text} / "
+              f"p99 {level['p99']:.2f} 秒　吞吐量 {level['throughput']:.2f} 流程/秒　"
+              f"錯誤 {level['error_rate']:.0%}　RSS 峰值 {level['rss_peak']:.0f} MB"
+              f"（每 session {level['rss_per_session']:.1f} MB）")
+        for step, stats in level['steps'].items():
+            print(f"      {step:<15} p50 {stats['p50']:.2f}　p95 {stats['p95']:.2f} 秒　({stats['count']} 次)")
+    saturation = summary['saturation']
+    print(f"飽和點: {f'{saturation} sessions' if saturation else '未達飽和'}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Streamlit 併發 session 負載測試（回放後端）')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help='依序測試的併發 session 數')
+    parser.add_argument('--flows', type=int, default=2, help='每個 session 執行的流程數')
+    parser.add_argument('--latency', type=float, default=1.0, help='回放延遲中位數（秒）')
+    parser.add_argument('--sigma', type=float, default=0.3, help='回放延遲分佈的 sigma')
+    parser.add_argument('--timeout', type=float, default=120.0, help='單次 rerun 的逾時（秒）')
+    parser.add_argument('--max-p95', type=float, default=5.0, help='p95 rerun 延遲超過此秒數視為飽和')
+    parser.add_argument('--seed', type=int, default=0, help='操作流程的亂數種子')
+    parser.add_argument('--page-size', type=int, default=2,
+                        help='參考來源每頁筆數（回放的合成回應有 5 筆來源，小於此數時不會出現「顯示更多來源」）')
+    parser.add_argument('--use-cache', action='store_true', help='啟用查詢快取（預設關閉以量測完整查詢流程）')
+    parser.add_argument('--admission', action='store_true', help='啟用准入控制')
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT_PATH), help='逐流程結果輸出 (JSONL)')
+    parser.add_argument('--baseline', default=None, help='與此 baseline 摘要比較')
+    parser.add_argument('--save-baseline', default=None, help='將本次摘要存為 baseline')
+    parser.add_argument('--max-latency-regression', type=float, default=0.3, help='p95 延遲容許增加比例')
+    parser.add_argument('--max-rss-regression', type=float, default=0.3, help='每個 session 記憶體容許增加比例')
+    args = parser.parse_args(argv)
+
+    configure_environment(args)
+
+    # 先執行一次，載入模組與共用資源（mapping 索引、Client 等），不計入量測
+    print("暖機中...")
+    run_flow(-1, 0, args.timeout, random.Random(args.seed))
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    levels = []
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for sessions in args.sessions:
+            level = run_level(sessions, args.flows, args.timeout, args.seed)
+            for r in level['results']:
+                f.write(json.dumps(dict(r, sessions=sessions), ensure_ascii=False) + '\n')
+            levels.append(summarize_level(level))
+            print(f"[{sessions} sessions] 完成 {len(level['results'])} 個流程，耗時 {level['wall_time']:.1f} 秒")
+
+    summary = summarize(levels, args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print()
+    print_summary(summary, baseline)
+    print(f"逐流程結果: {output_path}")
+
+    if args.save_baseline:
+        Path(args.save_baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"已儲存 baseline: {args.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare(summary, baseline, args.max_latency_regression, args.max_rss_regression)
+        if regressions:
+            print("❌ 效能退步：")
+            for text in regressions:
+                print(f"  {text}")
+            return 1
+        print("✅ 未超出 baseline 容許範圍")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
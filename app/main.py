@@ -9,11 +9,31 @@
 """
 
 import streamlit as st
-import os
+import logging
 import time
-import json
-from typing import List, Dict, Any
-from pathlib import Path
+import uuid
+from typing import List, Dict, Any, Optional
+
+from answer_cache import AnswerCache
+from doc_lookup import CATEGORY_LABELS, build_lookup_hint
+from store_router import CATEGORY_PREFIX_STORES
+from metadata_filter import apply_source_filters, filters_key, has_filters
+from gemini_backend import GEMINI_BACKEND
+import metrics
+from gemini_client import get_client
+from admission import AdmissionRejected
+from conversation import Conversation
+from example_precompute import ExamplePrecomputer
+from qa_core import (
+    ADMISSION_ENABLED, ANSWER_CACHE_ENABLED, FANOUT_ENABLED, GEMINI_MODEL, GEMINI_WARM_UP,
+    METADATA_FILTER_PUSHDOWN, NEAR_DUPLICATE_ENABLED, RETRY_MAX_ATTEMPTS, SINGLE_FLIGHT_ENABLED,
+    SNIPPET_SEPARATOR, SOURCE_LABELS, STORES, answer_cached, filter_unsupported_stores, find_similar_answer,
+    get_admission_controller, get_answer_cache, get_doc_lookup, get_example_precomputer,
+    get_near_duplicate_index, get_retry_policy, get_single_flight, get_store_router, get_system_prompt,
+    query_gemini, query_gemini_context, query_gemini_fanout, query_gemini_stream, start_client_warm_up,
+    start_metrics_server,
+)
+from settings import get_setting
 
 # 頁面配置
 st.set_page_config(
@@ -23,166 +43,98 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Store 配置
-STORES = {
-    'penalties': {
-        'name': 'fsc-penalties-plaintext',
-        'store_id': 'fileSearchStores/fscpenaltiesplaintext-4f87t5uexgui',
-        'display_name': '裁罰案件',
-        'icon': '⚖️',
-        'description': '490 筆金融機構裁罰案件 (2012-2025)',
-        'count': 490,
-    },
-    'law_interpretations': {
-        'name': 'fsc-law-interpretations',
-        'store_id': 'fileSearchStores/fsclawinterpretations-zz5pwrly06hz',
-        'display_name': '法令函釋',
-        'icon': '📜',
-        'description': '法規解釋、修正說明、條文對照',
-        'count': 2872,
-    },
-    'announcements': {
-        'name': 'fsc-announcements',
-        'store_id': 'fileSearchStores/fscannouncements-o94q0kmo2zxb',
-        'display_name': '重要公告',
-        'icon': '📢',
-        'description': '政策公告、法規修正公告',
-        'count': 1642,
-    },
-}
-
-# 載入 Mapping 檔案
-def load_mappings():
-    """
-    載入所有資料類型的 gemini_id_mapping 和 file_mapping 檔案
-    用於將 Gemini 回傳的 file ID 轉換為可讀的顯示名稱
-    """
-    data_path = Path(__file__).parent.parent / "data"
-
-    gemini_id_mapping = {}  # gemini_short_id → doc_id
-    file_mapping = {}       # doc_id → info
+# 參考來源的顯示順序：裁罰 → 函釋 → 公告 → 其他
+SOURCE_TYPE_ORDER = [
+    ("⚖️", "裁罰案件"),
+    ("📜", "法令函釋"),
+    ("📢", "重要公告"),
+    ("📄", "其他"),
+]
+
+# 每個 session 保留的查詢紀錄筆數、參考來源每次顯示的筆數
+QUERY_HISTORY_SIZE = get_setting('QUERY_HISTORY_SIZE', 5)
+SOURCES_PAGE_SIZE = get_setting('SOURCES_PAGE_SIZE', 10)
+
+# 篩選條件的年份範圍（選取完整範圍視為不篩選）
+FILTER_MIN_YEAR = 2000
+FILTER_MAX_YEAR = time.localtime().tm_year
+
+# 串流顯示答案（False 時使用非串流查詢）
+STREAMING_ENABLED = get_setting('STREAMING_ENABLED', True)
+
+# 多輪對話
+CONVERSATION_ENABLED = get_setting('CONVERSATION_ENABLED', False)              # 側邊欄開關的預設值
+CONVERSATION_TOKEN_BUDGET = get_setting('CONVERSATION_TOKEN_BUDGET', 2000)     # 對話脈絡的 token 上限
+CONVERSATION_REUSE_CONTEXT = get_setting('CONVERSATION_REUSE_CONTEXT', True)   # 追問上一輪文件時不重新檢索
+
+# 發文字號 / 法規名稱本地查詢
+LOOKUP_ENABLED = get_setting('LOOKUP_ENABLED', True)              # 純查詢型問題直接回傳本地結果
+LOOKUP_HINT_ENABLED = get_setting('LOOKUP_HINT_ENABLED', False)   # 將相符文件附加在 AI 查詢中
+
+# 範例問題預先計算（背景 thread，每個 process 一個）
+EXAMPLE_PRECOMPUTE_ENABLED = get_setting('EXAMPLE_PRECOMPUTE_ENABLED', True)
+EXAMPLE_PRECOMPUTE_INTERVAL = get_setting('EXAMPLE_PRECOMPUTE_INTERVAL', 21600.0)   # 重新計算間隔（秒）
+EXAMPLE_PRECOMPUTE_BUDGET = get_setting('EXAMPLE_PRECOMPUTE_BUDGET', 60)            # 每輪上游呼叫上限（含重試）
+
+# 自動選擇資料來源
+ROUTER_AUTO_DEFAULT = get_setting('ROUTER_AUTO_DEFAULT', False)     # 側邊欄開關的預設值
+
+# 記錄路由等決策，第三方套件維持預設層級
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logging.getLogger('store_router').setLevel(get_setting('LOG_LEVEL', 'INFO'))
+
+# 指標：METRICS_PORT 不為 0 時於背景提供 Prometheus /metrics
+METRICS_PORT = get_setting('METRICS_PORT', 0)
+METRICS_PANEL = get_setting('METRICS_PANEL', False)    # 側邊欄顯示各階段延遲
+
+
+def get_conversation() -> Conversation:
+    """
+    取得目前 session 的對話狀態
+    """
+    if 'conversation' not in st.session_state:
+        st.session_state.conversation = Conversation(token_budget=CONVERSATION_TOKEN_BUDGET)
+    return st.session_state.conversation
+
+
+def summarize_conversation(prompt: str, api_key: str) -> str:
+    """
+    以 Gemini 產生對話的滾動摘要（不使用 File Search）
+    """
+    from google.genai import types
+
+    if ADMISSION_ENABLED:
+        get_admission_controller().charge()
+    client = get_client(api_key)
+    with metrics.span('summarize'):
+        response = client.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                temperature=0.1,
+                max_output_tokens=int(CONVERSATION_TOKEN_BUDGET * 0.4)
+            )
+        )
+    return response.text or ''
+
+
+def get_precomputed_example(precomputer: Optional[ExamplePrecomputer], question: str,
+                            stores: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    取得預先計算的範例答案；尚未計算或已過期時回傳 None
+    """
+    if precomputer is None:
+        return None
+    start_time = time.time()
+    result = precomputer.get(question, stores)
+    if result is None:
+        return None
+    metrics.annotate(mode='precomputed')
+    return dict(result, latency=time.time() - start_time, cached=True)
 
-    try:
-        # === 載入裁罰案件 (舊格式) ===
-        penalties_path = data_path / "penalties"
-
-        # gemini_id_mapping.json: {files/xxx: doc_id}
-        gemini_mapping_path = penalties_path / "gemini_id_mapping.json"
-        if gemini_mapping_path.exists():
-            with open(gemini_mapping_path, 'r', encoding='utf-8') as f:
-                raw_mapping = json.load(f)
-                for full_id, doc_id in raw_mapping.items():
-                    short_id = full_id.replace('files/', '')
-                    gemini_id_mapping[short_id] = doc_id
-
-        # file_mapping.json: {doc_id: info}
-        file_mapping_path = penalties_path / "file_mapping.json"
-        if file_mapping_path.exists():
-            with open(file_mapping_path, 'r', encoding='utf-8') as f:
-                file_mapping.update(json.load(f))
-
-        # === 載入法令函釋 ===
-        law_path = data_path / "law_interpretations"
-        law_gemini_path = law_path / "gemini_id_mapping_new.json"
-        if law_gemini_path.exists():
-            with open(law_gemini_path, 'r', encoding='utf-8') as f:
-                raw_mapping = json.load(f)
-                for doc_id, info in raw_mapping.items():
-                    gemini_file_id = info.get('gemini_file_id', '')
-                    if gemini_file_id:
-                        short_id = gemini_file_id.replace('files/', '')
-                        gemini_id_mapping[short_id] = doc_id
-                    file_mapping[doc_id] = {
-                        'display_name': info.get('display_name', ''),
-                        'date': info.get('date', ''),
-                        'source': info.get('source', ''),
-                        'category': info.get('category', ''),
-                        'original_url': info.get('original_url', ''),
-                    }
-
-        # === 載入重要公告 ===
-        ann_path = data_path / "announcements"
-        ann_gemini_path = ann_path / "gemini_id_mapping_new.json"
-        if ann_gemini_path.exists():
-            with open(ann_gemini_path, 'r', encoding='utf-8') as f:
-                raw_mapping = json.load(f)
-                for doc_id, info in raw_mapping.items():
-                    gemini_file_id = info.get('gemini_file_id', '')
-                    if gemini_file_id:
-                        short_id = gemini_file_id.replace('files/', '')
-                        gemini_id_mapping[short_id] = doc_id
-                    file_mapping[doc_id] = {
-                        'display_name': info.get('display_name', ''),
-                        'date': info.get('date', ''),
-                        'source': info.get('source', ''),
-                        'category': info.get('category', ''),
-                        'original_url': info.get('original_url', ''),
-                    }
-
-    except Exception as e:
-        st.warning(f"載入 mapping 檔案時發生錯誤: {e}")
-
-    return gemini_id_mapping, file_mapping
-
-# 全域 Mapping (載入一次)
-GEMINI_ID_MAPPING, FILE_MAPPING = load_mappings()
-
-
-def resolve_source_display_name(raw_id: str) -> tuple:
-    """
-    將 Gemini 回傳的 file ID 解析為可讀的顯示名稱
-
-    回傳: (display_name, source_type, date, original_url)
-    """
-    # 嘗試從 mapping 查詢
-    doc_id = GEMINI_ID_MAPPING.get(raw_id, '')
-
-    if doc_id and doc_id in FILE_MAPPING:
-        info = FILE_MAPPING[doc_id]
-        display_name = info.get('display_name', '')
-        date = info.get('date', '未知日期')
-        source = info.get('source', '')
-        original_url = info.get('original_url', '')
-
-        # 判斷來源類型
-        if doc_id.startswith('fsc_pen'):
-            source_type = "裁罰案件"
-            icon = "⚖️"
-        elif doc_id.startswith('fsc_law'):
-            source_type = "法令函釋"
-            icon = "📜"
-        elif doc_id.startswith('fsc_unk') or doc_id.startswith('fsc_ann'):
-            source_type = "重要公告"
-            icon = "📢"
-        else:
-            source_type = "未知"
-            icon = "📄"
-
-        # 來源單位中文化
-        source_map = {
-            'insurance_bureau': '保險局',
-            'securities_bureau': '證期局',
-            'bank_bureau': '銀行局',
-            'fsc': '金管會',
-        }
-        source_display = source_map.get(source, source)
-
-        # 格式化顯示名稱
-        if display_name:
-            # 裁罰案件格式: "2025-09-25_保險局_全球人壽"
-            # 新格式: "2025-11-14_insurance_bureau_ann_amendment_fsc_unk_..."
-            parts = display_name.split('_')
-            if doc_id.startswith('fsc_pen') and len(parts) >= 3:
-                # 裁罰: 日期_來源_機構名稱
-                return f"{icon} {parts[0]}_{parts[2]}", source_type, date, original_url
-            elif len(parts) >= 2:
-                # 法令函釋/公告: 日期_來源
-                return f"{icon} {date}_{source_display}", source_type, date, original_url
-
-        return f"{icon} {source_type}_{date}", source_type, date, original_url
-
-    # 如果 mapping 找不到，嘗試從原始名稱解析
-    return f"📄 {format_source_display_name(raw_id)}", "未知", "未知日期", ""
+
+# 結果區以 fragment 渲染，互動時只重新執行該區塊（Streamlit 1.37 前為 experimental_fragment）
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda func: func)
 
 
 # 範例問題
@@ -196,203 +148,478 @@ EXAMPLE_QUESTIONS = [
 ]
 
 
-def get_system_prompt(selected_stores: List[str]) -> str:
+def stream_answer(question: str, selected_stores: List[str], api_key: str,
+                  filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
-    根據選取的 Store 組合產生系統提示
+    串流顯示部分答案，完成後清除暫存區並回傳最終結果
     """
-    base_prompt = """你是專業的金融法規顧問。請根據參考資料回答問題。
+    placeholder = st.empty()
+    placeholder.info("🔍 AI 查詢中...")
 
-回答時必須：
-1. 明確引用來源文件（檔案名稱、日期）
-2. 如果資料中沒有相關資訊，請誠實說明
-3. 使用繁體中文回答
-4. 保持專業、客觀的態度
-"""
+    text = ""
+    result = None
+    for event in query_gemini_stream(question, selected_stores, api_key, filters=filters):
+        if event['type'] == 'delta':
+            text += event['text']
+            placeholder.markdown(text + "▌")
+        elif event['type'] == 'done':
+            result = event['result']
 
-    # 根據選取的 Store 加入特定指引
-    specific_guidelines = []
+    placeholder.empty()
+    return result
 
-    if 'penalties' in selected_stores:
-        specific_guidelines.append("""
-【裁罰案件指引】
-- 列舉具體案例與裁罰內容
-- 說明受罰機構、罰款金額、違規行為
-- 引用相關法律依據""")
 
-    if 'law_interpretations' in selected_stores:
-        specific_guidelines.append("""
-【法令函釋指引】
-- 解釋法規的具體含義
-- 列出修正前後的差異（如有）
-- 引用發文字號""")
+def run_query(question: str, selected_stores: List[str], api_key: str,
+              filters: Optional[Dict[str, Any]] = None,
+              context_sources: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    執行查詢；其他 session 正在查詢相同問題時等待並共用其結果（single-flight）
 
-    if 'announcements' in selected_stores:
-        specific_guidelines.append("""
-【重要公告指引】
-- 說明公告的主要內容
-- 列出生效日期（如有）
-- 引用公告文號""")
+    context_sources 為多輪對話中沿用的上一輪來源，有值時不重新檢索
+    """
+    fanout = not context_sources and len(selected_stores) > 1 and st.session_state.get('fanout_mode', FANOUT_ENABLED)
+    if context_sources:
+        mode = 'context'
+    else:
+        mode = 'fanout' if fanout else ('stream' if STREAMING_ENABLED else 'plain')
+    metrics.annotate(mode=mode)
+
+    if not SINGLE_FLIGHT_ENABLED:
+        return execute_query(question, selected_stores, api_key, filters, fanout, context_sources)
+
+    key = AnswerCache.make_key(
+        question, selected_stores, GEMINI_MODEL, get_system_prompt(selected_stores),
+        variant=mode + filters_key(filters)
+    )
+    notice = st.empty()
+    result, shared = get_single_flight().do(
+        key,
+        lambda: execute_query(question, selected_stores, api_key, filters, fanout, context_sources),
+        on_wait=lambda: notice.info("⏳ 相同的問題正在查詢中，等待結果..."),
+    )
+    notice.empty()
 
-    # 組合提示
-    if specific_guidelines:
-        return base_prompt + "\n" + "\n".join(specific_guidelines)
-    return base_prompt
+    if shared:
+        metrics.annotate(coalesced=True)
+        metrics.registry.incr('coalesced', mode=mode)
+        result['shared'] = True
+    return result
 
 
-def query_gemini(question: str, selected_stores: List[str], api_key: str) -> Dict[str, Any]:
+def admit_query(question: str, selected_stores: List[str], filters: Optional[Dict[str, Any]],
+                fanout: bool, context: bool = False) -> Optional[Dict[str, Any]]:
     """
-    使用 Gemini File Search 執行查詢
+    等待准入控制放行，等待期間顯示排隊位置與預估時間
+
+    快取命中的查詢不呼叫 Gemini，直接放行。被拒絕時回傳錯誤結果，放行時回傳 None。
     """
-    from google import genai
-    from google.genai import types
+    variant = 'context' if context else ('fanout' if fanout else '') + filters_key(filters)
+    if answer_cached(question, selected_stores, variant):
+        return None
 
-    client = genai.Client(api_key=api_key)
+    notice = st.empty()
+    try:
+        with metrics.span('admission') as tags:
+            tags['waited'] = get_admission_controller().acquire(
+                st.session_state.get('session_id', ''),
+                cost=len(selected_stores) + 1 if fanout else 1,
+                on_wait=lambda position, eta: notice.info(
+                    f"⏳ 查詢排隊中：第 {position} 位，預估等待 {eta:.0f} 秒"
+                ),
+            )
+    except AdmissionRejected as e:
+        metrics.annotate(rejected=True)
+        return {'answer': f"⚠️ {e}", 'sources': [], 'retryable': False, 'error': True}
+    finally:
+        notice.empty()
+    return None
 
-    # 取得選取的 Store IDs
-    store_ids = [STORES[s]['store_id'] for s in selected_stores if s in STORES]
 
-    if not store_ids:
-        return {
-            'answer': '請至少選擇一個資料來源',
-            'sources': [],
-            'error': True
-        }
+def execute_query(question: str, selected_stores: List[str], api_key: str,
+                  filters: Optional[Dict[str, Any]], fanout: bool,
+                  context_sources: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    依設定選擇查詢模式（沿用先前來源 / 分別查詢 / 串流 / 一般），沒有來源或可重試錯誤時交由重試策略處理
+    """
+    if ADMISSION_ENABLED:
+        rejected = admit_query(question, selected_stores, filters, fanout, context=bool(context_sources))
+        if rejected is not None:
+            return rejected
+
+    policy = get_retry_policy()
+
+    if context_sources:
+        with st.spinner("🔍 AI 查詢中（沿用先前的參考資料）..."):
+            return policy.run(
+                lambda attempt: query_gemini_context(
+                    question, selected_stores, api_key, context_sources, use_cache=(attempt == 0)
+                )
+            )
 
-    # 取得系統提示
-    system_prompt = get_system_prompt(selected_stores)
+    if STREAMING_ENABLED and not fanout:
+        result = stream_answer(question, selected_stores, api_key, filters)
+        if result['sources'] or (result['error'] and not result.get('retryable')) or RETRY_MAX_ATTEMPTS <= 1:
+            return result
+
+        # 串流結果沒有來源：以重試策略重新查詢（不使用快取）
+        notice = st.empty()
+        notice.warning("⚠️ 未找到參考來源，正在重試...")
+        token = metrics.attempt_index.set(1)
+        try:
+            with st.spinner("重新查詢中..."):
+                retried = policy.run(
+                    lambda attempt: query_gemini(question, selected_stores, api_key, use_cache=False, filters=filters),
+                    max_attempts=RETRY_MAX_ATTEMPTS - 1,
+                )
+        finally:
+            metrics.attempt_index.reset(token)
+        notice.empty()
+
+        retried['attempts'] += 1
+        if retried['error'] and not result['error']:
+            return result
+        return retried
+
+    query_fn = query_gemini_fanout if fanout else query_gemini
+    spinner_text = "🔍 AI 查詢中（分別查詢各資料來源）..." if fanout else "🔍 AI 查詢中..."
+    with st.spinner(spinner_text):
+        return policy.run(
+            lambda attempt: query_fn(question, selected_stores, api_key, use_cache=(attempt == 0), filters=filters)
+        )
 
-    start_time = time.time()
 
-    try:
-        # 執行查詢
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=question,
-            config=types.GenerateContentConfig(
-                tools=[
-                    types.Tool(
-                        file_search=types.FileSearch(
-                            file_search_store_names=store_ids
-                        )
-                    )
-                ],
-                temperature=0.1,
-                max_output_tokens=2000,
-                system_instruction=system_prompt
-            )
+def render_result(result: Dict[str, Any], selected_stores: List[str],
+                  filters: Optional[Dict[str, Any]] = None, source_limit: int = 0):
+    """
+    顯示查詢結果：指標、答案與參考來源
+
+    source_limit 為最多顯示的來源筆數（0 表示全部）
+    """
+    if result['error']:
+        st.error(result['answer'])
+        return
+
+    # 顯示結果
+    st.success("✅ 查詢完成")
+
+    # 指標欄（使用較小字體）
+    stores_text = ", ".join([STORES[s]['display_name'] for s in selected_stores])
+    if result.get('precomputed_at'):
+        cached_text = f"（預先計算，{(time.time() - result['precomputed_at']) / 60:.0f} 分鐘前）"
+    else:
+        cached_text = "（快取）" if result.get('cached') else ("（共用進行中的查詢）" if result.get('shared') else "")
+    ttft_text = f"　｜　⚡ 首字時間: {result['ttft']:.2f} 秒" if result.get('ttft') is not None else ""
+    retry_text = ""
+    if result.get('attempts', 1) > 1:
+        hedge_text = "，hedge 勝出" if result.get('hedge_win') else ""
+        retry_text = f"　｜　🔁 嘗試 {result['attempts']} 次{hedge_text}"
+    st.caption(f"⏱️ 回應時間: {result['latency']:.2f} 秒{cached_text}{ttft_text}　｜　📚 來源數量: {len(result['sources'])} 筆　｜　📂 查詢範圍: {stores_text}{retry_text}")
+    if result.get('conversation'):
+        turn = result['conversation']
+        tokens_text = f"{result['input_tokens']:,}" if result.get('input_tokens') is not None else "—"
+        reuse_text = "　｜　♻️ 沿用上一輪的參考資料" if result.get('context_reused') else ""
+        st.caption(
+            f"💬 第 {turn['turn']} 輪　｜　🧮 輸入 tokens: {tokens_text}"
+            f"（對話脈絡約 {turn['context_tokens']:,} / {turn['budget']:,}）{reuse_text}"
         )
+    if result.get('similar_question'):
+        st.caption(f"♻️ 沿用相似問題的答案：「{result['similar_question']}」（相似度 {result['similarity']:.0%}）")
+    if has_filters(filters):
+        st.caption(f"🔎 篩選條件: {describe_filters(filters)}")
+
+    # 各 Store 查詢統計（分別查詢模式）
+    if result.get('store_stats'):
+        stat_texts = []
+        for stat in result['store_stats']:
+            store = STORES[stat['store']]
+            if stat['timed_out']:
+                status = "逾時"
+            elif stat['error']:
+                status = "失敗"
+            else:
+                status = f"{stat['sources']} 筆"
+            stat_texts.append(f"{store['icon']} {store['display_name']}: {stat['latency']:.2f} 秒 / {status}")
+        if result.get('synthesis_latency') is not None:
+            stat_texts.append(f"📝 彙整: {result['synthesis_latency']:.2f} 秒")
+        st.caption("　｜　".join(stat_texts))
+
+    st.markdown("---")
+
+    # 答案
+    st.subheader("📝 答案")
+    st.markdown(result['answer'])
+
+    st.markdown("---")
 
-        latency = time.time() - start_time
+    if not result['sources']:
+        st.info("你查詢的問題在目前的文件庫中沒有合適的結果，請嘗試換個方式描述您的問題。")
+        return
 
-        # 提取答案
-        answer = response.text if hasattr(response, 'text') else str(response)
+    # 來源（按類型分組，各組按時間排序）
+    st.subheader(f"📚 參考來源 ({len(result['sources'])} 筆)")
 
-        # 提取來源
-        sources = extract_sources(response)
+    with metrics.span('render_sources', sources=len(result['sources'])):
+        shown = render_source_groups(group_sources(result['sources']), limit=source_limit)
 
-        return {
-            'answer': answer,
-            'sources': sources,
-            'latency': latency,
-            'error': False
-        }
+    # 其餘來源按需載入
+    remaining = len(result['sources']) - shown
+    if remaining > 0:
+        st.button(
+            f"顯示更多來源（尚有 {remaining} 筆）",
+            key="more_sources",
+            on_click=show_more_sources,
+        )
 
-    except Exception as e:
-        return {
-            'answer': f'查詢失敗: {str(e)}',
-            'sources': [],
-            'error': True
-        }
 
+def group_sources(sources: List[Dict[str, Any]]) -> List[tuple]:
+    """
+    依類型分組（單次走訪），各組按日期由新到舊排序
 
-def format_source_display_name(raw_name: str) -> str:
+    回傳: [(icon, type_name, sources), ...]，依 SOURCE_TYPE_ORDER 排列且不含空組
     """
-    將原始檔案名稱格式化為易讀的顯示名稱
+    other_type = SOURCE_TYPE_ORDER[-1][1]
+    groups: Dict[str, List[Dict[str, Any]]] = {type_name: [] for _, type_name in SOURCE_TYPE_ORDER}
+    for source in sources:
+        groups.get(source.get('source_type'), groups[other_type]).append(source)
 
-    原始格式範例：
-    - 法令函釋: 2006-03-03_securities_bureau_law_amendment_fsc_law_201406240001
-    - 重要公告: 2019-01-02_insurance_bureau_ann_amendment_fsc_unk_20190102_1648
-    - 裁罰案件: 2025-09-25_insurance_bureau_penalty_fsc_pen_20250925_0001
+    return [
+        (icon, type_name, sorted(groups[type_name], key=lambda x: x.get('date', ''), reverse=True))
+        for icon, type_name in SOURCE_TYPE_ORDER
+        if groups[type_name]
+    ]
 
-    輸出格式：
-    - 法令函釋_2006-03-03
-    - 重要公告_2019-01-02
-    - 裁罰案件_2025-09-25
+
+def render_source_groups(type_config: List[tuple], limit: int = 0) -> int:
     """
-    if not raw_name:
-        return "未知文件"
+    顯示各類型的參考來源 expander
 
-    # 判斷來源類型
-    source_type = "未知"
-    if 'fsc_law' in raw_name or 'law_' in raw_name:
-        source_type = "法令函釋"
-    elif 'fsc_unk' in raw_name or 'ann_' in raw_name:
-        source_type = "重要公告"
-    elif 'fsc_pen' in raw_name or 'penalty' in raw_name:
-        source_type = "裁罰案件"
+    limit 為最多顯示的筆數（0 表示全部），回傳實際顯示的筆數
+    """
+    shown = 0
+    for icon, type_name, sources_list in type_config:
+        if limit and shown >= limit:
+            break
+        if limit:
+            sources_list = sources_list[:limit - shown]
+        shown += len(sources_list)
+
+        st.caption(f"{icon} {type_name} ({len(sources_list)} 筆)")
+        for source in sources_list:
+            with st.expander(
+                f"{icon} {source['filename']}",
+                expanded=False
+            ):
+                st.markdown(f"**相關內容：**")
+                st.markdown("\n\n".join(
+                    f"> {part[:300]}..." for part in source['snippet'].split(SNIPPET_SEPARATOR)
+                ))
+
+                if source['score'] < 1.0:
+                    st.caption(f"相似度: {source['score']:.2%}")
+
+                # 顯示原始網頁連結
+                if source.get('original_url'):
+                    st.markdown(f"[🔗 查看原始網頁]({source['original_url']})")
+
+    return shown
+
+
+def save_result(question: str, stores: List[str], filters: Dict[str, Any],
+                result: Dict[str, Any], route_text: str = ''):
+    """
+    將查詢結果存入 session 的查詢紀錄（最新在前），之後的 rerun 直接重新顯示，不必再查詢
+    """
+    history = st.session_state.setdefault('history', [])
+    history.insert(0, {
+        'question': question,
+        'stores': stores,
+        'filters': filters,
+        'result': result,
+        'route_text': route_text,
+    })
+    del history[QUERY_HISTORY_SIZE:]
+    st.session_state.history_index = 0
+    st.session_state.sources_shown = SOURCES_PAGE_SIZE
 
-    # 提取日期（格式：YYYY-MM-DD）
-    date = "未知日期"
-    parts = raw_name.split('_')
-    if parts and len(parts[0]) == 10 and '-' in parts[0]:
-        date = parts[0]
 
-    return f"{source_type}_{date}"
+def show_more_sources():
+    """「顯示更多來源」的 callback：多載入一頁來源"""
+    st.session_state.sources_shown = st.session_state.get('sources_shown', SOURCES_PAGE_SIZE) + SOURCES_PAGE_SIZE
 
 
-def extract_sources(response) -> List[Dict[str, Any]]:
+def render_similar_prompt(question: str, similar: Dict[str, Any]):
     """
-    從 Gemini 回應中提取來源
+    詢問是否沿用相似問題的答案（確認後下一次 rerun 才顯示）
     """
-    sources = []
+    st.info(
+        f"♻️ 找到相似的問題：「{similar['similar_question']}」（相似度 {similar['similarity']:.0%}）\n\n"
+        "使用相似問題的答案？"
+    )
+    col1, col2, _ = st.columns([1, 1, 4])
+    with col1:
+        st.button(
+            "♻️ 使用此答案",
+            key="accept_similar",
+            use_container_width=True,
+            on_click=lambda: st.session_state.update(similar_accepted=question)
+        )
+    with col2:
+        st.button(
+            "🔍 重新查詢",
+            key="reject_similar",
+            use_container_width=True,
+            help="不沿用相似問題的答案，以 AI 查詢",
+            on_click=lambda: st.session_state.update(refresh_requested=question)
+        )
 
-    try:
-        if hasattr(response, 'candidates') and len(response.candidates) > 0:
-            candidate = response.candidates[0]
 
-            if hasattr(candidate, 'grounding_metadata') and candidate.grounding_metadata:
-                metadata = candidate.grounding_metadata
+@fragment
+def render_history():
+    """
+    顯示查詢紀錄中選取的結果
 
-                if hasattr(metadata, 'grounding_chunks') and metadata.grounding_chunks:
-                    for i, chunk in enumerate(metadata.grounding_chunks):
-                        if hasattr(chunk, 'retrieved_context'):
-                            context = chunk.retrieved_context
+    以 fragment 渲染：切換紀錄、載入更多來源時只重新執行這個區塊
+    """
+    history = st.session_state.get('history') or []
+    if not history:
+        return
+
+    index = min(st.session_state.get('history_index', 0), len(history) - 1)
+    if len(history) > 1:
+        index = st.selectbox(
+            "🕘 查詢紀錄",
+            options=range(len(history)),
+            index=index,
+            format_func=lambda i: history[i]['question'][:40],
+        )
+        if index != st.session_state.get('history_index', 0):
+            st.session_state.history_index = index
+            st.session_state.sources_shown = SOURCES_PAGE_SIZE
+
+    entry = history[index]
+    if entry['route_text']:
+        st.caption(entry['route_text'])
+    render_result(
+        entry['result'], entry['stores'], entry['filters'],
+        source_limit=st.session_state.get('sources_shown', SOURCES_PAGE_SIZE),
+    )
 
-                            # 提取原始檔名/ID
-                            raw_id = ""
-                            if hasattr(context, 'title') and context.title:
-                                raw_id = context.title
-                            elif hasattr(context, 'uri') and context.uri:
-                                raw_id = context.uri.split('/')[-1]
 
-                            # 使用 mapping 解析顯示名稱
-                            display_name, source_type, date, original_url = resolve_source_display_name(raw_id)
+def render_lookup(lookup: Dict[str, Any], latency: float, question: str):
+    """
+    顯示本地查詢結果（發文字號 / 法規名稱）
+    """
+    matches = lookup['matches']
+    kind_text = "發文字號" if lookup['kind'] == 'document_number' else "法規名稱"
+
+    st.success(f"⚡ 已從本地索引找到 {len(matches)} 筆相符文件")
+    st.caption(f"⏱️ 回應時間: {latency * 1000:.1f} 毫秒　｜　🔎 比對方式: {kind_text}　｜　📌 {'、'.join(lookup['terms'])}")
+
+    st.markdown("---")
+
+    for doc in matches:
+        store = STORES.get(doc['store'], {})
+        icon = store.get('icon', '📄')
+        title = doc['law_name'] or doc['document_number'] or doc['doc_id']
+        with st.expander(f"{icon} {doc['date']} {title}", expanded=False):
+            if doc['law_name']:
+                st.markdown(f"**法規名稱：** {doc['law_name']}")
+            if doc['document_number']:
+                st.markdown(f"**發文字號：** {doc['document_number']}")
+            st.caption(
+                f"{store.get('display_name', '未知')}　｜　"
+                f"{SOURCE_LABELS.get(doc['source'], doc['source'])}　｜　"
+                f"{CATEGORY_LABELS.get(doc['category'], doc['category'])}"
+            )
+            if doc['original_url']:
+                st.markdown(f"[🔗 查看原始網頁]({doc['original_url']})")
+
+    # 使用 on_click：按鈕只在本次查詢時顯示，下一次 rerun 不會再渲染
+    st.button(
+        "🤖 改用 AI 查詢",
+        key="lookup_to_ai",
+        on_click=lambda: st.session_state.update(ai_requested=question)
+    )
 
-                            snippet = ""
-                            if hasattr(context, 'text') and context.text:
-                                snippet = context.text[:500]
 
-                            score = 1.0
-                            if hasattr(chunk, 'score'):
-                                score = float(chunk.score)
+def render_filters(selected_stores: List[str]):
+    """
+    渲染篩選條件（日期區間、來源單位、文件類別）
 
-                            sources.append({
-                                'filename': display_name,
-                                'raw_id': raw_id,
-                                'source_type': source_type,
-                                'date': date,
-                                'snippet': snippet,
-                                'score': score,
-                                'original_url': original_url,
-                            })
+    篩選條件只有下推至 File Search 才會縮小檢索範圍並影響答案，未啟用下推時不顯示；
+    勾選的資料來源有文件未帶 metadata 時停用篩選並提示
+    """
+    if not METADATA_FILTER_PUSHDOWN:
+        return
+
+    unsupported = filter_unsupported_stores(selected_stores)
+    with st.expander("🔎 篩選條件", expanded=has_filters(get_active_filters(selected_stores))):
+        if unsupported:
+            names = "、".join(STORES[s]['display_name'] for s in unsupported)
+            st.warning(f"⚠️ {names}的文件未帶篩選用的 metadata（需以 corpus_sync 重新匯入），勾選時無法使用篩選條件")
+
+        st.slider(
+            "📅 年份",
+            min_value=FILTER_MIN_YEAR,
+            max_value=FILTER_MAX_YEAR,
+            value=(FILTER_MIN_YEAR, FILTER_MAX_YEAR),
+            key="filter_years",
+            disabled=bool(unsupported)
+        )
+        st.multiselect(
+            "🏢 來源單位",
+            options=list(SOURCE_LABELS),
+            format_func=lambda key: SOURCE_LABELS[key],
+            key="filter_sources",
+            placeholder="全部",
+            disabled=bool(unsupported)
+        )
 
-    except Exception as e:
-        st.warning(f"提取來源時發生錯誤: {e}")
+        # 只列出勾選資料來源的類別
+        prefixes = [prefix for prefix, store in CATEGORY_PREFIX_STORES.items() if store in selected_stores]
+        categories = [key for key in CATEGORY_LABELS if key.startswith(tuple(prefixes))]
+        st.multiselect(
+            "🗂️ 文件類別",
+            options=categories,
+            format_func=lambda key: CATEGORY_LABELS[key],
+            key="filter_categories",
+            placeholder="全部",
+            disabled=bool(unsupported)
+        )
 
-    return sources
 
+def get_active_filters(selected_stores: List[str]) -> Dict[str, Any]:
+    """
+    從側邊欄取得目前的篩選條件（無法套用至勾選的資料來源時為空）
 
-def render_sidebar():
+    回傳: {'year_range': (起, 迄) 或 None, 'sources': [...], 'categories': [...]}
+    """
+    if filter_unsupported_stores(selected_stores):
+        return {'year_range': None, 'sources': [], 'categories': []}
+
+    year_range = st.session_state.get('filter_years')
+    if year_range and tuple(year_range) == (FILTER_MIN_YEAR, FILTER_MAX_YEAR):
+        year_range = None
+    return {
+        'year_range': tuple(year_range) if year_range else None,
+        'sources': list(st.session_state.get('filter_sources') or []),
+        'categories': list(st.session_state.get('filter_categories') or []),
+    }
+
+
+def describe_filters(filters: Dict[str, Any]) -> str:
+    """篩選條件的顯示文字"""
+    parts = []
+    if filters.get('year_range'):
+        parts.append(f"{filters['year_range'][0]}–{filters['year_range'][1]} 年")
+    if filters.get('sources'):
+        parts.append("、".join(SOURCE_LABELS.get(s, s) for s in filters['sources']))
+    if filters.get('categories'):
+        parts.append("、".join(CATEGORY_LABELS.get(c, c) for c in filters['categories']))
+    return "，".join(parts)
+
+
+def render_sidebar(precomputer: Optional[ExamplePrecomputer] = None):
     """渲染側邊欄"""
     with st.sidebar:
         st.header("📊 資料來源")
@@ -416,6 +643,39 @@ def render_sidebar():
             total_docs = sum(STORES[s]['count'] for s in selected_stores)
             st.metric("📚 文件總數", f"{total_docs:,}")
 
+            if len(selected_stores) > 1:
+                st.toggle(
+                    "🧭 自動選擇資料來源",
+                    value=ROUTER_AUTO_DEFAULT,
+                    key="auto_route",
+                    help="依問題內容從勾選的資料來源中挑選相關的部分查詢，無法判斷時查詢全部"
+                )
+                st.toggle(
+                    "⚡ 分別查詢各資料來源",
+                    value=FANOUT_ENABLED,
+                    key="fanout_mode",
+                    help="並行查詢每個資料來源，合併排序參考來源後產生單一答案"
+                )
+
+            render_filters(selected_stores)
+
+            conversation_mode = st.toggle(
+                "💬 多輪對話",
+                value=CONVERSATION_ENABLED,
+                key="conversation_mode",
+                help="保留先前的問答作為脈絡，可直接追問（例如「第二個案例的罰鍰是多少？」）"
+            )
+            if conversation_mode:
+                conversation_stats = get_conversation().stats()
+                st.caption(
+                    f"💬 已對話 {conversation_stats['turns']} 輪（壓縮 {conversation_stats['summarized']} 輪）　"
+                    f"脈絡約 {conversation_stats['context_tokens']:,} / {conversation_stats['budget']:,} tokens　"
+                    f"參考過 {conversation_stats['documents']} 份文件"
+                )
+                if st.button("🆕 開始新對話", use_container_width=True):
+                    st.session_state.pop('conversation', None)
+                    st.rerun()
+
             with st.expander("ℹ️ 資料說明", expanded=False):
                 for key in selected_stores:
                     store = STORES[key]
@@ -442,6 +702,69 @@ def render_sidebar():
             - **重要公告**：金管會政策公告
             """)
 
+        # 快取統計
+        if ANSWER_CACHE_ENABLED:
+            stats = get_answer_cache().stats()
+            st.caption(
+                f"🗄️ 快取：{stats['entries']:,} 筆　命中率 {stats['hit_rate']:.0%} "
+                f"({stats['hits']:,}/{stats['hits'] + stats['misses']:,})"
+            )
+
+        # 相似問題統計
+        if ANSWER_CACHE_ENABLED and NEAR_DUPLICATE_ENABLED:
+            similar_stats = get_near_duplicate_index().stats()
+            st.caption(
+                f"♻️ 相似問題 {similar_stats['entries']:,} 筆　找到 "
+                f"{similar_stats['matches']:,}/{similar_stats['lookups']:,} 次　"
+                f"關鍵細節不同 {similar_stats['rejected']:,} 次"
+            )
+
+        # 重試統計
+        retry_stats = get_retry_policy().stats()
+        st.caption(
+            f"🔁 重試 {retry_stats['retries']:,} 次　hedge 勝出 "
+            f"{retry_stats['hedge_wins']:,}/{retry_stats['hedges']:,}　"
+            f"hedge 延遲 {retry_stats['hedge_delay']:.1f} 秒"
+        )
+
+        # 准入控制統計
+        if ADMISSION_ENABLED:
+            admission_stats = get_admission_controller().stats()
+            st.caption(
+                f"🚦 排隊中 {admission_stats['waiting']:,} 筆　拒絕 {admission_stats['rejected']:,} 次　"
+                f"平均等待 {admission_stats['avg_wait']:.1f} 秒"
+            )
+
+        # 相同查詢合併統計
+        if SINGLE_FLIGHT_ENABLED:
+            flight_stats = get_single_flight().stats()
+            st.caption(
+                f"🔗 合併相同查詢 {flight_stats['coalesced']:,}/{flight_stats['requests']:,} 次"
+                f"（{flight_stats['coalesce_rate']:.0%}）"
+            )
+
+        # 範例問題預先計算
+        if precomputer is not None:
+            example_stats = precomputer.stats()
+            oldest_text = (f"　最舊 {example_stats['oldest_age'] / 60:.0f} 分鐘前"
+                           if example_stats['oldest_age'] is not None else "")
+            st.caption(f"📌 範例預先計算 {example_stats['ready']}/{example_stats['total']} 組{oldest_text}")
+
+        # 各階段延遲
+        if METRICS_PANEL:
+            with st.expander("📈 各階段延遲", expanded=False):
+                for phase, summary in metrics.registry.phase_summary().items():
+                    st.caption(
+                        f"{phase}: p50 {summary['p50']:.2f} / p95 {summary['p95']:.2f} 秒　"
+                        f"({summary['count']:,} 次)"
+                    )
+                counters = metrics.registry.counters()
+                if counters.get('queries'):
+                    st.caption(
+                        f"錯誤率 {counters.get('query_errors', 0) / counters['queries']:.1%}　"
+                        f"無來源 {counters.get('empty_sources', 0) / counters['queries']:.1%}"
+                    )
+
         st.markdown("---")
         st.caption("🤖 AI 智能問答系統")
         st.caption("⚠️ 本系統僅供參考")
@@ -452,14 +775,32 @@ def render_sidebar():
 def main():
     """主程式"""
     # 取得 API Key
-    api_key = st.secrets.get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY")
+    api_key = get_setting("GEMINI_API_KEY", "")
+    if not api_key and GEMINI_BACKEND == 'replay':
+        # 回放模式不連網，不需要 API Key
+        api_key = 'replay'
 
     if not api_key:
         st.error("請設定 GEMINI_API_KEY")
         st.stop()
 
+    if GEMINI_WARM_UP:
+        start_client_warm_up(api_key)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    precomputer = None
+    if EXAMPLE_PRECOMPUTE_ENABLED:
+        precomputer = get_example_precomputer(
+            api_key, tuple(EXAMPLE_QUESTIONS), EXAMPLE_PRECOMPUTE_INTERVAL, EXAMPLE_PRECOMPUTE_BUDGET
+        )
+
+    # 准入控制依 session 輪流放行
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
     # 渲染側邊欄
-    selected_stores = render_sidebar()
+    selected_stores = render_sidebar(precomputer)
+    filters = get_active_filters(selected_stores)
 
     # 主標題
     st.title("🏛️ 金管會智能問答")
@@ -489,102 +830,127 @@ def main():
     with col2:
         if st.button("🗑️ 清除", use_container_width=True):
             st.session_state.current_question = ""
+            st.session_state.history = []
             st.rerun()
 
+    # 「改用 AI 查詢」略過本地查詢
+    ai_requested = st.session_state.pop('ai_requested', None) == question
+    # 點選範例問題時直接查詢（有預先計算的結果時立即顯示）
+    example_requested = st.session_state.pop('example_requested', None) == question
+    # 「重新查詢」不沿用相似問題的答案；「使用此答案」確認沿用
+    refresh_requested = st.session_state.pop('refresh_requested', None) == question
+    similar_accepted = st.session_state.pop('similar_accepted', None) == question
+
     # 處理查詢
-    if submit_button and question:
+    if (submit_button or ai_requested or example_requested or refresh_requested or similar_accepted) and question:
         if not selected_stores:
             st.error("請至少選擇一個資料來源")
         else:
-            with st.spinner("🔍 AI 查詢中..."):
-                result = query_gemini(question, selected_stores, api_key)
-
-            if result['error']:
-                st.error(result['answer'])
+            # 發文字號 / 法規名稱本地查詢
+            lookup = None
+            if (LOOKUP_ENABLED or LOOKUP_HINT_ENABLED) and not ai_requested:
+                doc_lookup = get_doc_lookup()
+                lookup_start = time.time()
+                lookup = doc_lookup.match(question) if doc_lookup is not None else None
+                if lookup is not None and has_filters(filters):
+                    lookup['matches'] = apply_source_filters(lookup['matches'], filters)
+                    if not lookup['matches']:
+                        lookup = None
+                lookup_latency = time.time() - lookup_start
+
+            if LOOKUP_ENABLED and lookup is not None and lookup['pure']:
+                render_lookup(lookup, lookup_latency, question)
             else:
-                # 顯示結果
-                st.success("✅ 查詢完成")
-
-                # 指標欄（使用較小字體）
-                stores_text = ", ".join([STORES[s]['display_name'] for s in selected_stores])
-                st.caption(f"⏱️ 回應時間: {result['latency']:.2f} 秒　｜　📚 來源數量: {len(result['sources'])} 筆　｜　📂 查詢範圍: {stores_text}")
-
-                st.markdown("---")
-
-                # 答案
-                st.subheader("📝 答案")
-                st.markdown(result['answer'])
-
-                st.markdown("---")
-
-                # 來源（按類型分組，各組按時間排序）
-                if result['sources']:
-                    st.subheader(f"📚 參考來源 ({len(result['sources'])} 筆)")
-
-                    # 按類型分組
-                    penalties = [s for s in result['sources'] if s.get('source_type') == "裁罰案件"]
-                    law_interps = [s for s in result['sources'] if s.get('source_type') == "法令函釋"]
-                    announcements = [s for s in result['sources'] if s.get('source_type') == "重要公告"]
-                    others = [s for s in result['sources'] if s.get('source_type') not in ["裁罰案件", "法令函釋", "重要公告"]]
-
-                    # 各組按日期排序（最新到最舊）
-                    for group in [penalties, law_interps, announcements, others]:
-                        group.sort(key=lambda x: x.get('date', ''), reverse=True)
-
-                    # 依序顯示：裁罰 → 函釋 → 公告 → 其他
-                    type_config = [
-                        ("⚖️", "裁罰案件", penalties),
-                        ("📜", "法令函釋", law_interps),
-                        ("📢", "重要公告", announcements),
-                        ("📄", "其他", others),
-                    ]
-
-                    for icon, type_name, sources_list in type_config:
-                        if not sources_list:
-                            continue
-
-                        st.caption(f"{icon} {type_name} ({len(sources_list)} 筆)")
-                        for source in sources_list:
-                            with st.expander(
-                                f"{icon} {source['filename']}",
-                                expanded=False
-                            ):
-                                st.markdown(f"**相關內容：**")
-                                st.markdown(f"> {source['snippet'][:300]}...")
-
-                                if source['score'] < 1.0:
-                                    st.caption(f"相似度: {source['score']:.2%}")
-
-                                # 顯示原始網頁連結
-                                if source.get('original_url'):
-                                    st.markdown(f"[🔗 查看原始網頁]({source['original_url']})")
-                else:
-                    # sources=0 自動重試
-                    st.warning("⚠️ 未找到參考來源，正在重試...")
-                    with st.spinner("重新查詢中..."):
-                        result2 = query_gemini(question, selected_stores, api_key)
-
-                    if result2['sources']:
-                        st.success("✅ 重試成功")
-                        st.markdown(result2['answer'])
-
-                        # 按類型分組並排序
-                        penalties2 = sorted([s for s in result2['sources'] if s.get('source_type') == "裁罰案件"], key=lambda x: x.get('date', ''), reverse=True)
-                        law_interps2 = sorted([s for s in result2['sources'] if s.get('source_type') == "法令函釋"], key=lambda x: x.get('date', ''), reverse=True)
-                        announcements2 = sorted([s for s in result2['sources'] if s.get('source_type') == "重要公告"], key=lambda x: x.get('date', ''), reverse=True)
-                        others2 = sorted([s for s in result2['sources'] if s.get('source_type') not in ["裁罰案件", "法令函釋", "重要公告"]], key=lambda x: x.get('date', ''), reverse=True)
-
-                        for icon, type_name, sources_list in [("⚖️", "裁罰案件", penalties2), ("📜", "法令函釋", law_interps2), ("📢", "重要公告", announcements2), ("📄", "其他", others2)]:
-                            if not sources_list:
-                                continue
-                            st.caption(f"{icon} {type_name} ({len(sources_list)} 筆)")
-                            for source in sources_list:
-                                with st.expander(f"{icon} {source['filename']}"):
-                                    st.markdown(f"> {source['snippet'][:300]}...")
-                                    if source.get('original_url'):
-                                        st.markdown(f"[🔗 查看原始網頁]({source['original_url']})")
-                    else:
-                        st.info("你查詢的問題在目前的文件庫中沒有合適的結果，請嘗試換個方式描述您的問題。")
+                query_stores = selected_stores
+                route_text = ''
+                if len(selected_stores) > 1 and st.session_state.get('auto_route', ROUTER_AUTO_DEFAULT):
+                    route = get_store_router().route(question, selected_stores)
+                    query_stores = route['stores']
+                    routed_text = ", ".join(STORES[s]['display_name'] for s in query_stores)
+                    fallback_text = "（信心不足，查詢全部）" if route['fallback'] else ""
+                    route_text = f"🧭 自動選擇: {routed_text}{fallback_text}　信心 {route['confidence']:.0%}"
+                route_placeholder = st.empty()
+                if route_text:
+                    route_placeholder.caption(route_text)
+
+                query_text = question
+                if LOOKUP_HINT_ENABLED and lookup is not None:
+                    query_text = question + build_lookup_hint(lookup['matches'])
+
+                # 多輪對話：加上先前的對話脈絡，追問上一輪文件時沿用其來源
+                conversation = None
+                if st.session_state.get('conversation_mode', CONVERSATION_ENABLED):
+                    conversation = get_conversation()
+                context_sources = None
+                if conversation is not None:
+                    # 沿用的來源不是在目前的篩選條件下檢索的，有篩選條件時重新檢索
+                    if CONVERSATION_REUSE_CONTEXT and not has_filters(filters):
+                        context_sources = conversation.reusable_sources(question) or None
+                    query_text = conversation.build_prompt(query_text)
+
+                plain_question = query_text == question and not context_sources and not has_filters(filters)
+                # 相似問題的答案需使用者確認後才沿用（問法相近不代表是同一個問題）
+                similar = None
+                if plain_question and not refresh_requested and not similar_accepted and not example_requested:
+                    similar = find_similar_answer(question, query_stores)
+                if similar is not None:
+                    route_placeholder.empty()
+                    render_similar_prompt(question, similar)
+                    render_history()
+                    return
+
+                with metrics.trace_query(query_stores, filtered=has_filters(filters)):
+                    result = None
+                    if example_requested and plain_question:
+                        result = get_precomputed_example(precomputer, question, query_stores)
+                    if result is None and plain_question and similar_accepted:
+                        result = find_similar_answer(question, query_stores)
+                        if result is not None:
+                            metrics.annotate(mode='similar')
+                    if result is None:
+                        result = run_query(query_text, query_stores, api_key, filters, context_sources)
+                    if conversation is not None:
+                        result['conversation'] = {
+                            'turn': conversation.turn_count + 1,
+                            'context_tokens': conversation.context_tokens(),
+                            'budget': conversation.token_budget,
+                        }
+                        metrics.annotate(
+                            turn=result['conversation']['turn'],
+                            context_tokens=result['conversation']['context_tokens'],
+                            context_reused=bool(result.get('context_reused')),
+                        )
+                    metrics.annotate(
+                        sources=len(result['sources']),
+                        attempts=result.get('attempts', 1),
+                        cached=bool(result.get('cached')),
+                        error=bool(result.get('error')),
+                        input_tokens=result.get('input_tokens'),
+                        output_tokens=result.get('output_tokens'),
+                    )
+                    save_result(question, query_stores, filters, result, route_text)
+                    route_placeholder.empty()
+                    render_history()
+
+                # 使用 on_click：按鈕只在本次查詢時顯示，下一次 rerun 不會再渲染
+                if result.get('similar_question'):
+                    st.button(
+                        "🔄 重新查詢",
+                        key="refresh_similar",
+                        help="不沿用相似問題的答案，重新以 AI 查詢",
+                        on_click=lambda: st.session_state.update(refresh_requested=question)
+                    )
+
+                # 答案顯示後才壓縮對話脈絡，不增加這一輪的等待時間
+                if conversation is not None and not result['error']:
+                    conversation.add_turn(
+                        question, result['answer'], result['sources'],
+                        summarizer=lambda prompt: summarize_conversation(prompt, api_key),
+                    )
+
+    # 之前的查詢結果（sidebar 或其他互動造成的 rerun 不重新查詢）
+    elif st.session_state.get('history'):
+        render_history()
 
     # 範例問題
     if not question:
@@ -597,6 +963,8 @@ def main():
             with col:
                 if st.button(f"📌 {eq}", key=f"example_{idx}", use_container_width=True):
                     st.session_state.current_question = eq
+                    if EXAMPLE_PRECOMPUTE_ENABLED:
+                        st.session_state.example_requested = eq
                     st.rerun()
 
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Mapping 索引
+
+將 data/ 下三種資料類型的 mapping JSON 編譯為單一 SQLite 索引，
+執行時以唯讀方式查詢，不必每次啟動都解析數 MB 的 JSON 並在記憶體中建立巢狀 dict。
+
+- gemini_ids: gemini_short_id → doc_id
+- documents:  doc_id → 顯示名稱、日期、來源單位、類別、原始網址、所屬 Store
+- strings:    來源單位 / 類別等重複字串只存一份（interned）
+
+索引記錄來源 JSON 的修改時間與大小（fingerprint），來源更新後會自動重建。
+
+離線建置：
+    python app/mapping_index.py [--data DATA_DIR] [--output INDEX_PATH]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_DATA_PATH = Path(__file__).parent.parent / "data"
+DEFAULT_INDEX_PATH = Path(__file__).parent.parent / ".cache" / "mapping_index.sqlite3"
+
+# 各資料類型的 mapping 檔案（相對於 data/）
+SOURCE_FILES = [
+    ('penalties', 'penalties/gemini_id_mapping.json'),
+    ('penalties', 'penalties/file_mapping.json'),
+    ('law_interpretations', 'law_interpretations/gemini_id_mapping_new.json'),
+    ('announcements', 'announcements/gemini_id_mapping_new.json'),
+]
+
+# corpus_sync 產生的整合 mapping，存在時優先於上述舊格式
+UNIFIED_MAPPING_FILE = 'corpus_mapping.json'
+
+SCHEMA_VERSION = '1'
+
+
+def mapping_fingerprint(data_path: Path = DEFAULT_DATA_PATH) -> str:
+    """
+    以來源 JSON 的修改時間與大小產生 fingerprint，檔案變動時 fingerprint 隨之改變
+    """
+    parts = [SCHEMA_VERSION]
+    for rel_path in [rel_path for _, rel_path in SOURCE_FILES] + [UNIFIED_MAPPING_FILE]:
+        path = Path(data_path) / rel_path
+        if path.exists():
+            stat = path.stat()
+            parts.append(f"{rel_path}:{stat.st_mtime_ns}:{stat.st_size}")
+    return '|'.join(parts)
+
+
+def iter_mapping_records(data_path: Path = DEFAULT_DATA_PATH) -> Iterator[Tuple[str, str, str, Optional[Dict[str, Any]]]]:
+    """
+    逐筆讀取 mapping JSON
+
+    產生: (store, doc_id, gemini_short_id, info)，info 為 None 表示只有 ID 對應
+    """
+    data_path = Path(data_path)
+
+    # === 裁罰案件 (舊格式) ===
+    # gemini_id_mapping.json: {files/xxx: doc_id}
+    penalties_gemini = data_path / 'penalties' / 'gemini_id_mapping.json'
+    if penalties_gemini.exists():
+        with open(penalties_gemini, 'r', encoding='utf-8') as f:
+            for full_id, doc_id in json.load(f).items():
+                yield 'penalties', doc_id, full_id.replace('files/', ''), None
+
+    # file_mapping.json: {doc_id: info}
+    penalties_files = data_path / 'penalties' / 'file_mapping.json'
+    if penalties_files.exists():
+        with open(penalties_files, 'r', encoding='utf-8') as f:
+            for doc_id, info in json.load(f).items():
+                yield 'penalties', doc_id, '', info
+
+    # === 法令函釋 / 重要公告 ===
+    for store, rel_path in SOURCE_FILES[2:]:
+        path = data_path / rel_path
+        if not path.exists():
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for doc_id, info in json.load(f).items():
+                short_id = (info.get('gemini_file_id') or '').replace('files/', '')
+                yield store, doc_id, short_id, info
+
+    # === 整合 mapping（最後產生，覆蓋舊格式的同一文件；舊的 file ID 仍可解析）===
+    unified = data_path / UNIFIED_MAPPING_FILE
+    if unified.exists():
+        with open(unified, 'r', encoding='utf-8') as f:
+            for doc_id, info in json.load(f).items():
+                short_id = (info.get('gemini_file_id') or '').replace('files/', '')
+                yield info.get('store') or '', doc_id, short_id, info
+
+
+def build_index(data_path: Path = DEFAULT_DATA_PATH, index_path: Path = DEFAULT_INDEX_PATH) -> Dict[str, int]:
+    """
+    編譯 mapping 索引，先寫入暫存檔再以 os.replace 原子替換
+
+    回傳: {'documents': ..., 'gemini_ids': ..., 'strings': ...}
+    """
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    fingerprint = mapping_fingerprint(data_path)
+    strings: Dict[str, int] = {}
+
+    def intern_id(value: str) -> int:
+        if value not in strings:
+            strings[value] = len(strings) + 1
+        return strings[value]
+
+    gemini_ids: Dict[str, str] = {}
+    documents: Dict[str, tuple] = {}
+
+    for store, doc_id, short_id, info in iter_mapping_records(data_path):
+        if short_id:
+            gemini_ids[short_id] = doc_id
+        if info is not None:
+            documents[doc_id] = (
+                doc_id,
+                intern_id(store),
+                info.get('display_name') or '',
+                info.get('date') or '',
+                intern_id(info.get('source') or ''),
+                intern_id(info.get('category') or ''),
+                info.get('original_url') or '',
+            )
+
+    conn = sqlite3.connect(str(tmp_path))
+    try:
+        with conn:
+            conn.executescript("""
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE gemini_ids (short_id TEXT PRIMARY KEY, doc_id TEXT NOT NULL) WITHOUT ROWID;
+                CREATE TABLE documents (
+                    doc_id TEXT PRIMARY KEY,
+                    store_id INTEGER NOT NULL,
+                    display_name TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    source_id INTEGER NOT NULL,
+                    category_id INTEGER NOT NULL,
+                    original_url TEXT NOT NULL
+                ) WITHOUT ROWID;
+            """)
+            conn.executemany('INSERT INTO strings (id, value) VALUES (?, ?)',
+                             [(i, v) for v, i in strings.items()])
+            conn.executemany('INSERT INTO gemini_ids (short_id, doc_id) VALUES (?, ?)',
+                             gemini_ids.items())
+            conn.executemany('INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             documents.values())
+            conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', [
+                ('fingerprint', fingerprint),
+                ('built_at', str(time.time())),
+            ])
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, index_path)
+    return {'documents': len(documents), 'gemini_ids': len(gemini_ids), 'strings': len(strings)}
+
+
+def read_fingerprint(index_path: Path) -> Optional[str]:
+    """讀取索引中記錄的 fingerprint，索引不存在或損毀時回傳 None"""
+    if not Path(index_path).exists():
+        return None
+    try:
+        conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+class MappingIndex:
+    """
+    唯讀 mapping 索引（每個 thread 使用各自的 SQLite 連線）
+    """
+
+    def __init__(self, index_path: Path = DEFAULT_INDEX_PATH):
+        self.index_path = Path(index_path)
+        self._local = threading.local()
+        self.resolve = lru_cache(maxsize=4096)(self._resolve)
+
+        conn = self._conn()
+        # 字串表很小，直接載入記憶體並 intern
+        self._strings = {
+            i: sys.intern(v) for i, v in conn.execute('SELECT id, value FROM strings')
+        }
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def _resolve(self, short_id: str) -> str:
+        """gemini_short_id → doc_id，找不到回傳空字串"""
+        row = self._conn().execute(
+            'SELECT doc_id FROM gemini_ids WHERE short_id = ?', (short_id,)
+        ).fetchone()
+        return row[0] if row else ''
+
+    def _row_to_info(self, row: tuple) -> Dict[str, str]:
+        doc_id, store_id, display_name, date, source_id, category_id, original_url = row
+        return {
+            'doc_id': doc_id,
+            'store': self._strings.get(store_id, ''),
+            'display_name': display_name,
+            'date': date,
+            'source': self._strings.get(source_id, ''),
+            'category': self._strings.get(category_id, ''),
+            'original_url': original_url,
+        }
+
+    def get_document(self, doc_id: str) -> Optional[Dict[str, str]]:
+        """doc_id → 文件資訊，找不到回傳 None"""
+        row = self._conn().execute(
+            'SELECT * FROM documents WHERE doc_id = ?', (doc_id,)
+        ).fetchone()
+        return self._row_to_info(row) if row else None
+
+    def __contains__(self, doc_id: str) -> bool:
+        return self.get_document(doc_id) is not None
+
+    def count(self) -> int:
+        """文件筆數"""
+        return self._conn().execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+
+def load_index(data_path: Path = DEFAULT_DATA_PATH, index_path: Path = DEFAULT_INDEX_PATH) -> MappingIndex:
+    """
+    開啟 mapping 索引；索引不存在或與來源 JSON 不一致時先重建
+    """
+    if read_fingerprint(index_path) != mapping_fingerprint(data_path):
+        build_index(data_path, index_path)
+    return MappingIndex(index_path)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='編譯 mapping 索引')
+    parser.add_argument('--data', default=str(DEFAULT_DATA_PATH), help='資料目錄')
+    parser.add_argument('--output', default=str(DEFAULT_INDEX_PATH), help='索引輸出路徑')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+    counts = build_index(Path(args.data), Path(args.output))
+    print(f"✅ 已建立 {args.output}")
+    print(f"   文件 {counts['documents']:,} 筆 / Gemini ID {counts['gemini_ids']:,} 筆 / 字串 {counts['strings']:,} 筆")
+    print(f"   耗時 {time.time() - start_time:.2f} 秒")
+
+
+if __name__ == '__main__':
+    main()
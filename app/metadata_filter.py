@@ -0,0 +1,90 @@
+"""
+Metadata 篩選
+
+將側邊欄的日期（年份）區間、來源單位、文件類別篩選條件：
+- 轉為 File Search 的 metadata_filter 運算式，在檢索時就排除不相關的文件
+  （文件上傳時需帶有 custom_metadata：source、category、year）
+- 對回傳的來源再做一次本地篩選，排除未帶 metadata 而漏網的段落
+
+篩選條件格式:
+    {'year_range': (2023, 2025) 或 None, 'sources': [...], 'categories': [...]}
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+
+def has_filters(filters: Optional[Dict[str, Any]]) -> bool:
+    """是否有任何篩選條件"""
+    return bool(filters) and bool(
+        filters.get('year_range') or filters.get('sources') or filters.get('categories')
+    )
+
+
+def filters_key(filters: Optional[Dict[str, Any]]) -> str:
+    """篩選條件的穩定字串表示，用於快取 key"""
+    if not has_filters(filters):
+        return ''
+    return json.dumps({
+        'year_range': list(filters['year_range']) if filters.get('year_range') else None,
+        'sources': sorted(filters.get('sources') or []),
+        'categories': sorted(filters.get('categories') or []),
+    }, sort_keys=True)
+
+
+def _any_of(field: str, values: List[str]) -> str:
+    clauses = [f'{field} = "{value}"' for value in sorted(values)]
+    if len(clauses) == 1:
+        return clauses[0]
+    return "(" + " OR ".join(clauses) + ")"
+
+
+def build_metadata_filter(filters: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    產生 File Search metadata_filter 運算式（AIP-160 語法），沒有篩選條件時回傳 None
+
+    例如: (source = "bank_bureau") AND year >= 2023 AND year <= 2025
+    """
+    if not has_filters(filters):
+        return None
+
+    clauses = []
+    if filters.get('sources'):
+        clauses.append(_any_of('source', filters['sources']))
+    if filters.get('categories'):
+        clauses.append(_any_of('category', filters['categories']))
+    if filters.get('year_range'):
+        start, end = filters['year_range']
+        clauses.append(f"year >= {int(start)} AND year <= {int(end)}")
+
+    return " AND ".join(clauses)
+
+
+def source_matches(source: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    """
+    判斷單一來源是否符合篩選條件
+
+    只排除 metadata 已知且不符合的來源；mapping 中查不到的欄位視為符合
+    """
+    year_range = filters.get('year_range')
+    date = source.get('date') or ''
+    if year_range and date[:4].isdigit():
+        if not year_range[0] <= int(date[:4]) <= year_range[1]:
+            return False
+
+    bureau = source.get('source')
+    if filters.get('sources') and bureau and bureau not in filters['sources']:
+        return False
+
+    category = source.get('category')
+    if filters.get('categories') and category and category not in filters['categories']:
+        return False
+
+    return True
+
+
+def apply_source_filters(sources: List[Dict[str, Any]], filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """本地篩選來源"""
+    if not has_filters(filters):
+        return sources
+    return [source for source in sources if source_matches(source, filters)]
@@ -0,0 +1,331 @@
+"""
+各階段延遲量測與指標輸出
+
+每次查詢以 trace_query() 建立一個 trace，期間以 span() 記錄各階段耗時
+（Client 建立、mapping 載入、快取查詢、Gemini 呼叫、來源提取、來源渲染等），
+並標記 Store 組合、來源數與是否為重試。
+
+- 每次查詢寫入一行 JSON 至輪替記錄檔（METRICS_LOG_PATH）
+- 各階段延遲累計為 histogram，可輸出 Prometheus 文字格式
+  （METRICS_PORT 不為 0 時於背景提供 /metrics）
+
+trace 透過 contextvars 傳遞；重試策略的 thread 與共用 event loop 會帶入呼叫端的 context。
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from settings import get_setting
+
+METRICS_ENABLED = get_setting('METRICS_ENABLED', True)
+METRICS_LOG_PATH = get_setting(
+    'METRICS_LOG_PATH',
+    str(Path(__file__).parent.parent / '.cache' / 'metrics.jsonl'),
+)
+METRICS_LOG_MAX_BYTES = get_setting('METRICS_LOG_MAX_BYTES', 10 * 1024 * 1024)
+METRICS_LOG_BACKUPS = get_setting('METRICS_LOG_BACKUPS', 5)
+
+# histogram 上界（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# 目前的嘗試序號（由重試策略設定，0 為第一次嘗試）
+attempt_index: ContextVar[int] = ContextVar('attempt_index', default=0)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    累計型 histogram（Prometheus 語意：bucket 為 <= 上界的累計次數）
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """由 bucket 線性內插估計百分位數"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        prev_bound, prev_count = 0.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                if count == prev_count:
+                    return bound
+                return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+            prev_bound, prev_count = bound, count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    各階段延遲 histogram 與查詢計數（thread-safe，每個 process 一個）
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, phase: str, seconds: float, stores: str = ''):
+        with self._lock:
+            key = (phase, stores)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(self.buckets)
+            self._histograms[key].observe(seconds)
+
+    def incr(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def phase_summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        依階段彙總（合併各 Store 組合）
+
+        回傳: {phase: {'count', 'mean', 'p50', 'p95', 'p99'}}
+        """
+        with self._lock:
+            merged: Dict[str, Histogram] = {}
+            for (phase, _), hist in self._histograms.items():
+                total = merged.setdefault(phase, Histogram(self.buckets))
+                total.count += hist.count
+                total.sum += hist.sum
+                total.counts = [a + b for a, b in zip(total.counts, hist.counts)]
+
+        return {
+            phase: {
+                'count': hist.count,
+                'mean': hist.sum / hist.count if hist.count else 0.0,
+                'p50': hist.quantile(0.50),
+                'p95': hist.quantile(0.95),
+                'p99': hist.quantile(0.99),
+            }
+            for phase, hist in sorted(merged.items())
+        }
+
+    def counters(self) -> Dict[str, float]:
+        """各計數器的總和（合併 label）"""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for (name, _), value in self._counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def render_prometheus(self) -> str:
+        """輸出 Prometheus 文字格式"""
+        lines = [
+            '# HELP fsc_qa_phase_duration_seconds 查詢各階段耗時',
+            '# TYPE fsc_qa_phase_duration_seconds histogram',
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        for (phase, stores), hist in histograms:
+            labels = f'phase="{phase}",stores="{stores}"'
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'fsc_qa_phase_duration_seconds_bucket{{{labels},le="{bound:g}"}} {count}')
+            lines.append(f'fsc_qa_phase_duration_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f'fsc_qa_phase_duration_seconds_sum{{{labels}}} {hist.sum:.6f}')
+            lines.append(f'fsc_qa_phase_duration_seconds_count{{{labels}}} {hist.count}')
+
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f'fsc_qa_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{metric}{{{label_text}}} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class QueryTrace:
+    """
+    單次查詢的各階段紀錄
+    """
+
+    def __init__(self, stores: List[str], **tags: Any):
+        self.stores = '+'.join(sorted(stores))
+        self.tags: Dict[str, Any] = dict(tags)
+        self.spans: List[Dict[str, Any]] = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, phase: str, duration: float, tags: Dict[str, Any]):
+        with self._lock:
+            self.spans.append({'phase': phase, 'duration': round(duration, 6), **tags})
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+
+_current_trace: ContextVar[Optional[QueryTrace]] = ContextVar('current_trace', default=None)
+
+_log_lock = threading.Lock()
+_log_handler: Optional[RotatingFileHandler] = None
+
+
+def _write_log(record: Dict[str, Any]):
+    """寫入一行 JSON 至輪替記錄檔"""
+    global _log_handler
+    if not METRICS_LOG_PATH:
+        return
+    try:
+        with _log_lock:
+            if _log_handler is None:
+                Path(METRICS_LOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+                _log_handler = RotatingFileHandler(
+                    METRICS_LOG_PATH, maxBytes=METRICS_LOG_MAX_BYTES,
+                    backupCount=METRICS_LOG_BACKUPS, encoding='utf-8',
+                )
+            _log_handler.emit(logging.makeLogRecord({
+                'msg': json.dumps(record, ensure_ascii=False, default=str),
+                'levelno': logging.INFO,
+                'levelname': 'INFO',
+            }))
+    except Exception as e:
+        logger.warning("寫入 metrics 記錄失敗: %s", e)
+
+
+def record_span(phase: str, duration: float, stores: Optional[List[str]] = None, **tags: Any):
+    """
+    記錄一個階段的耗時
+
+    有進行中的 trace 時併入該次查詢的紀錄；否則單獨寫入記錄檔（例如 Client 建立）。
+    stores 可覆寫 Store 組合標籤（例如分別查詢時的單一 Store）。
+    """
+    if not METRICS_ENABLED:
+        return
+
+    trace = _current_trace.get()
+    if stores is not None:
+        stores_label = '+'.join(sorted(stores))
+    else:
+        stores_label = trace.stores if trace is not None else ''
+
+    registry.observe(phase, duration, stores_label)
+
+    tags['retry'] = attempt_index.get() > 0
+    if stores is not None:
+        tags['stores'] = stores_label
+    if trace is not None:
+        trace.add_span(phase, duration, tags)
+    else:
+        _write_log({'ts': time.time(), 'phase': phase, 'duration': round(duration, 6), **tags})
+
+
+@contextmanager
+def span(phase: str, stores: Optional[List[str]] = None, **tags: Any) -> Iterator[Dict[str, Any]]:
+    """
+    量測區塊耗時；yield 的 dict 可在區塊內補充標籤（例如來源數）
+    """
+    start = time.perf_counter()
+    try:
+        yield tags
+    finally:
+        record_span(phase, time.perf_counter() - start, stores, **tags)
+
+
+def annotate(**tags: Any):
+    """為進行中的查詢 trace 加上標籤"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.tags.update(tags)
+
+
+@contextmanager
+def trace_query(stores: List[str], **tags: Any) -> Iterator[QueryTrace]:
+    """
+    建立單次查詢的 trace；結束時累計查詢總耗時與計數並寫入記錄檔
+
+    可由 annotate() 設定的標籤：sources（來源數）、attempts、cached、error、mode
+    """
+    trace = QueryTrace(stores, **tags)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        if METRICS_ENABLED:
+            _finish_trace(trace)
+
+
+def _finish_trace(trace: QueryTrace):
+    total = trace.elapsed()
+    tags = trace.tags
+    registry.observe('query', total, trace.stores)
+
+    mode = str(tags.get('mode', ''))
+    registry.incr('queries', stores=trace.stores, mode=mode)
+    if tags.get('error'):
+        registry.incr('query_errors', stores=trace.stores, mode=mode)
+    elif not tags.get('sources'):
+        registry.incr('empty_sources', stores=trace.stores, mode=mode)
+    if tags.get('attempts', 1) > 1:
+        registry.incr('retried_queries', stores=trace.stores, mode=mode)
+    if tags.get('cached'):
+        registry.incr('cache_hits', stores=trace.stores, mode=mode)
+
+    _write_log({
+        'ts': trace.started_at,
+        'stores': trace.stores,
+        'duration': round(total, 6),
+        **tags,
+        'spans': trace.spans,
+    })
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '0.0.0.0') -> Optional[ThreadingHTTPServer]:
+    """
+    於背景 thread 提供 Prometheus /metrics；連接埠已被占用時回傳 None
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning("無法啟動 metrics server (port %s): %s", port, e)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,87 @@
+"""
+模型分級
+
+依問題的複雜度選擇模型、輸出 token 上限與 File Search 檢索筆數：
+「某公司有沒有被裁罰」這類簡單的查詢使用較輕量的模型與較小的輸出上限，
+跨多個 Store、需要列舉或比較的問題使用較大的輸出上限與檢索筆數。
+
+複雜度為本地估算（不呼叫 API），依據：
+- 問題長度（正規化後的字數）
+- 查詢的 Store 數
+- 列舉 / 比較意圖（有哪些、列舉、比較、差異…）；是非題（有沒有、是否…）降低複雜度
+
+分數低於 lite_below 使用 lite，達到 deep_from 使用 deep，其餘使用 standard。
+"""
+
+import re
+import unicodedata
+from typing import Any, Dict, List
+
+# 列舉 / 比較意圖
+ENUMERATIVE_PATTERN = re.compile(r'有哪些|哪些|列舉|列出|整理|彙整|比較|差異|分析|歷年|所有|各種|案例')
+# 是非題
+YES_NO_PATTERN = re.compile(r'有沒有|是否|是不是|可不可以|能不能|可否|嗎')
+
+# 每多少字增加 1 分（最多 MAX_LENGTH_SCORE 分）
+CHARS_PER_POINT = 40
+MAX_LENGTH_SCORE = 2.0
+STORE_WEIGHT = 0.5          # 每多查詢一個 Store
+ENUMERATIVE_WEIGHT = 1.5
+YES_NO_WEIGHT = -0.5
+
+TIER_NAMES = ('lite', 'standard', 'deep')
+
+
+def estimate_complexity(question: str, selected_stores: List[str]) -> Dict[str, Any]:
+    """
+    估算問題的複雜度
+
+    回傳: {'score', 'length', 'stores', 'enumerative', 'yes_no'}
+    """
+    text = re.sub(r'\s+', '', unicodedata.normalize('NFKC', question or ''))
+    enumerative = bool(ENUMERATIVE_PATTERN.search(text))
+    yes_no = bool(YES_NO_PATTERN.search(text)) and not enumerative
+
+    score = min(len(text) / CHARS_PER_POINT, MAX_LENGTH_SCORE)
+    score += STORE_WEIGHT * max(0, len(selected_stores) - 1)
+    if enumerative:
+        score += ENUMERATIVE_WEIGHT
+    if yes_no:
+        score += YES_NO_WEIGHT
+
+    return {
+        'score': round(score, 2),
+        'length': len(text),
+        'stores': len(selected_stores),
+        'enumerative': enumerative,
+        'yes_no': yes_no,
+    }
+
+
+class TierPolicy:
+    """
+    依複雜度選擇模型分級
+
+    tiers 為 {'lite' | 'standard' | 'deep': {'model', 'max_output_tokens', 'top_k'}}
+    """
+
+    def __init__(self, tiers: Dict[str, Dict[str, Any]], lite_below: float = 0.5, deep_from: float = 2.5):
+        missing = [name for name in TIER_NAMES if name not in tiers]
+        if missing:
+            raise ValueError(f"缺少模型分級設定: {', '.join(missing)}")
+        self.tiers = tiers
+        self.lite_below = lite_below
+        self.deep_from = deep_from
+
+    def select(self, question: str, selected_stores: List[str]) -> Dict[str, Any]:
+        """
+        回傳: {'tier', 'model', 'max_output_tokens', 'top_k', 'complexity'}
+        """
+        complexity = estimate_complexity(question, selected_stores)
+        if complexity['score'] < self.lite_below:
+            name = 'lite'
+        elif complexity['score'] >= self.deep_from:
+            name = 'deep'
+        else:
+            name = 'standard'
+        return {'tier': name, **self.tiers[name], 'complexity': complexity['score']}
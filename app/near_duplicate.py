@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+相似問題索引
+
+同一個問題常有不同的問法（「保險業資本適足率不足會有什麼處分？」與「保險業資本適足率不足的處分」）、
+全形 / 半形標點與句尾語助詞的差異，查詢快取的完全相符 key 無法命中。
+此索引以 MinHash + LSH 找出同一 Store 組合下相近的既有問題，沿用其快取的答案與來源。
+
+- 正規化：NFKC（全形轉半形）、轉小寫、去除疑問詞與語助詞（請問、有哪些、嗎、呢…）、只保留文字與數字
+- 特徵：單字 + 相鄰兩字（character 1/2-gram）
+- 簽章：num_perm 個 MinHash，分為 bands 組作為 LSH bucket（bucket 含 Store 組合），
+  只比對落在同一 bucket 的候選問題，再以實際的 Jaccard 相似度確認
+- 關鍵細節：字元相似但數字 / 年份、機構或法規名稱、業別、否定詞（不、未、非…）不同的問題
+  （「國泰人壽…」與「富邦人壽…」、「2023 年…」與「2024 年…」、「可以…」與「不可以…」）視為不同的問題
+- 與查詢快取存放在同一個 SQLite 檔案，重啟後保留，並定期載入其他 process 新增的問題
+
+門檻以標註的問題配對校準（data/similar_eval.jsonl）：
+    python app/near_duplicate.py [--file data/similar_eval.jsonl]
+"""
+
+import argparse
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Sequence
+
+DEFAULT_EVAL_PATH = Path(__file__).parent.parent / "data" / "similar_eval.jsonl"
+
+# 不影響問題內容的疑問詞與語助詞
+FILLER_PATTERN = re.compile(
+    r'請問|想請問|想知道|有哪些|哪些|有什麼|是什麼|什麼|為何|如何|是否'
+    r'|的|之|了|[嗎呢吧啊呀啦喔哦耶]'
+)
+
+# 關鍵細節：數字（含中文數字）、機構名稱、條文前的法規名稱、業別、否定詞
+NUMBER_PATTERN = re.compile(r'\d+|[零〇一二兩三四五六七八九十百千萬]+')
+ENTITY_PATTERN = re.compile(
+    r'[\u4e00-\u9fff]{2}(?:人壽|產險|產物|銀行|商銀|證券|投信|投顧|期貨|金控|票券|信託|保經|保代)'
+    r'|[\u4e00-\u9fff]{2}(?:條例|辦法|準則|規則|細則|法)(?=第|$)'
+)
+# 業別（問題的對象不同即是不同的問題）
+INDUSTRY_PATTERN = re.compile(
+    r'金融控股公司|金控|銀行|保險業|人壽|產險|保險經紀人|保險代理人|證券商|證券|投信|投顧|期貨|票券'
+    r'|電子支付|電子票證|信用卡|信託|虛擬資產'
+)
+QUOTED_PATTERN = re.compile(r'「([^「」]+)」')
+NEGATION_PATTERN = re.compile(r'[不未非無沒勿]')
+
+# MinHash 的 hash 函數參數（固定 seed，簽章可跨 process 保存）
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_SEED = 20250101
+
+# 問題太長（例如含對話脈絡或附加資料）時不加入索引
+MAX_QUESTION_CHARS = 200
+# 正規化後少於此字數時不比對（資訊太少，容易誤判）
+MIN_MATCH_CHARS = 4
+
+
+def normalize_for_matching(text: str) -> str:
+    """
+    比對用的正規化：全形轉半形、轉小寫、去除疑問詞、語助詞、標點與空白
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = FILLER_PATTERN.sub('', text)
+    return ''.join(ch for ch in text if unicodedata.category(ch)[0] in 'LN')
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """正規化文字的單字與相鄰兩字"""
+    return frozenset(text) | frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def key_details(question: str) -> Dict[str, Any]:
+    """
+    問題的關鍵細節：數字 / 年份、機構與法規名稱（含「」標示的名稱）、業別、否定詞的個數
+
+    兩個問題的關鍵細節不同時，即使字元相似度很高也不是同一個問題。
+    """
+    text = normalize_for_matching(question)
+    quoted = QUOTED_PATTERN.findall(unicodedata.normalize('NFKC', question or ''))
+    return {
+        'numbers': frozenset(NUMBER_PATTERN.findall(text)),
+        'entities': frozenset(ENTITY_PATTERN.findall(text)) | frozenset(normalize_for_matching(q) for q in quoted),
+        'industries': frozenset(INDUSTRY_PATTERN.findall(text)),
+        'negations': Counter(NEGATION_PATTERN.findall(text)),
+    }
+
+
+def similarity(a: str, b: str) -> float:
+    """兩個問題的相似度：關鍵細節不同時為 0，否則為字元 1/2-gram 的 Jaccard 相似度"""
+    if key_details(a) != key_details(b):
+        return 0.0
+    return jaccard(shingles(normalize_for_matching(a)), shingles(normalize_for_matching(b)))
+
+
+class NearDuplicateIndex:
+    """
+    依 Store 組合分組的相似問題索引（thread-safe，每個 process 一個）
+
+    每筆問題對應一個查詢快取 key，找到相似問題後由呼叫端以 key 讀取快取的答案。
+    """
+
+    def __init__(self, path: str, threshold: float = 0.75, num_perm: int = 64, bands: int = 16,
+                 max_entries: int = 5000, sync_interval: float = 5.0):
+        if num_perm % bands:
+            raise ValueError('num_perm 必須是 bands 的倍數')
+        self.path = Path(path)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.sync_interval = sync_interval
+
+        rng = random.Random(MINHASH_SEED)
+        self._perms = [
+            (rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME))
+            for _ in range(num_perm)
+        ]
+
+        # cache key → {'question', 'stores', 'buckets'}（依加入順序，超過上限時淘汰最舊的）
+        self._entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._buckets: Dict[int, List[str]] = {}
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._synced_at = 0.0
+        self._counters = {
+            'lookups': 0,
+            'matches': 0,
+            'rejected': 0,      # 字元相似度達門檻，但關鍵細節不同
+        }
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS similar_questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL UNIQUE,
+                    question TEXT NOT NULL,
+                    stores TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+        self._sync(initial=True)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # 每次操作建立新連線，避免跨 thread 共用連線
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _stores_key(stores: Sequence[str]) -> str:
+        return ','.join(sorted(stores))
+
+    def signature(self, features: FrozenSet[str]) -> array:
+        """MinHash 簽章（num_perm 個 32-bit 值）"""
+        hashes = [zlib.crc32(feature.encode('utf-8')) for feature in features]
+        return array('I', (
+            min([(a * h + b) % MINHASH_PRIME for h in hashes]) & 0xFFFFFFFF
+            for a, b in self._perms
+        ))
+
+    def _bucket_keys(self, stores_key: str, signature: array) -> List[int]:
+        return [
+            hash((stores_key, band, tuple(signature[band * self.rows:(band + 1) * self.rows])))
+            for band in range(self.bands)
+        ]
+
+    def _insert(self, key: str, question: str, stores_key: str, signature: array):
+        """加入記憶體中的索引；呼叫端須持有 _lock"""
+        self._remove(key)
+        buckets = self._bucket_keys(stores_key, signature)
+        self._entries[key] = {'question': question, 'stores': stores_key, 'buckets': buckets}
+        for bucket in buckets:
+            self._buckets.setdefault(bucket, []).append(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        """自記憶體中的索引移除；呼叫端須持有 _lock"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket in entry['buckets']:
+            keys = self._buckets.get(bucket)
+            if keys is None:
+                continue
+            try:
+                keys.remove(key)
+            except ValueError:
+                pass
+            if not keys:
+                del self._buckets[bucket]
+
+    def _sync(self, initial: bool = False):
+        """載入其他 process 新增的問題（初次載入最新的 max_entries 筆）"""
+        with self._connect() as conn:
+            if initial:
+                rows = conn.execute(
+                    'SELECT id, key, question, stores, signature FROM similar_questions '
+                    'ORDER BY id DESC LIMIT ?', (self.max_entries,)
+                ).fetchall()[::-1]
+            else:
+                rows = conn.execute(
+                    'SELECT id, key, question, stores, signature FROM similar_questions '
+                    'WHERE id > ? ORDER BY id', (self._last_id,)
+                ).fetchall()
+
+        with self._lock:
+            for row_id, key, question, stores_key, blob in rows:
+                signature = array('I')
+                signature.frombytes(blob)
+                if len(signature) == self.num_perm:
+                    self._insert(key, question, stores_key, signature)
+                self._last_id = max(self._last_id, row_id)
+            self._synced_at = time.time()
+
+    def add(self, question: str, stores: Sequence[str], key: str) -> bool:
+        """
+        加入問題（key 為其查詢快取 key），太長或太短的問題不加入
+        """
+        if len(question) > MAX_QUESTION_CHARS:
+            return False
+        text = normalize_for_matching(question)
+        if len(text) < MIN_MATCH_CHARS:
+            return False
+
+        stores_key = self._stores_key(stores)
+        signature = self.signature(shingles(text))
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT OR REPLACE INTO similar_questions (key, question, stores, signature, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, question, stores_key, signature.tobytes(), time.time()),
+            )
+            row_id = cursor.lastrowid
+            count = conn.execute('SELECT COUNT(*) FROM similar_questions').fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    'DELETE FROM similar_questions WHERE id IN ('
+                    'SELECT id FROM similar_questions ORDER BY id ASC LIMIT ?)',
+                    (overflow,),
+                )
+
+        with self._lock:
+            self._insert(key, question, stores_key, signature)
+            # 其他 process 在此之前新增的問題留待下次同步
+            if row_id == self._last_id + 1:
+                self._last_id = row_id
+        return True
+
+    def find(self, question: str, stores: Sequence[str], limit: int = 3) -> List[Dict[str, Any]]:
+        """
+        找出同一 Store 組合下相似度達 threshold 且關鍵細節相同的問題，依相似度由高到低排序
+
+        回傳: [{'key', 'question', 'similarity'}, ...]
+        """
+        if time.time() - self._synced_at > self.sync_interval:
+            self._sync()
+
+        text = normalize_for_matching(question)
+        if len(text) < MIN_MATCH_CHARS or len(question) > MAX_QUESTION_CHARS:
+            return []
+        features = shingles(text)
+        stores_key = self._stores_key(stores)
+        buckets = self._bucket_keys(stores_key, self.signature(features))
+
+        with self._lock:
+            self._counters['lookups'] += 1
+            candidates = {key for bucket in buckets for key in self._buckets.get(bucket, ())}
+            entries = [(key, self._entries[key]['question']) for key in candidates]
+
+        matches = []
+        rejected = 0
+        details = None
+        for key, candidate in entries:
+            score = jaccard(features, shingles(normalize_for_matching(candidate)))
+            if score < self.threshold:
+                continue
+            if details is None:
+                details = key_details(question)
+            if key_details(candidate) != details:
+                rejected += 1
+                continue
+            matches.append({'key': key, 'question': candidate, 'similarity': score})
+        matches.sort(key=lambda match: match['similarity'], reverse=True)
+
+        with self._lock:
+            self._counters['rejected'] += rejected
+            if matches:
+                self._counters['matches'] += 1
+        return matches[:limit]
+
+    def discard(self, key: str):
+        """移除問題（例如對應的快取已過期）"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM similar_questions WHERE key = ?', (key,))
+        with self._lock:
+            self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳統計：entries, lookups, matches, rejected, match_rate
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        stats['match_rate'] = stats['matches'] / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
+
+
+def evaluate(eval_path: Path, thresholds: List[float]) -> Dict[str, Any]:
+    """
+    以標註的問題配對評估各門檻的 precision / recall
+
+    每行格式: {"a": "...", "b": "...", "same": true}
+    - precision：判定為相同的配對中，標註為相同的比例（誤用其他問題的答案的反面）
+    - recall：標註為相同的配對中，被判定為相同的比例
+    """
+    rows = []
+    with open(eval_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rows.append(json.loads(line))
+
+    scores = [(similarity(row['a'], row['b']), bool(row['same'])) for row in rows]
+    positives = sum(same for _, same in scores)
+    report = []
+    for threshold in thresholds:
+        tp = sum(score >= threshold and same for score, same in scores)
+        fp = sum(score >= threshold and not same for score, same in scores)
+        report.append({
+            'threshold': threshold,
+            'precision': tp / (tp + fp) if tp + fp else 1.0,
+            'recall': tp / positives if positives else 0.0,
+            'false_matches': [
+                (row['a'], row['b']) for row, (score, same) in zip(rows, scores) if score >= threshold and not same
+            ],
+        })
+
+    # 不誤用任何答案（precision 100%）的最低門檻
+    recommended: Optional[float] = next((r['threshold'] for r in report if r['precision'] == 1.0), None)
+    return {'count': len(rows), 'positives': positives, 'thresholds': report, 'recommended': recommended}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='相似問題門檻校準')
+    parser.add_argument('--file', default=str(DEFAULT_EVAL_PATH), help='標註的問題配對 (JSONL)')
+    args = parser.parse_args(argv)
+
+    thresholds = [round(0.5 + 0.05 * i, 2) for i in range(10)]
+    report = evaluate(Path(args.file), thresholds)
+
+    print(f"配對數: {report['count']}（相同 {report['positives']}）")
+    for r in report['thresholds']:
+        print(f"  門檻 {r['threshold']:.2f}　precision {r['precision']:.1%}　recall {r['recall']:.1%}")
+    recommended = report['recommended']
+    print(f"建議門檻: {recommended:.2f}" if recommended is not None else "建議門檻: 無（所有門檻都有誤判）")
+    for r in report['thresholds']:
+        if r['threshold'] == recommended:
+            break
+        for a, b in r['false_matches']:
+            print(f"  誤判（門檻 {r['threshold']:.2f}）: {a} ↔ {b}")
+
+
+if __name__ == '__main__':
+    main()
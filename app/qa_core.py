@@ -0,0 +1,1366 @@
+"""
+問答核心
+
+Store 設定、系統提示、Gemini File Search 查詢（一般 / 串流 / 分別查詢 / 沿用來源）與來源解析，
+不依賴 Streamlit，由 Streamlit 介面（main.py）、HTTP API（api.py）與批次評估共用。
+
+Client、mapping 索引、查詢快取、重試策略、准入控制等資源每個 process 只建立一次，
+由所有 session 與 API 請求共用。
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from itertools import combinations
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from pathlib import Path
+
+from answer_cache import AnswerCache, normalize_question
+from doc_lookup import DocLookup, lookup_fingerprint
+from example_precompute import ExamplePrecomputer
+from mapping_index import DEFAULT_INDEX_PATH, UNIFIED_MAPPING_FILE, MappingIndex, load_index, mapping_fingerprint
+from metadata_filter import apply_source_filters, build_metadata_filter, filters_key, has_filters
+import metrics
+from gemini_client import GEMINI_TIMEOUT, get_client, is_timeout_error, run_async, warm_up
+from retry_policy import RETRYABLE_STATUS_CODES, RetryPolicy
+from single_flight import SingleFlight
+from admission import AdmissionController, AdmissionRejected
+from model_tier import TierPolicy
+from near_duplicate import NearDuplicateIndex
+from settings import get_setting
+from store_router import StoreRouter
+
+logger = logging.getLogger(__name__)
+
+
+def shared_resource(max_entries: Optional[int] = None) -> Callable[[Callable], Callable]:
+    """
+    每個 process 共用的資源（依參數快取，thread-safe，同一組參數只建立一次）
+
+    max_entries=1 時參數改變（例如 fingerprint）即取代舊的資源。
+    """
+    def decorator(func: Callable) -> Callable:
+        entries: 'OrderedDict[tuple, Any]' = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in entries:
+                    entries.move_to_end(args)
+                    return entries[args]
+                value = func(*args)
+                entries[args] = value
+                if max_entries and len(entries) > max_entries:
+                    entries.popitem(last=False)
+                return value
+
+        wrapper.clear = entries.clear
+        return wrapper
+    return decorator
+
+
+# Store 配置
+STORES = {
+    'penalties': {
+        'name': 'fsc-penalties-plaintext',
+        'store_id': 'fileSearchStores/fscpenaltiesplaintext-4f87t5uexgui',
+        'display_name': '裁罰案件',
+        'icon': '⚖️',
+        'description': '490 筆金融機構裁罰案件 (2012-2025)',
+        'count': 490,
+    },
+    'law_interpretations': {
+        'name': 'fsc-law-interpretations',
+        'store_id': 'fileSearchStores/fsclawinterpretations-zz5pwrly06hz',
+        'display_name': '法令函釋',
+        'icon': '📜',
+        'description': '法規解釋、修正說明、條文對照',
+        'count': 2872,
+    },
+    'announcements': {
+        'name': 'fsc-announcements',
+        'store_id': 'fileSearchStores/fscannouncements-o94q0kmo2zxb',
+        'display_name': '重要公告',
+        'icon': '📢',
+        'description': '政策公告、法規修正公告',
+        'count': 1642,
+    },
+}
+
+# 來源單位中文名稱
+SOURCE_LABELS = {
+    'insurance_bureau': '保險局',
+    'securities_bureau': '證期局',
+    'bank_bureau': '銀行局',
+    'inspection_bureau': '檢查局',
+    'fsc': '金管會',
+}
+
+# 參考來源：同一文件的多個段落合併為一筆，每次回答最多保留的文件數（0 表示不限制）
+SOURCES_TOP_K = get_setting('SOURCES_TOP_K', 20)
+SOURCE_MAX_CHUNKS = 3                                               # 每筆文件保留的段落數
+SNIPPET_SEPARATOR = "\n\n⋯\n\n"
+
+# 模型設定
+GEMINI_MODEL = 'gemini-2.5-flash'
+GEMINI_MAX_OUTPUT_TOKENS = 2000
+
+# 模型分級：依問題複雜度選擇模型、輸出 token 上限與 File Search 檢索段落數（top_k）
+MODEL_TIERING_ENABLED = get_setting('MODEL_TIERING_ENABLED', False)
+MODEL_TIERS = {
+    'lite': {
+        'model': get_setting('MODEL_TIER_LITE_MODEL', 'gemini-2.5-flash-lite'),
+        'max_output_tokens': get_setting('MODEL_TIER_LITE_MAX_TOKENS', 800),
+        'top_k': 5,
+    },
+    'standard': {
+        'model': GEMINI_MODEL,
+        'max_output_tokens': GEMINI_MAX_OUTPUT_TOKENS,
+        'top_k': 10,
+    },
+    'deep': {
+        'model': GEMINI_MODEL,
+        'max_output_tokens': get_setting('MODEL_TIER_DEEP_MAX_TOKENS', 4000),
+        'top_k': 20,
+    },
+}
+# 未啟用分級時的設定（top_k 為 None 時使用 File Search 預設值）
+DEFAULT_TIER = {
+    'tier': 'standard',
+    'model': GEMINI_MODEL,
+    'max_output_tokens': GEMINI_MAX_OUTPUT_TOKENS,
+    'top_k': None,
+    'complexity': None,
+}
+
+# 啟動時於背景暖機 Gemini Client
+GEMINI_WARM_UP = get_setting('GEMINI_WARM_UP', True)
+
+# 分別查詢各 Store 再合併來源（多個 Store 時）
+FANOUT_ENABLED = get_setting('FANOUT_ENABLED', False)
+FANOUT_STORE_DEADLINE = get_setting('FANOUT_STORE_DEADLINE', 20.0)  # 每個 Store 的等待上限（秒）
+FANOUT_MAX_SOURCES = get_setting('FANOUT_MAX_SOURCES', 20)          # 合併後保留的來源數
+FANOUT_RETRIEVAL_TOKENS = 256                                       # 各 Store 檢索呼叫的輸出上限
+FANOUT_CONTEXT_CHARS = 2000                                         # 每段來源提供給模型的字數
+
+# 重試策略
+RETRY_MAX_ATTEMPTS = get_setting('RETRY_MAX_ATTEMPTS', 3)
+RETRY_DEADLINE = get_setting('RETRY_DEADLINE', 90.0)              # 整體期限（秒）
+HEDGE_ENABLED = get_setting('HEDGE_ENABLED', True)
+HEDGE_DEFAULT_DELAY = get_setting('HEDGE_DEFAULT_DELAY', 15.0)    # 延遲樣本不足時的 hedge 延遲（秒）
+HEDGE_PERCENTILE = get_setting('HEDGE_PERCENTILE', 0.9)
+RETRY_MAX_WORKERS = get_setting('RETRY_MAX_WORKERS', 16)         # 整個 process 同時進行的查詢嘗試上限
+
+# Gemini 呼叫准入控制（token bucket + 依 session / API client 輪流放行）
+ADMISSION_ENABLED = get_setting('ADMISSION_ENABLED', True)
+ADMISSION_RATE = get_setting('ADMISSION_RATE', 5.0)            # 每秒上游請求數
+ADMISSION_BURST = get_setting('ADMISSION_BURST', 10.0)         # 瞬間可用的請求數
+ADMISSION_MAX_QUEUE = get_setting('ADMISSION_MAX_QUEUE', 50)   # 等待佇列上限
+ADMISSION_MAX_WAIT = get_setting('ADMISSION_MAX_WAIT', 60.0)   # 預估等待超過此秒數即拒絕
+ADMISSION_SHARED_PATH = get_setting('ADMISSION_SHARED_PATH', '')   # 設定時多個 process 共用速率上限 (SQLite)
+
+# 合併進行中的相同查詢（跨 session）
+SINGLE_FLIGHT_ENABLED = get_setting('SINGLE_FLIGHT_ENABLED', True)
+SINGLE_FLIGHT_TIMEOUT = get_setting('SINGLE_FLIGHT_TIMEOUT', RETRY_DEADLINE)   # 等待其他 session 的上限（秒）
+
+# 篩選條件下推至 File Search（文件需帶有 source / category / year custom_metadata）
+# 既有 Store 的文件未帶 metadata（只有 corpus_sync 之後上傳的文件才有），下推會使篩選結果為空，
+# 預設關閉（不提供篩選條件），以 corpus_sync 重新匯入所有文件後再啟用；
+# 啟用後也只在勾選的 Store 都已重新匯入時提供（見 filter_unsupported_stores）
+METADATA_FILTER_PUSHDOWN = get_setting('METADATA_FILTER_PUSHDOWN', False)
+
+# 自動選擇資料來源：低於此信心時查詢全部勾選的來源
+ROUTER_MIN_CONFIDENCE = get_setting('ROUTER_MIN_CONFIDENCE', 0.5)
+
+# 查詢快取設定
+ANSWER_CACHE_ENABLED = get_setting('ANSWER_CACHE_ENABLED', True)
+ANSWER_CACHE_PATH = get_setting(
+    'ANSWER_CACHE_PATH',
+    str(Path(__file__).parent.parent / '.cache' / 'answer_cache.sqlite3'),
+)
+ANSWER_CACHE_TTL = get_setting('ANSWER_CACHE_TTL', 86400)            # 秒
+ANSWER_CACHE_MAX_ENTRIES = get_setting('ANSWER_CACHE_MAX_ENTRIES', 5000)
+
+# 相似問題：沿用同一 Store 組合下相近問題的快取答案（需啟用查詢快取，使用者確認後才沿用）
+NEAR_DUPLICATE_ENABLED = get_setting('NEAR_DUPLICATE_ENABLED', False)
+# Jaccard 相似度（字元 1/2-gram），以 data/similar_eval.jsonl 校準（python app/near_duplicate.py）
+NEAR_DUPLICATE_THRESHOLD = get_setting('NEAR_DUPLICATE_THRESHOLD', 0.75)
+
+
+@shared_resource()
+def get_answer_cache() -> AnswerCache:
+    """
+    取得查詢快取（每個 process 建立一次）
+    """
+    return AnswerCache(
+        ANSWER_CACHE_PATH,
+        ttl_seconds=ANSWER_CACHE_TTL,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    )
+
+
+@shared_resource()
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    """
+    取得相似問題索引（每個 process 建立一次，與查詢快取存放在同一個檔案）
+    """
+    return NearDuplicateIndex(
+        ANSWER_CACHE_PATH,
+        threshold=NEAR_DUPLICATE_THRESHOLD,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    )
+
+
+@shared_resource()
+def get_tier_policy() -> TierPolicy:
+    """
+    取得模型分級策略（每個 process 建立一次）
+    """
+    return TierPolicy(MODEL_TIERS)
+
+
+def select_tier(question: str, selected_stores: List[str]) -> Dict[str, Any]:
+    """
+    依問題複雜度選擇模型分級（不記錄 trace，實際呼叫模型時由 start_generation() 記錄）
+
+    回傳: {'tier', 'model', 'max_output_tokens', 'top_k', 'complexity'}
+    """
+    if not MODEL_TIERING_ENABLED:
+        return DEFAULT_TIER
+    return get_tier_policy().select(question, selected_stores)
+
+
+@shared_resource()
+def get_retry_policy() -> RetryPolicy:
+    """
+    取得重試策略（每個 process 共用，累計延遲樣本與統計）
+    """
+    return RetryPolicy(
+        max_attempts=RETRY_MAX_ATTEMPTS,
+        deadline=RETRY_DEADLINE,
+        hedge_enabled=HEDGE_ENABLED,
+        hedge_default_delay=HEDGE_DEFAULT_DELAY,
+        hedge_percentile=HEDGE_PERCENTILE,
+        max_workers=RETRY_MAX_WORKERS,
+    )
+
+
+@shared_resource()
+def get_admission_controller() -> AdmissionController:
+    """
+    取得准入控制器（每個 process 共用）
+    """
+    return AdmissionController(
+        rate=ADMISSION_RATE,
+        burst=ADMISSION_BURST,
+        max_queue=ADMISSION_MAX_QUEUE,
+        max_wait=ADMISSION_MAX_WAIT,
+        shared_path=ADMISSION_SHARED_PATH,
+    )
+
+
+def charge_retry(cost: int = 1):
+    """
+    重試不經准入佇列，直接扣除 token，延後後續查詢的放行
+    """
+    if ADMISSION_ENABLED and metrics.attempt_index.get() > 0:
+        get_admission_controller().charge(cost)
+
+
+@shared_resource()
+def get_single_flight() -> SingleFlight:
+    """
+    取得相同查詢合併器（每個 process 共用）
+    """
+    return SingleFlight(timeout=SINGLE_FLIGHT_TIMEOUT)
+
+
+@shared_resource()
+def start_client_warm_up(api_key: str):
+    """
+    每個 process 只執行一次的 Client 暖機
+    """
+    return warm_up(api_key, GEMINI_MODEL)
+
+
+@shared_resource()
+def start_metrics_server(port: int):
+    """
+    每個 process 只啟動一次的 Prometheus /metrics server
+    """
+    return metrics.start_http_server(port)
+
+
+def precompute_example(question: str, stores: List[str], api_key: str) -> Dict[str, Any]:
+    """
+    預先計算一個範例問題（不使用快取），與一般查詢同樣經過准入控制與重試策略
+
+    第一次嘗試在此排入准入佇列；重試與 hedge 嘗試與 execute_query 相同，
+    由 query_gemini() → start_generation() → charge_retry() 依 attempt_index 各扣除一個 token。
+    """
+    if ADMISSION_ENABLED:
+        try:
+            get_admission_controller().acquire('example-precompute')
+        except AdmissionRejected as e:
+            return {'answer': f"⚠️ {e}", 'sources': [], 'error': True}
+
+    with metrics.trace_query(stores, mode='precompute'):
+        # 每次嘗試都經過 start_generation()，attempt > 0 時扣除准入 token
+        result = get_retry_policy().run(
+            lambda attempt: query_gemini(question, stores, api_key, use_cache=False)
+        )
+        metrics.annotate(
+            sources=len(result['sources']),
+            attempts=result.get('attempts', 1),
+            error=bool(result.get('error')),
+        )
+    return result
+
+
+@shared_resource()
+def get_example_precomputer(api_key: str, questions: Tuple[str, ...], refresh_interval: float,
+                            budget: int) -> ExamplePrecomputer:
+    """
+    每個 process 只啟動一次的範例問題預先計算（所有 Store 組合）
+    """
+    precomputer = ExamplePrecomputer(
+        questions, list(SYSTEM_PROMPTS),
+        lambda question, stores: precompute_example(question, stores, api_key),
+        refresh_interval=refresh_interval,
+        budget=budget,
+    )
+    precomputer.start()
+    return precomputer
+
+
+# Mapping 索引
+DATA_PATH = Path(__file__).parent.parent / "data"
+MAPPING_INDEX_PATH = get_setting('MAPPING_INDEX_PATH', str(DEFAULT_INDEX_PATH))
+
+
+@shared_resource(max_entries=1)
+def _load_mapping_index(fingerprint: str) -> MappingIndex:
+    """
+    開啟 mapping 索引（fingerprint 改變時重新載入，必要時重建索引）
+    """
+    return load_index(DATA_PATH, MAPPING_INDEX_PATH)
+
+
+def load_mappings() -> Optional[MappingIndex]:
+    """
+    取得 mapping 索引，用於將 Gemini 回傳的 file ID 轉換為可讀的顯示名稱
+
+    每個 process 只載入一次，來源 JSON 的修改時間改變時才重新載入。
+    """
+    try:
+        with metrics.span('load_mappings'):
+            return _load_mapping_index(mapping_fingerprint(DATA_PATH))
+    except Exception as e:
+        logger.warning("載入 mapping 檔案時發生錯誤: %s", e)
+        return None
+
+
+@shared_resource(max_entries=1)
+def _load_metadata_stores(fingerprint: str) -> frozenset:
+    """
+    整合 mapping 中所有文件都由 corpus_sync 匯入（帶有 custom_metadata，紀錄有 document_name）的 Store
+    """
+    path = DATA_PATH / UNIFIED_MAPPING_FILE
+    if not path.exists():
+        return frozenset()
+    with open(path, 'r', encoding='utf-8') as f:
+        mapping = json.load(f)
+
+    complete = {key: True for key in STORES}
+    seen = set()
+    for record in mapping.values():
+        store = record.get('store')
+        if store in complete:
+            seen.add(store)
+            complete[store] = complete[store] and bool(record.get('document_name'))
+    return frozenset(store for store in seen if complete[store])
+
+
+def filter_unsupported_stores(selected_stores: List[str]) -> List[str]:
+    """
+    無法套用篩選條件的 Store
+
+    篩選條件只能下推至 File Search（本地篩選無法影響檢索與答案），
+    未啟用 METADATA_FILTER_PUSHDOWN 時為全部；啟用時為文件未帶 metadata 的 Store
+    （metadata_filter 會排除該 Store 的所有文件）
+    """
+    if not METADATA_FILTER_PUSHDOWN:
+        return list(selected_stores)
+    try:
+        supported = _load_metadata_stores(mapping_fingerprint(DATA_PATH))
+    except Exception as e:
+        logger.warning("讀取整合 mapping 時發生錯誤: %s", e)
+        supported = frozenset()
+    return [store for store in selected_stores if store not in supported]
+
+
+@shared_resource(max_entries=1)
+def _load_doc_lookup(fingerprint: str) -> DocLookup:
+    """
+    建立發文字號 / 法規名稱索引（fingerprint 改變時重建）
+    """
+    return DocLookup.from_data_path(DATA_PATH)
+
+
+def get_doc_lookup() -> Optional[DocLookup]:
+    """
+    取得發文字號 / 法規名稱索引（每個 process 建立一次，來源 JSON 改變時重建）
+    """
+    try:
+        return _load_doc_lookup(lookup_fingerprint(DATA_PATH))
+    except Exception as e:
+        logger.warning("載入發文字號索引時發生錯誤: %s", e)
+        return None
+
+
+@shared_resource(max_entries=1)
+def _load_store_router(fingerprint: str) -> StoreRouter:
+    """
+    建立 Store 路由器（使用發文字號 / 法規名稱索引中的法規名稱）
+    """
+    return StoreRouter(get_doc_lookup(), min_confidence=ROUTER_MIN_CONFIDENCE)
+
+
+def get_store_router() -> StoreRouter:
+    """
+    取得 Store 路由器（每個 process 建立一次，發文字號索引重建時一併重建）
+    """
+    return _load_store_router(lookup_fingerprint(DATA_PATH))
+
+
+def resolve_source_display_name(raw_id: str, index: Optional[MappingIndex] = None) -> tuple:
+    """
+    將 Gemini 回傳的 file ID 解析為可讀的顯示名稱
+
+    index 未提供時使用 load_mappings()
+    回傳: (display_name, source_type, date, original_url)
+    """
+    if index is None:
+        index = load_mappings()
+
+    # 嘗試從 mapping 查詢
+    doc_id = index.resolve(raw_id) if index is not None else ''
+    info = index.get_document(doc_id) if doc_id else None
+
+    if info is not None:
+        display_name = info.get('display_name', '')
+        date = info.get('date', '未知日期')
+        source = info.get('source', '')
+        original_url = info.get('original_url', '')
+
+        # 判斷來源類型
+        if doc_id.startswith('fsc_pen'):
+            source_type = "裁罰案件"
+            icon = "⚖️"
+        elif doc_id.startswith('fsc_law'):
+            source_type = "法令函釋"
+            icon = "📜"
+        elif doc_id.startswith('fsc_unk') or doc_id.startswith('fsc_ann'):
+            source_type = "重要公告"
+            icon = "📢"
+        else:
+            source_type = "未知"
+            icon = "📄"
+
+        # 來源單位中文化
+        source_display = SOURCE_LABELS.get(source, source)
+
+        # 格式化顯示名稱
+        if display_name:
+            # 裁罰案件格式: "2025-09-25_保險局_全球人壽"
+            # 新格式: "2025-11-14_insurance_bureau_ann_amendment_fsc_unk_..."
+            parts = display_name.split('_')
+            if doc_id.startswith('fsc_pen') and len(parts) >= 3:
+                # 裁罰: 日期_來源_機構名稱
+                return f"{icon} {parts[0]}_{parts[2]}", source_type, date, original_url
+            elif len(parts) >= 2:
+                # 法令函釋/公告: 日期_來源
+                return f"{icon} {date}_{source_display}", source_type, date, original_url
+
+        return f"{icon} {source_type}_{date}", source_type, date, original_url
+
+    # 如果 mapping 找不到，嘗試從原始名稱解析
+    return f"📄 {format_source_display_name(raw_id)}", "未知", "未知日期", ""
+
+
+def build_system_prompt(selected_stores: List[str]) -> str:
+    """
+    根據選取的 Store 組合產生系統提示
+    """
+    base_prompt = """你是專業的金融法規顧問。請根據參考資料回答問題。
+
+回答時必須：
+1. 明確引用來源文件（檔案名稱、日期）
+2. 如果資料中沒有相關資訊，請誠實說明
+3. 使用繁體中文回答
+4. 保持專業、客觀的態度
+"""
+
+    # 根據選取的 Store 加入特定指引
+    specific_guidelines = []
+
+    if 'penalties' in selected_stores:
+        specific_guidelines.append("""
+【裁罰案件指引】
+- 列舉具體案例與裁罰內容
+- 說明受罰機構、罰款金額、違規行為
+- 引用相關法律依據""")
+
+    if 'law_interpretations' in selected_stores:
+        specific_guidelines.append("""
+【法令函釋指引】
+- 解釋法規的具體含義
+- 列出修正前後的差異（如有）
+- 引用發文字號""")
+
+    if 'announcements' in selected_stores:
+        specific_guidelines.append("""
+【重要公告指引】
+- 說明公告的主要內容
+- 列出生效日期（如有）
+- 引用公告文號""")
+
+    # 組合提示
+    if specific_guidelines:
+        return base_prompt + "\n" + "\n".join(specific_guidelines)
+    return base_prompt
+
+
+def store_combination(selected_stores: List[str]) -> Tuple[str, ...]:
+    """Store 組合（依 STORES 順序，與勾選順序無關）"""
+    return tuple(key for key in STORES if key in selected_stores)
+
+
+# 所有 Store 組合的系統提示（啟動時產生一次）
+SYSTEM_PROMPTS = {
+    combo: build_system_prompt(list(combo))
+    for size in range(1, len(STORES) + 1)
+    for combo in combinations(STORES, size)
+}
+
+
+def get_system_prompt(selected_stores: List[str]) -> str:
+    """
+    取得 Store 組合的系統提示
+    """
+    prompt = SYSTEM_PROMPTS.get(store_combination(selected_stores))
+    return prompt if prompt is not None else build_system_prompt(selected_stores)
+
+
+def build_generate_config(store_ids: List[str], system_prompt: str,
+                          max_output_tokens: int = GEMINI_MAX_OUTPUT_TOKENS,
+                          filters: Optional[Dict[str, Any]] = None, top_k: Optional[int] = None):
+    """
+    建立 File Search 查詢的 GenerateContentConfig
+
+    filters 會轉為 metadata_filter，在檢索時只掃描符合條件的文件。
+    top_k 為 File Search 檢索的段落數，None 時使用預設值。
+    """
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        tools=[
+            types.Tool(
+                file_search=types.FileSearch(
+                    file_search_store_names=store_ids,
+                    metadata_filter=build_metadata_filter(filters) if METADATA_FILTER_PUSHDOWN else None,
+                    top_k=top_k
+                )
+            )
+        ],
+        temperature=0.1,
+        max_output_tokens=max_output_tokens,
+        system_instruction=system_prompt
+    )
+
+
+def lookup_answer_cache(question: str, selected_stores: List[str], system_prompt: str,
+                        use_cache: bool = True, variant: str = '', model: str = GEMINI_MODEL) -> tuple:
+    """
+    查詢快取
+
+    回傳: (cache, cache_key, cached)，未啟用快取時 cache 為 None，未命中時 cached 為 None
+    """
+    if not (use_cache and ANSWER_CACHE_ENABLED):
+        return None, None, None
+
+    with metrics.span('cache_lookup') as tags:
+        cache = get_answer_cache()
+        cache_key = AnswerCache.make_key(question, selected_stores, model, system_prompt, variant)
+        cached = cache.get(cache_key)
+        tags['hit'] = cached is not None
+    return cache, cache_key, cached
+
+
+def error_result(e: Exception) -> Dict[str, Any]:
+    """
+    將例外轉換為錯誤結果
+
+    逾時與 429 / 5xx 標記為 retryable，交由重試策略退避重試
+    """
+    if is_timeout_error(e):
+        return {
+            'answer': f'查詢逾時（超過 {GEMINI_TIMEOUT:g} 秒），請稍後再試',
+            'sources': [],
+            'retryable': True,
+            'error': True
+        }
+    return {
+        'answer': f'查詢失敗: {str(e)}',
+        'sources': [],
+        'retryable': getattr(e, 'code', None) in RETRYABLE_STATUS_CODES,
+        'error': True
+    }
+
+
+def usage_input_tokens(response) -> Optional[int]:
+    """
+    回應的輸入 token 數（含 File Search 檢索內容），沒有 usage_metadata 時回傳 None
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None or getattr(usage, 'prompt_token_count', None) is None:
+        return None
+    return usage.prompt_token_count + (getattr(usage, 'tool_use_prompt_token_count', None) or 0)
+
+
+def usage_output_tokens(response) -> Optional[int]:
+    """
+    回應的輸出 token 數（含 thinking），沒有 usage_metadata 時回傳 None
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None or getattr(usage, 'candidates_token_count', None) is None:
+        return None
+    return usage.candidates_token_count + (getattr(usage, 'thoughts_token_count', None) or 0)
+
+
+def answer_cached(question: str, selected_stores: List[str], variant: str = '') -> bool:
+    """
+    查詢快取中是否已有結果（命中的查詢不呼叫 Gemini，不需經過准入控制）
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return False
+    # 分別查詢 / 沿用來源固定使用 GEMINI_MODEL
+    model = GEMINI_MODEL
+    if not variant.startswith(('fanout', 'context')):
+        model = select_tier(question, selected_stores)['model']
+    key = AnswerCache.make_key(
+        question, selected_stores, model, get_system_prompt(selected_stores), variant
+    )
+    return get_answer_cache().contains(key)
+
+
+def store_answer(cache: AnswerCache, cache_key: str, answer: str, sources: List[Dict[str, Any]],
+                 question: str, selected_stores: List[str], filters: Optional[Dict[str, Any]] = None):
+    """
+    寫入查詢快取；未篩選的問題同時加入相似問題索引
+    """
+    cache.set(cache_key, {'answer': answer, 'sources': sources})
+    if NEAR_DUPLICATE_ENABLED and not has_filters(filters):
+        try:
+            get_near_duplicate_index().add(question, selected_stores, cache_key)
+        except Exception as e:
+            logger.warning("無法加入相似問題索引: %s", e)
+
+
+def find_similar_answer(question: str, selected_stores: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    找出同一 Store 組合下相似問題的快取答案；沒有相似問題或其快取已過期時回傳 None
+
+    結果另含 similar_question（相似的問題）與 similarity（相似度）。
+    """
+    if not (NEAR_DUPLICATE_ENABLED and ANSWER_CACHE_ENABLED):
+        return None
+
+    start_time = time.time()
+    index = get_near_duplicate_index()
+    with metrics.span('similar_lookup') as tags:
+        result = None
+        for match in index.find(question, selected_stores):
+            if normalize_question(match['question']) == normalize_question(question):
+                break   # 相同的問題由查詢快取處理
+            cached = get_answer_cache().get(match['key'])
+            if cached is None:
+                index.discard(match['key'])
+                continue
+            result = {
+                'answer': cached['answer'],
+                'sources': cached['sources'],
+                'latency': time.time() - start_time,
+                'similar_question': match['question'],
+                'similarity': match['similarity'],
+                'cached': True,
+                'error': False
+            }
+            break
+        tags['hit'] = result is not None
+    return result
+
+
+def prepare_query(question: str, selected_stores: List[str], use_cache: bool = True,
+                  filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    File Search 查詢（一般 / 串流 × sync / async）共用的前置步驟：Store、系統提示、模型分級、查詢快取
+
+    回傳 plan: {'start_time', 'store_ids', 'system_prompt', 'tier', 'cache', 'cache_key', 'result'}
+    result 不為 None 時（未選擇 Store、快取命中）不需呼叫 Gemini，直接回傳該結果。
+    """
+    start_time = time.time()
+    store_ids = [STORES[s]['store_id'] for s in selected_stores if s in STORES]
+
+    if not store_ids:
+        return {'start_time': start_time, 'result': {
+            'answer': '請至少選擇一個資料來源',
+            'sources': [],
+            'error': True
+        }}
+
+    system_prompt = get_system_prompt(selected_stores)
+    tier = select_tier(question, selected_stores)
+    cache, cache_key, cached = lookup_answer_cache(
+        question, selected_stores, system_prompt, use_cache, variant=filters_key(filters), model=tier['model']
+    )
+
+    result = None
+    if cached is not None:
+        result = {
+            'answer': cached['answer'],
+            'sources': cached['sources'],
+            'latency': time.time() - start_time,
+            'cached': True,
+            'error': False
+        }
+
+    return {
+        'start_time': start_time,
+        'store_ids': store_ids,
+        'system_prompt': system_prompt,
+        'tier': tier,
+        'cache': cache,
+        'cache_key': cache_key,
+        'result': result,
+    }
+
+
+def start_generation(plan: Dict[str, Any]):
+    """
+    呼叫 Gemini 前的共用步驟：重試扣除准入 token、在 trace 記錄實際使用的模型分級
+    """
+    charge_retry()
+    tier = plan['tier']
+    if MODEL_TIERING_ENABLED:
+        metrics.annotate(
+            tier=tier['tier'],
+            model=tier['model'],
+            max_output_tokens=tier['max_output_tokens'],
+            top_k=tier['top_k'],
+            complexity=tier['complexity'],
+        )
+
+
+def generate_request(plan: Dict[str, Any], question: str,
+                     filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    generate_content / generate_content_stream 的參數（model、contents、config）
+    """
+    tier = plan['tier']
+    return {
+        'model': tier['model'],
+        'contents': question,
+        'config': build_generate_config(plan['store_ids'], plan['system_prompt'], tier['max_output_tokens'],
+                                        filters=filters, top_k=tier['top_k']),
+    }
+
+
+def finish_query(plan: Dict[str, Any], question: str, selected_stores: List[str],
+                 filters: Optional[Dict[str, Any]], answer: str, sources: List[Dict[str, Any]],
+                 input_tokens: Optional[int], output_tokens: Optional[int]) -> Dict[str, Any]:
+    """
+    查詢完成的共用步驟：產生結果，只快取有來源的結果（避免無來源的答案阻擋重試）
+    """
+    latency = time.time() - plan['start_time']
+
+    if plan['cache'] is not None and sources:
+        store_answer(plan['cache'], plan['cache_key'], answer, sources, question, selected_stores, filters)
+
+    return {
+        'answer': answer,
+        'sources': sources,
+        'latency': latency,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'cached': False,
+        'error': False
+    }
+
+
+def response_result(plan: Dict[str, Any], response, question: str, selected_stores: List[str],
+                    filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    將 File Search 查詢的回應轉換為查詢結果
+
+    來源另以本地篩選排除未帶 metadata 而漏網的段落
+    """
+    return finish_query(
+        plan, question, selected_stores, filters,
+        answer=response.text if hasattr(response, 'text') else str(response),
+        sources=apply_source_filters(extract_sources(response), filters),
+        input_tokens=usage_input_tokens(response),
+        output_tokens=usage_output_tokens(response),
+    )
+
+
+def prepared_events(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    不需呼叫 Gemini 的結果（未選擇 Store、快取命中）轉為串流事件
+    """
+    if result.get('error'):
+        return [{'type': 'done', 'result': result}]
+    return [
+        {'type': 'delta', 'text': result['answer']},
+        {'type': 'done', 'result': dict(result, ttft=result['latency'])},
+    ]
+
+
+def new_stream_state() -> Dict[str, Any]:
+    """串流查詢累積的文字、來源、首字時間與 token 數"""
+    return {'parts': [], 'sources': [], 'ttft': None, 'input_tokens': None, 'output_tokens': None}
+
+
+def consume_chunk(state: Dict[str, Any], plan: Dict[str, Any], chunk,
+                  filters: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    處理一個串流 chunk，回傳其中的文字（沒有文字時回傳 None）
+
+    來源取自帶有 grounding metadata 的 chunk（通常是最後一個）
+    """
+    text = getattr(chunk, 'text', None)
+    if text:
+        if state['ttft'] is None:
+            state['ttft'] = time.time() - plan['start_time']
+            metrics.record_span('first_token', state['ttft'])
+        state['parts'].append(text)
+
+    chunk_sources = extract_sources(chunk)
+    if chunk_sources:
+        state['sources'] = apply_source_filters(chunk_sources, filters)
+    state['input_tokens'] = usage_input_tokens(chunk) or state['input_tokens']
+    state['output_tokens'] = usage_output_tokens(chunk) or state['output_tokens']
+    return text or None
+
+
+def stream_error_result(state: Dict[str, Any], error: Exception) -> Dict[str, Any]:
+    """已輸出部分文字後串流失敗：保留已輸出的文字並附上錯誤訊息"""
+    result = error_result(error)
+    result['answer'] = ''.join(state['parts']) + f"\n\n⚠️ {result['answer']}"
+    return result
+
+
+def finish_stream(plan: Dict[str, Any], state: Dict[str, Any], question: str, selected_stores: List[str],
+                  filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    串流完成：記錄 generate 階段並產生結果（另含 ttft）
+    """
+    metrics.record_span('generate', time.time() - plan['start_time'], streaming=True)
+    result = finish_query(
+        plan, question, selected_stores, filters,
+        answer=''.join(state['parts']),
+        sources=state['sources'],
+        input_tokens=state['input_tokens'],
+        output_tokens=state['output_tokens'],
+    )
+    result['ttft'] = state['ttft'] if state['ttft'] is not None else result['latency']
+    return result
+
+
+def query_gemini(question: str, selected_stores: List[str], api_key: str,
+                 use_cache: bool = True, filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    使用 Gemini File Search 執行查詢
+
+    use_cache=True 時先查詢快取，命中則直接回傳（含來源），
+    有來源的成功結果會寫回快取。
+    filters 為日期 / 來源單位 / 類別篩選條件（見 metadata_filter）。
+    """
+    plan = prepare_query(question, selected_stores, use_cache, filters)
+    if plan['result'] is not None:
+        return plan['result']
+
+    client = get_client(api_key)
+    start_generation(plan)
+
+    try:
+        # 執行查詢
+        with metrics.span('generate'):
+            response = client.models.generate_content(**generate_request(plan, question, filters))
+
+        return response_result(plan, response, question, selected_stores, filters)
+
+    except Exception as e:
+        return error_result(e)
+
+
+def query_gemini_stream(question: str, selected_stores: List[str], api_key: str,
+                        use_cache: bool = True,
+                        filters: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    使用 generate_content_stream 串流查詢
+
+    依序產生事件：
+    - {'type': 'delta', 'text': ...}：部分答案文字
+    - {'type': 'done', 'result': ...}：最終結果，格式同 query_gemini()，另含 ttft（首字時間）
+
+    來源取自帶有 grounding metadata 的最後一個 chunk。
+    若串流在收到任何文字前失敗，改用 query_gemini() 非串流查詢。
+    """
+    plan = prepare_query(question, selected_stores, use_cache, filters)
+    if plan['result'] is not None:
+        yield from prepared_events(plan['result'])
+        return
+
+    client = get_client(api_key)
+    start_generation(plan)
+    state = new_stream_state()
+
+    try:
+        stream = client.models.generate_content_stream(**generate_request(plan, question, filters))
+        for chunk in stream:
+            text = consume_chunk(state, plan, chunk, filters)
+            if text:
+                yield {'type': 'delta', 'text': text}
+
+    except Exception as e:
+        if not state['parts']:
+            # 尚未輸出任何文字，退回非串流查詢
+            yield {'type': 'done', 'result': query_gemini(
+                question, selected_stores, api_key, use_cache=False, filters=filters
+            )}
+            return
+        yield {'type': 'done', 'result': stream_error_result(state, e)}
+        return
+
+    yield {'type': 'done', 'result': finish_stream(plan, state, question, selected_stores, filters)}
+
+
+async def query_gemini_async(question: str, selected_stores: List[str], api_key: str,
+                             use_cache: bool = True,
+                             filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    query_gemini() 的 async 版本（client.aio），等待 Gemini 回應時不佔用 thread
+
+    HTTP API 在同一個 event loop 上並行處理大量請求時使用。
+    """
+    plan = prepare_query(question, selected_stores, use_cache, filters)
+    if plan['result'] is not None:
+        return plan['result']
+
+    client = get_client(api_key)
+    start_generation(plan)
+
+    try:
+        with metrics.span('generate'):
+            response = await client.aio.models.generate_content(**generate_request(plan, question, filters))
+
+        return response_result(plan, response, question, selected_stores, filters)
+
+    except Exception as e:
+        return error_result(e)
+
+
+async def query_gemini_stream_async(question: str, selected_stores: List[str], api_key: str,
+                                    use_cache: bool = True,
+                                    filters: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    query_gemini_stream() 的 async 版本，事件格式相同
+
+    若串流在收到任何文字前失敗，改用 query_gemini_async() 非串流查詢。
+    """
+    plan = prepare_query(question, selected_stores, use_cache, filters)
+    if plan['result'] is not None:
+        for event in prepared_events(plan['result']):
+            yield event
+        return
+
+    client = get_client(api_key)
+    start_generation(plan)
+    state = new_stream_state()
+
+    try:
+        stream = await client.aio.models.generate_content_stream(**generate_request(plan, question, filters))
+        async for chunk in stream:
+            text = consume_chunk(state, plan, chunk, filters)
+            if text:
+                yield {'type': 'delta', 'text': text}
+
+    except Exception as e:
+        if not state['parts']:
+            yield {'type': 'done', 'result': await query_gemini_async(
+                question, selected_stores, api_key, use_cache=False, filters=filters
+            )}
+            return
+        yield {'type': 'done', 'result': stream_error_result(state, e)}
+        return
+
+    yield {'type': 'done', 'result': finish_stream(plan, state, question, selected_stores, filters)}
+
+
+def fuse_sources(source_lists: List[List[Dict[str, Any]]], k: int = 60,
+                 limit: int = FANOUT_MAX_SOURCES) -> List[Dict[str, Any]]:
+    """
+    以分數加權的 Reciprocal Rank Fusion 合併多個 Store 的來源
+
+    每個來源的融合分數為 score / (k + rank)，同一文件出現在多個 Store 時分數相加。
+    """
+    fused = {}
+    for sources in source_lists:
+        for rank, source in enumerate(sources, start=1):
+            key = source.get('doc_id') or source['raw_id']
+            weight = source.get('score', 1.0) / (k + rank)
+            if key in fused:
+                fused[key]['fused_score'] += weight
+            else:
+                fused[key] = {**source, 'fused_score': weight}
+
+    merged = sorted(fused.values(), key=lambda s: s['fused_score'], reverse=True)
+    return merged[:limit]
+
+
+def build_fanout_prompt(question: str, sources: List[Dict[str, Any]]) -> str:
+    """
+    將合併後的來源組成最終回答用的提示
+    """
+    context = "\n\n".join(
+        f"[{i}] {s['filename']}（{s['date']}）\n{s['snippet']}"
+        for i, s in enumerate(sources, start=1)
+    )
+    return f"以下是檢索到的參考資料：\n\n{context}\n\n問題：{question}"
+
+
+async def _query_store_async(client, store_key: str, question: str,
+                             filters: Optional[Dict[str, Any]] = None) -> tuple:
+    """
+    查詢單一 Store，超過 FANOUT_STORE_DEADLINE 視為逾時
+
+    回傳: (sources, stat)
+    """
+    start_time = time.time()
+    stat = {'store': store_key, 'latency': 0.0, 'sources': 0, 'timed_out': False, 'error': None,
+            'input_tokens': None}
+    sources = []
+
+    try:
+        with metrics.span('store_query', stores=[store_key]):
+            response = await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=question,
+                    config=build_generate_config(
+                        [STORES[store_key]['store_id']],
+                        get_system_prompt([store_key]),
+                        max_output_tokens=FANOUT_RETRIEVAL_TOKENS,
+                        filters=filters,
+                    )
+                ),
+                timeout=FANOUT_STORE_DEADLINE,
+            )
+        sources = apply_source_filters(extract_sources(response, snippet_length=FANOUT_CONTEXT_CHARS), filters)
+        stat['input_tokens'] = usage_input_tokens(response)
+    except asyncio.TimeoutError:
+        stat['timed_out'] = True
+    except Exception as e:
+        stat['error'] = str(e)
+
+    stat['latency'] = time.time() - start_time
+    stat['sources'] = len(sources)
+    return sources, stat
+
+
+async def _query_fanout_async(question: str, selected_stores: List[str], api_key: str,
+                              system_prompt: str, filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    並行查詢各 Store、合併來源後產生單一答案
+    """
+    from google.genai import types
+
+    client = get_client(api_key)
+
+    results = await asyncio.gather(*[
+        _query_store_async(client, store_key, question, filters) for store_key in selected_stores
+    ])
+    store_stats = [stat for _, stat in results]
+    sources = fuse_sources([store_sources for store_sources, _ in results])
+
+    if not sources:
+        return {
+            'answer': '各資料來源皆未找到相關文件',
+            'sources': [],
+            'store_stats': store_stats,
+            'error': False
+        }
+
+    synthesis_start = time.time()
+    with metrics.span('synthesis'):
+        response = await client.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=build_fanout_prompt(question, sources),
+            config=types.GenerateContentConfig(
+                temperature=0.1,
+                max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+                system_instruction=system_prompt
+            )
+        )
+
+    for source in sources:
+        source['snippet'] = source['snippet'][:500]
+
+    # 輸入 token 數：各 Store 檢索 + 彙整
+    token_counts = [stat['input_tokens'] for stat in store_stats] + [usage_input_tokens(response)]
+    known_counts = [count for count in token_counts if count is not None]
+
+    return {
+        'answer': response.text if hasattr(response, 'text') else str(response),
+        'sources': sources,
+        'store_stats': store_stats,
+        'synthesis_latency': time.time() - synthesis_start,
+        'input_tokens': sum(known_counts) if known_counts else None,
+        'error': False
+    }
+
+
+def query_gemini_fanout(question: str, selected_stores: List[str], api_key: str,
+                        use_cache: bool = True, filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    分別查詢各 Store（client.aio 並行），以 rank fusion 合併來源後產生單一答案
+
+    在共用 event loop 上執行 query_gemini_fanout_async()。
+    結果另含 store_stats：各 Store 的延遲、來源數、是否逾時，用於找出瓶頸。
+    """
+    return run_async(query_gemini_fanout_async(question, selected_stores, api_key, use_cache, filters))
+
+
+async def query_gemini_fanout_async(question: str, selected_stores: List[str], api_key: str,
+                                    use_cache: bool = True,
+                                    filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    query_gemini_fanout() 的 async 版本（HTTP API 直接在 event loop 上呼叫）
+    """
+    selected_stores = [s for s in selected_stores if s in STORES]
+
+    if not selected_stores:
+        return {
+            'answer': '請至少選擇一個資料來源',
+            'sources': [],
+            'error': True
+        }
+
+    system_prompt = get_system_prompt(selected_stores)
+
+    start_time = time.time()
+
+    cache, cache_key, cached = lookup_answer_cache(
+        question, selected_stores, system_prompt, use_cache, variant='fanout' + filters_key(filters)
+    )
+    if cached is not None:
+        return {
+            'answer': cached['answer'],
+            'sources': cached['sources'],
+            'latency': time.time() - start_time,
+            'cached': True,
+            'error': False
+        }
+
+    charge_retry(len(selected_stores) + 1)
+    try:
+        result = await _query_fanout_async(question, selected_stores, api_key, system_prompt, filters)
+    except Exception as e:
+        return error_result(e)
+
+    result['latency'] = time.time() - start_time
+    result['cached'] = False
+
+    if cache is not None and result['sources']:
+        store_answer(cache, cache_key, result['answer'], result['sources'], question, selected_stores, filters)
+
+    return result
+
+
+def query_gemini_context(question: str, selected_stores: List[str], api_key: str,
+                         sources: List[Dict[str, Any]], use_cache: bool = True) -> Dict[str, Any]:
+    """
+    以先前檢索到的來源段落回答追問（不呼叫 File Search）
+
+    question 為含對話脈絡的查詢內容；對話脈絡相同時來源也相同，快取以 question 為準。
+    """
+    from google.genai import types
+
+    system_prompt = get_system_prompt(selected_stores)
+
+    start_time = time.time()
+
+    cache, cache_key, cached = lookup_answer_cache(
+        question, selected_stores, system_prompt, use_cache, variant='context'
+    )
+    if cached is not None:
+        return {
+            'answer': cached['answer'],
+            'sources': cached['sources'],
+            'latency': time.time() - start_time,
+            'context_reused': True,
+            'cached': True,
+            'error': False
+        }
+
+    charge_retry()
+    client = get_client(api_key)
+
+    try:
+        with metrics.span('generate', context_reused=True):
+            response = client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=build_fanout_prompt(question, sources),
+                config=types.GenerateContentConfig(
+                    temperature=0.1,
+                    max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+                    system_instruction=system_prompt
+                )
+            )
+    except Exception as e:
+        return error_result(e)
+
+    answer = response.text if hasattr(response, 'text') else str(response)
+
+    if cache is not None:
+        cache.set(cache_key, {'answer': answer, 'sources': sources})
+
+    return {
+        'answer': answer,
+        'sources': sources,
+        'latency': time.time() - start_time,
+        'input_tokens': usage_input_tokens(response),
+        'context_reused': True,
+        'cached': False,
+        'error': False
+    }
+
+
+def format_source_display_name(raw_name: str) -> str:
+    """
+    將原始檔案名稱格式化為易讀的顯示名稱
+
+    原始格式範例：
+    - 法令函釋: 2006-03-03_securities_bureau_law_amendment_fsc_law_201406240001
+    - 重要公告: 2019-01-02_insurance_bureau_ann_amendment_fsc_unk_20190102_1648
+    - 裁罰案件: 2025-09-25_insurance_bureau_penalty_fsc_pen_20250925_0001
+
+    輸出格式：
+    - 法令函釋_2006-03-03
+    - 重要公告_2019-01-02
+    - 裁罰案件_2025-09-25
+    """
+    if not raw_name:
+        return "未知文件"
+
+    # 判斷來源類型
+    source_type = "未知"
+    if 'fsc_law' in raw_name or 'law_' in raw_name:
+        source_type = "法令函釋"
+    elif 'fsc_unk' in raw_name or 'ann_' in raw_name:
+        source_type = "重要公告"
+    elif 'fsc_pen' in raw_name or 'penalty' in raw_name:
+        source_type = "裁罰案件"
+
+    # 提取日期（格式：YYYY-MM-DD）
+    date = "未知日期"
+    parts = raw_name.split('_')
+    if parts and len(parts[0]) == 10 and '-' in parts[0]:
+        date = parts[0]
+
+    return f"{source_type}_{date}"
+
+
+def extract_sources(response, snippet_length: int = 500, top_k: int = SOURCES_TOP_K) -> List[Dict[str, Any]]:
+    """
+    從 Gemini 回應中提取來源（單次走訪）
+
+    - 每個 raw_id 只解析一次
+    - 同一文件（doc_id）的多個段落合併為一筆：保留最高分數，段落內容依序串接（最多 SOURCE_MAX_CHUNKS 段）
+    - 依分數保留前 top_k 筆，維持 Gemini 回傳的順序
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    start = time.perf_counter()
+
+    try:
+        chunks = []
+        if getattr(response, 'candidates', None):
+            metadata = getattr(response.candidates[0], 'grounding_metadata', None)
+            chunks = getattr(metadata, 'grounding_chunks', None) or []
+
+        # 只在有來源時載入 mapping（串流的文字 chunk 不需要）
+        index = load_mappings() if chunks else None
+        resolved: Dict[str, tuple] = {}
+
+        for chunk in chunks:
+            context = getattr(chunk, 'retrieved_context', None)
+            if context is None:
+                continue
+
+            # 提取原始檔名/ID
+            raw_id = ""
+            if getattr(context, 'title', None):
+                raw_id = context.title
+            elif getattr(context, 'uri', None):
+                raw_id = context.uri.split('/')[-1]
+
+            # 使用 mapping 解析顯示名稱（同一 raw_id 只解析一次）
+            if raw_id not in resolved:
+                doc_id = index.resolve(raw_id) if index is not None else ''
+                info = (index.get_document(doc_id) if doc_id else None) or {}
+                resolved[raw_id] = (resolve_source_display_name(raw_id, index), doc_id, info)
+            (display_name, source_type, date, original_url), doc_id, info = resolved[raw_id]
+
+            snippet = (getattr(context, 'text', None) or '')[:snippet_length]
+            score = float(chunk.score) if getattr(chunk, 'score', None) is not None else 1.0
+
+            key = doc_id or raw_id
+            source = merged.get(key)
+            if source is None:
+                merged[key] = {
+                    'filename': display_name,
+                    'raw_id': raw_id,
+                    'source_type': source_type,
+                    'date': date,
+                    'snippet': snippet,
+                    'score': score,
+                    'original_url': original_url,
+                    'doc_id': doc_id,
+                    'source': info.get('source', ''),
+                    'category': info.get('category', ''),
+                    'chunks': 1,
+                }
+                continue
+
+            source['score'] = max(source['score'], score)
+            if snippet and snippet not in source['snippet'] and source['chunks'] < SOURCE_MAX_CHUNKS:
+                source['snippet'] = source['snippet'] + SNIPPET_SEPARATOR + snippet if source['snippet'] else snippet
+                source['chunks'] += 1
+
+    except Exception as e:
+        logger.warning("提取來源時發生錯誤: %s", e)
+
+    sources = list(merged.values())
+    if top_k and len(sources) > top_k:
+        keep = sorted(range(len(sources)), key=lambda i: -sources[i]['score'])[:top_k]
+        sources = [sources[i] for i in sorted(keep)]
+
+    if sources:
+        metrics.record_span('extract_sources', time.perf_counter() - start, sources=len(sources))
+    return sources
@@ -0,0 +1,316 @@
+"""
+查詢重試策略
+
+在 query_gemini() 外層提供：
+- Hedged request：第一次嘗試超過近期延遲 p90 仍未完成時，提前送出第二次嘗試
+- 429 / 5xx / 逾時以指數退避 + jitter 重試
+- 整體期限（deadline），超過即回傳目前最佳結果
+- 取第一個帶有參考來源的結果
+
+重試次數與 hedge 勝出次數會被記錄，用於調整延遲參數。
+每次嘗試在呼叫端 context 的複本中執行，並設定 metrics.attempt_index。
+
+所有嘗試在每個 process 共用的 thread pool（max_workers）中執行，pool 大小即為整個 process
+同時進行的 Gemini 呼叫上限。pool 滿載時嘗試會先排隊：
+- 期限、hedge 延遲與延遲樣本都從嘗試開始執行時起算，排隊時間不計入
+- 仍在排隊的嘗試不算進行中（不觸發 hedge），結束時取消尚未開始的嘗試
+- 排隊超過 deadline 仍未開始時放棄（回傳逾時）
+- 已開始執行的嘗試無法中斷，回傳後仍佔用 worker 直到 Gemini 請求完成或逾時（GEMINI_TIMEOUT）
+
+run_async() 為 async 版本（HTTP API 使用）：依序退避重試，不送 hedge。
+"""
+
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from metrics import attempt_index
+
+# 可重試的 HTTP 狀態碼
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# 有嘗試在 pool 中排隊時，檢查是否已開始執行的間隔（秒）
+QUEUE_POLL_INTERVAL = 0.05
+
+
+class RetryPolicy:
+    """
+    Hedged + 退避重試引擎（thread-safe，每個 process 共用一個）
+    """
+
+    def __init__(self, max_attempts: int = 3, deadline: float = 90.0,
+                 hedge_enabled: bool = True, hedge_default_delay: float = 15.0,
+                 hedge_percentile: float = 0.9, backoff_base: float = 1.0,
+                 backoff_max: float = 8.0, window: int = 200, max_workers: int = 16):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.hedge_enabled = hedge_enabled
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_percentile = hedge_percentile
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._latencies = deque(maxlen=window)
+        self._counters = {
+            'requests': 0,
+            'attempts': 0,
+            'retries': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+            'deadline_exceeded': 0,
+            'queue_timeouts': 0,        # 排隊超過 deadline 仍未開始執行
+        }
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-attempt')
+
+    def _incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def record_latency(self, seconds: float):
+        """記錄一次成功嘗試的延遲"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> float:
+        """
+        依近期延遲的百分位數計算 hedge 延遲；樣本不足時使用預設值
+        """
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < 10:
+            return self.hedge_default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.hedge_percentile))
+        return samples[index]
+
+    def backoff_delay(self, retry: int) -> float:
+        """指數退避 + full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** retry)))
+
+    @staticmethod
+    def _run_attempt(attempt_fn: Callable[[int], Dict[str, Any]], index: int, base_index: int,
+                     state: Dict[str, Any]) -> Dict[str, Any]:
+        state['started_at'] = time.time()
+        attempt_index.set(base_index + index)
+        return attempt_fn(index)
+
+    def run(self, attempt_fn: Callable[[int], Dict[str, Any]],
+            max_attempts: Optional[int] = None) -> Dict[str, Any]:
+        """
+        執行查詢直到取得帶來源的結果、用盡嘗試次數或超過期限
+
+        attempt_fn(attempt_index) 回傳 query_gemini() 格式的結果；
+        錯誤結果帶有 retryable=True 時會退避後重試。
+        max_attempts 可覆寫本次呼叫的嘗試上限。
+
+        期限從第一次嘗試開始執行時起算（不含在 pool 中排隊的時間）。
+        回傳的結果另含 attempts（嘗試次數）與 hedge_win（是否由 hedge 嘗試勝出）。
+        """
+        self._incr('requests')
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        max_attempts = max(1, max_attempts)
+        queue_deadline_at = time.time() + self.deadline
+        deadline_at: Optional[float] = None
+
+        base_index = attempt_index.get()
+        pending = {}        # future -> {'started_at'（排隊中為 None）, 'is_hedge'}
+        launched = 0
+        retries = 0
+        hedged = False
+        next_launch_at: Optional[float] = None
+        fallback: Optional[Dict[str, Any]] = None
+
+        def launch(is_hedge: bool = False):
+            nonlocal launched
+            context = contextvars.copy_context()
+            state = {'started_at': None, 'is_hedge': is_hedge}
+            future = self._executor.submit(context.run, self._run_attempt, attempt_fn, launched, base_index, state)
+            pending[future] = state
+            launched += 1
+            self._incr('attempts')
+            if is_hedge:
+                self._incr('hedges')
+
+        def finish(result: Dict[str, Any], hedge_win: bool = False) -> Dict[str, Any]:
+            # 取消仍在排隊的嘗試（已開始執行的無法取消）
+            for future in pending:
+                future.cancel()
+            result = dict(result)
+            result['attempts'] = launched
+            result['hedge_win'] = hedge_win
+            if hedge_win:
+                self._incr('hedge_wins')
+            return result
+
+        launch()
+
+        while True:
+            now = time.time()
+            running = [state for state in pending.values() if state['started_at'] is not None]
+            queued = len(pending) - len(running)
+            if deadline_at is None and running:
+                deadline_at = min(state['started_at'] for state in running) + self.deadline
+
+            limit_at = deadline_at if deadline_at is not None else queue_deadline_at
+            if now >= limit_at:
+                if deadline_at is None:
+                    self._incr('queue_timeouts')
+                    return finish({
+                        'answer': '目前查詢量過大，請稍後再試',
+                        'sources': [],
+                        'error': True
+                    })
+                self._incr('deadline_exceeded')
+                if fallback is not None:
+                    return finish(fallback)
+                return finish({
+                    'answer': f'查詢逾時（超過 {self.deadline:g} 秒），請稍後再試',
+                    'sources': [],
+                    'error': True
+                })
+
+            # 計算下一個喚醒時間：deadline、排程中的重試、hedge、排隊中的嘗試開始執行
+            wake_at = limit_at
+            if next_launch_at is not None:
+                wake_at = min(wake_at, next_launch_at)
+            if queued:
+                wake_at = min(wake_at, now + QUEUE_POLL_INTERVAL)
+
+            # hedge 只在唯一的嘗試已開始執行時計時
+            hedge_at = None
+            if self.hedge_enabled and not hedged and launched < max_attempts and len(running) == 1 and not queued:
+                hedge_at = running[0]['started_at'] + self.hedge_delay()
+                wake_at = min(wake_at, hedge_at)
+
+            if pending:
+                done, _ = wait(list(pending), timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(max(0.0, wake_at - now))
+                done = set()
+
+            for future in done:
+                state = pending.pop(future)
+                if deadline_at is None and state['started_at'] is not None:
+                    deadline_at = state['started_at'] + self.deadline
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'answer': f'查詢失敗: {str(e)}', 'sources': [], 'error': True}
+
+                if not result.get('error'):
+                    if not result.get('cached') and state['started_at'] is not None:
+                        self.record_latency(time.time() - state['started_at'])
+                    if result.get('sources'):
+                        return finish(result, hedge_win=state['is_hedge'])
+                    # 無來源：保留為備案，立即再試一次
+                    fallback = result
+                    if launched < max_attempts and not pending and next_launch_at is None:
+                        next_launch_at = time.time()
+                elif result.get('retryable') and launched < max_attempts:
+                    # 429 / 5xx：退避後重試
+                    if fallback is None:
+                        fallback = result
+                    if next_launch_at is None:
+                        next_launch_at = time.time() + self.backoff_delay(retries)
+                else:
+                    if fallback is None or fallback.get('error'):
+                        fallback = result
+
+            now = time.time()
+            if next_launch_at is not None and now >= next_launch_at and launched < max_attempts:
+                next_launch_at = None
+                retries += 1
+                self._incr('retries')
+                launch()
+            elif hedge_at is not None and now >= hedge_at and len(pending) == 1 and launched < max_attempts:
+                hedged = True
+                launch(is_hedge=True)
+
+            if not pending and next_launch_at is None:
+                return finish(fallback)
+
+    async def run_async(self, attempt_fn: Callable[[int], Awaitable[Dict[str, Any]]],
+                        max_attempts: Optional[int] = None) -> Dict[str, Any]:
+        """
+        run() 的 async 版本：依序嘗試，無來源時立即再試，429 / 5xx 退避後重試
+
+        在 event loop 上不送 hedge（避免尖峰時倍增上游請求），超過期限時取消進行中的嘗試。
+        回傳格式同 run()。
+        """
+        self._incr('requests')
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        max_attempts = max(1, max_attempts)
+        deadline_at = time.time() + self.deadline
+
+        base_index = attempt_index.get()
+        launched = 0
+        fallback: Optional[Dict[str, Any]] = None
+
+        def finish(result: Dict[str, Any]) -> Dict[str, Any]:
+            result = dict(result)
+            result['attempts'] = launched
+            result['hedge_win'] = False
+            return result
+
+        while launched < max_attempts:
+            remaining = deadline_at - time.time()
+            if remaining <= 0:
+                break
+
+            if launched > 0:
+                self._incr('retries')
+            self._incr('attempts')
+            token = attempt_index.set(base_index + launched)
+            launched += 1
+            started_at = time.time()
+            try:
+                result = await asyncio.wait_for(attempt_fn(launched - 1), remaining)
+            except asyncio.TimeoutError:
+                break
+            except Exception as e:
+                result = {'answer': f'查詢失敗: {str(e)}', 'sources': [], 'error': True}
+            finally:
+                attempt_index.reset(token)
+
+            if not result.get('error'):
+                if not result.get('cached'):
+                    self.record_latency(time.time() - started_at)
+                if result.get('sources'):
+                    return finish(result)
+                # 無來源：保留為備案，立即再試一次
+                fallback = result
+                continue
+
+            if fallback is None or fallback.get('error'):
+                fallback = result
+            if not result.get('retryable'):
+                return finish(fallback)
+            if launched < max_attempts:
+                await asyncio.sleep(min(self.backoff_delay(launched - 1), max(0.0, deadline_at - time.time())))
+        else:
+            return finish(fallback)
+
+        self._incr('deadline_exceeded')
+        if fallback is not None:
+            return finish(fallback)
+        return finish({
+            'answer': f'查詢逾時（超過 {self.deadline:g} 秒），請稍後再試',
+            'sources': [],
+            'error': True
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳統計：requests, attempts, retries, hedges, hedge_wins, deadline_exceeded, queue_timeouts, hedge_delay
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['hedge_delay'] = self.hedge_delay()
+        return stats
@@ -0,0 +1,36 @@
+"""
+應用程式設定
+
+設定值依序從 Streamlit secrets、環境變數讀取，皆未設定時使用預設值。
+環境變數的字串會依預設值的型別轉換（bool / int / float）。
+"""
+
+import os
+from typing import Any
+
+
+def get_setting(name: str, default: Any = None) -> Any:
+    """
+    讀取設定值
+
+    優先順序：st.secrets > 環境變數 > default
+    """
+    try:
+        import streamlit as st
+        if name in st.secrets:
+            return st.secrets[name]
+    except Exception:
+        # 非 Streamlit 環境或沒有 secrets.toml
+        pass
+
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
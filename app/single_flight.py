@@ -0,0 +1,103 @@
+"""
+相同查詢合併（single-flight）
+
+同一個問題在短時間內被多位使用者同時送出時，只由第一個呼叫者（leader）
+實際呼叫 Gemini，其餘呼叫者（follower）等待同一個結果。
+
+- follower 等待超過 timeout（leader 卡住）時改為自行查詢
+- leader 失敗或被中斷（例如使用者重新整理頁面）時，follower 也改為自行查詢
+- 每個 follower 取得結果的獨立複本（deepcopy），leader 之後修改自己的結果不影響 follower
+"""
+
+import copy
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class LeaderAborted(Exception):
+    """leader 未正常完成（例外或 Streamlit 中斷）"""
+
+
+class SingleFlight:
+    """
+    以 key 合併進行中的相同請求（thread-safe，每個 process 共用一個）
+    """
+
+    def __init__(self, timeout: float = 60.0):
+        self.timeout = timeout
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'requests': 0,
+            'leaders': 0,
+            'coalesced': 0,
+            'timeouts': 0,
+            'leader_failures': 0,
+        }
+
+    def _incr(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None,
+           on_wait: Optional[Callable[[], None]] = None) -> Tuple[Any, bool]:
+        """
+        執行 fn()，或等待進行中的相同請求
+
+        on_wait 在成為 follower、開始等待前呼叫（例如顯示提示）。
+        回傳: (result, shared)，shared=True 表示結果來自其他呼叫者（為獨立的複本，可直接修改）
+        """
+        with self._lock:
+            self._counters['requests'] += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self._counters['leaders'] += 1
+
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                # Streamlit 的 rerun / stop 為 BaseException，follower 只需知道 leader 未完成
+                future.set_exception(LeaderAborted(repr(e)))
+                raise
+            else:
+                # 保存完成時的快照，leader 之後修改 result 不影響 follower
+                future.set_result(copy.deepcopy(result))
+                return result, False
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is future:
+                        del self._calls[key]
+
+        if on_wait is not None:
+            on_wait()
+
+        try:
+            result = future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            self._incr('timeouts')
+            return fn(), False
+        except LeaderAborted:
+            self._incr('leader_failures')
+            return fn(), False
+
+        self._incr('coalesced')
+        return copy.deepcopy(result), True
+
+    def in_flight(self) -> int:
+        """進行中的不同請求數"""
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        回傳統計：requests, leaders, coalesced, timeouts, leader_failures, coalesce_rate
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['coalesce_rate'] = stats['coalesced'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
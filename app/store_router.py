@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+資料來源自動路由
+
+在呼叫 query_gemini() 前，以本地關鍵字分類器為每個問題挑選相關的 Store，
+避免使用者勾選全部資料來源時，每次查詢都要等待最慢的 Store。
+
+分數來源：
+- 關鍵字權重（裁罰 / 罰鍰 → 裁罰案件、函釋 / 解釋 → 法令函釋、公告 / 預告 → 重要公告）
+- mapping 中的文件類別名稱（law_* → 法令函釋、ann_* → 重要公告）
+- 問題提到 mapping 中的法規名稱時，加重法令函釋與重要公告
+
+來源單位（保險局、銀行局等）在三個 Store 中都有，不影響路由。
+信心不足時回傳全部候選 Store。
+
+離線準確率檢查（tune 為調整關鍵字權重時參考的問題，結果屬樣本內；holdout 未用於調整）：
+    python app/store_router.py [--file data/router_eval.jsonl] [--split tune|holdout]
+"""
+
+import argparse
+import json
+import logging
+import re
+import time
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from doc_lookup import CATEGORY_LABELS, DocLookup
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVAL_PATH = Path(__file__).parent.parent / "data" / "router_eval.jsonl"
+
+# 標註問題集的分組
+SPLIT_LABELS = {
+    'tune': '調整關鍵字權重時參考（樣本內）',
+    'holdout': '未用於調整權重',
+}
+
+# 關鍵字權重
+KEYWORD_WEIGHTS = {
+    'penalties': {
+        '裁罰': 3.0, '罰鍰': 3.0, '裁處': 3.0, '被罰': 3.0, '處罰': 2.0, '處分': 2.0,
+        '警告': 2.0, '糾正': 2.0, '懲處': 2.0, '停職': 2.0, '解除職務': 2.0, '違規': 2.0,
+        '罰則': 2.0, '違反': 1.5, '缺失': 1.5, '案例': 1.0, '案件': 1.0, '罰': 1.0,
+    },
+    'law_interpretations': {
+        '函釋': 3.0, '解釋': 2.5, '疑義': 2.0, '條文': 2.0, '認定': 1.5, '適用': 1.5,
+        '法規': 1.5, '規範': 1.0, '規定': 1.0, '要件': 1.5, '時點': 1.0, '修正': 1.0,
+        '辦法': 1.0, '準則': 1.0, '規則': 1.0, '令': 0.5,
+    },
+    'announcements': {
+        '公告': 3.0, '預告': 3.0, '草案': 2.0, '生效': 2.0, '施行': 1.5, '訂定': 1.5,
+        '發布': 1.5, '指定': 1.5, '政策': 1.5, '修正': 1.0,
+    },
+}
+
+# mapping 類別前綴 → Store
+CATEGORY_PREFIX_STORES = {
+    'law_': 'law_interpretations',
+    'ann_': 'announcements',
+    'penalty': 'penalties',
+}
+
+# 問題提到已知法規名稱時的加分
+LAW_NAME_WEIGHTS = {'law_interpretations': 2.0, 'announcements': 1.5}
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or ''))
+
+
+class StoreRouter:
+    """
+    本地 Store 路由分類器
+    """
+
+    def __init__(self, doc_lookup: Optional[DocLookup] = None, min_confidence: float = 0.5,
+                 route_ratio: float = 0.5, min_evidence: float = 3.0):
+        self.doc_lookup = doc_lookup
+        self.min_confidence = min_confidence
+        self.route_ratio = route_ratio
+        self.min_evidence = min_evidence
+
+        # 關鍵字表 + mapping 類別名稱
+        self.weights: Dict[str, Dict[str, float]] = {
+            store: dict(keywords) for store, keywords in KEYWORD_WEIGHTS.items()
+        }
+        for category, label in CATEGORY_LABELS.items():
+            for prefix, store in CATEGORY_PREFIX_STORES.items():
+                if category.startswith(prefix):
+                    self.weights[store].setdefault(label, 2.0)
+
+    def score(self, question: str) -> Dict[str, float]:
+        """計算各 Store 的分數"""
+        text = _normalize(question)
+        scores = {store: 0.0 for store in self.weights}
+
+        for store, keywords in self.weights.items():
+            for keyword, weight in keywords.items():
+                if keyword in text:
+                    scores[store] += weight
+
+        if self.doc_lookup is not None:
+            lookup = self.doc_lookup.match(text)
+            if lookup is not None:
+                for store, weight in LAW_NAME_WEIGHTS.items():
+                    scores[store] += weight * lookup['coverage']
+
+        return scores
+
+    def route(self, question: str, candidates: List[str]) -> Dict[str, Any]:
+        """
+        從候選 Store 中挑選相關的子集
+
+        回傳: {'stores': [...], 'scores': {...}, 'confidence': float, 'fallback': bool, 'elapsed': 秒}
+        """
+        start_time = time.perf_counter()
+        scores = {store: s for store, s in self.score(question).items() if store in candidates}
+
+        total = sum(scores.values())
+        top = max(scores.values()) if scores else 0.0
+        chosen = [store for store in candidates if top > 0 and scores.get(store, 0.0) >= top * self.route_ratio]
+
+        confidence = 0.0
+        if total > 0:
+            confidence = sum(scores[s] for s in chosen) / total * min(1.0, total / self.min_evidence)
+
+        fallback = confidence < self.min_confidence or not chosen
+        stores = list(candidates) if fallback else chosen
+        elapsed = time.perf_counter() - start_time
+
+        logger.info(
+            "store route: stores=%s confidence=%.2f fallback=%s scores=%s elapsed=%.3fms",
+            stores, confidence, fallback, scores, elapsed * 1000
+        )
+
+        return {
+            'stores': stores,
+            'scores': scores,
+            'confidence': confidence,
+            'fallback': fallback,
+            'elapsed': elapsed,
+        }
+
+
+def load_eval_rows(eval_path: Path) -> List[Dict[str, Any]]:
+    """
+    讀取標註問題集
+
+    每行格式: {"question": "...", "stores": ["penalties", ...], "split": "tune" | "holdout"}
+    split 省略時視為 tune
+    """
+    rows = []
+    with open(eval_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                row = json.loads(line)
+                row.setdefault('split', 'tune')
+                rows.append(row)
+    return rows
+
+
+def evaluate(router: StoreRouter, rows: List[Dict[str, Any]], all_stores: List[str]) -> Dict[str, Any]:
+    """
+    以標註問題評估路由準確率
+
+    - exact：選出的 Store 與標註完全相同
+    - recall：標註的 Store 全部被選中（不會漏查）
+    """
+
+    exact = recall = fallbacks = 0
+    elapsed = []
+    per_store = {store: {'tp': 0, 'fp': 0, 'fn': 0} for store in all_stores}
+    misses = []
+
+    for row in rows:
+        decision = router.route(row['question'], all_stores)
+        predicted, expected = set(decision['stores']), set(row['stores'])
+        elapsed.append(decision['elapsed'])
+
+        exact += predicted == expected
+        recall += expected <= predicted
+        fallbacks += decision['fallback']
+        if predicted != expected:
+            misses.append((row['question'], sorted(expected), sorted(predicted)))
+
+        for store in all_stores:
+            if store in predicted and store in expected:
+                per_store[store]['tp'] += 1
+            elif store in predicted:
+                per_store[store]['fp'] += 1
+            elif store in expected:
+                per_store[store]['fn'] += 1
+
+    n = len(rows) or 1
+    elapsed.sort()
+    return {
+        'count': len(rows),
+        'exact': exact / n,
+        'recall': recall / n,
+        'fallback_rate': fallbacks / n,
+        'p50_ms': elapsed[len(elapsed) // 2] * 1000 if elapsed else 0.0,
+        'max_ms': elapsed[-1] * 1000 if elapsed else 0.0,
+        'per_store': per_store,
+        'misses': misses,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Store 路由離線準確率檢查')
+    parser.add_argument('--file', default=str(DEFAULT_EVAL_PATH), help='標註問題集 (JSONL)')
+    parser.add_argument('--data', default=str(Path(__file__).parent.parent / "data"), help='資料目錄')
+    parser.add_argument('--split', choices=list(SPLIT_LABELS), default=None, help='只評估其中一組（預設兩組分別列出）')
+    args = parser.parse_args(argv)
+
+    router = StoreRouter(DocLookup.from_data_path(Path(args.data)))
+    rows = load_eval_rows(Path(args.file))
+
+    for split, label in SPLIT_LABELS.items():
+        split_rows = [row for row in rows if row['split'] == split]
+        if not split_rows or args.split not in (None, split):
+            continue
+        report = evaluate(router, split_rows, list(KEYWORD_WEIGHTS))
+
+        print(f"【{split}】{label}　題數: {report['count']}")
+        print(f"完全正確: {report['exact']:.1%}　不漏查: {report['recall']:.1%}　退回全部: {report['fallback_rate']:.1%}")
+        print(f"路由耗時: p50 {report['p50_ms']:.3f} ms　max {report['max_ms']:.3f} ms")
+        for store, c in report['per_store'].items():
+            precision = c['tp'] / (c['tp'] + c['fp']) if c['tp'] + c['fp'] else 0.0
+            recall = c['tp'] / (c['tp'] + c['fn']) if c['tp'] + c['fn'] else 0.0
+            print(f"  {store:<20} precision {precision:.1%}　recall {recall:.1%}")
+        if report['misses']:
+            print("不一致：")
+            for question, expected, predicted in report['misses']:
+                print(f"  {question}\n    標註 {expected} → 路由 {predicted}")
+        print()
+
+
+if __name__ == '__main__':
+    main()